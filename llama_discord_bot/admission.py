@@ -0,0 +1,97 @@
+import asyncio
+import discord
+
+# What makes the bot answer a message
+ALL = "all"
+MENTION = "mention"
+DM = "dm"
+CHANNEL = "channel"
+REPLY = "reply"
+TRIGGERS = frozenset({ALL, MENTION, DM, CHANNEL, REPLY})
+
+
+class AdmissionFilter:
+    """Decides which messages the bot answers, before any work is done for them: every message (`ALL`), or
+    only the ones that mention the bot, are sent to it directly, are sent to one of `channels`, or reply to
+    one of its messages. Messages that are not answered are still part of the conversation history.
+    """
+
+    def __init__(
+        self, triggers: frozenset[str] = frozenset({ALL}), channels=frozenset()
+    ):
+        unknown = set(triggers) - TRIGGERS
+        assert not unknown, f"Unknown triggers: {', '.join(sorted(unknown))}"
+        self.triggers = frozenset(triggers)
+        self.channels = frozenset(channels)
+        self.admitted: dict[str, int] = {}
+        self.dropped = 0
+
+    def _trigger(
+        self, message: discord.Message, bot_user: discord.abc.User
+    ) -> str | None:
+        if ALL in self.triggers:
+            return ALL
+        if MENTION in self.triggers and any(
+            user.id == bot_user.id for user in message.mentions
+        ):
+            return MENTION
+        if DM in self.triggers and message.guild is None:
+            return DM
+        if CHANNEL in self.triggers and message.channel.id in self.channels:
+            return CHANNEL
+        if REPLY in self.triggers and message.reference is not None:
+            # Only replies to messages discord.py has at hand are recognized, so no request is made for them
+            author = getattr(message.reference.resolved, "author", None)
+            if author is not None and author.id == bot_user.id:
+                return REPLY
+        return None
+
+    def admit(self, message: discord.Message, bot_user: discord.abc.User) -> bool:
+        """Whether the bot should answer a message."""
+
+        trigger = self._trigger(message, bot_user)
+        if trigger is None:
+            self.dropped += 1
+            return False
+        self.admitted[trigger] = self.admitted.get(trigger, 0) + 1
+        return True
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "dropped": self.dropped,
+            **{
+                f"admitted_{trigger}": self.admitted.get(trigger, 0)
+                for trigger in sorted(self.triggers)
+            },
+        }
+
+
+class MessageDebouncer:
+    """Merges bursts of messages in a channel into a single response. Each message waits `window` seconds,
+    and is only answered if no other message arrived in its channel meanwhile. The last message of a burst
+    answers all of them, since the prompt merges consecutive messages of the same role anyway.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._latest: dict[int, int] = {}
+        self.coalesced = 0
+
+    async def settle(self, channel_id: int, message_id: int) -> bool:
+        """Wait for the burst of a message to end. Returns whether the message is the last of its burst."""
+
+        self._latest[channel_id] = message_id
+        try:
+            await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            if self._latest.get(channel_id) == message_id:
+                del self._latest[channel_id]
+            raise
+        if self._latest.get(channel_id) != message_id:
+            self.coalesced += 1
+            return False
+        del self._latest[channel_id]
+        return True
+
+    def stats(self) -> dict[str, int]:
+        return {"coalesced": self.coalesced, "pending_channels": len(self._latest)}
@@ -0,0 +1,319 @@
+import functools
+import os
+from typing import TYPE_CHECKING
+from llama_discord_bot.cascade import LlamaCascade, PromptClassifier
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import (
+    LlamaBase,
+    LlamaLocal,
+    LlamaReplicate,
+    llama_cpp_token_counter,
+)
+from llama_discord_bot.inference_server import RemoteLlama
+from llama_discord_bot.loader import BackgroundLoadedLlama
+from llama_discord_bot.router import LlamaRouter
+from llama_discord_bot.worker_pool import LlamaWorkerPool
+
+if TYPE_CHECKING:
+    from llama_discord_bot.replicate_client import ReplicateClient
+
+
+class BackendBuilder:
+    """Creates the backend the bot (or an inference server) generates responses with: local models, replicate
+    models or inference servers, with a router in front of them if there are several, and optionally a small
+    model that takes the easy requests in a cascade.
+    It keeps the clients the backends share, so they can be closed. Local and replicate models generate with
+    `generation_config` by default, while inference servers have settings of their own.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str = "",
+        generation_config: GenerationConfig | None = None,
+    ):
+        self.system_prompt = system_prompt
+        self.generation_config = generation_config
+        self.replicate_client: "ReplicateClient | None" = None
+        self.remote_backends: list[RemoteLlama] = []
+        self.worker_pools: list[LlamaWorkerPool] = []
+
+    def build(
+        self,
+        local,
+        *,
+        replicate_model=None,
+        local_model_path=None,
+        local_state_cache_dir=None,
+        local_workers=1,
+        local_use_mmap=True,
+        local_use_mlock=False,
+        local_warmup_prompt=None,
+        wait_for_model=False,
+        tokenizer_model_path=None,
+        inference_servers=None,
+        inference_server_concurrency=None,
+        small_local_model_path=None,
+        small_replicate_model=None,
+        cascade_max_easy_tokens=48,
+        cascade_max_easy_turns=8,
+        cascade_keywords=None,
+    ) -> LlamaBase:
+        """Create the backend of the given configuration, like the environment of `main.py` describes it."""
+
+        # A small local model takes its share of the cores
+        local_models = 1 if small_local_model_path else 0
+        llama = self._build(
+            local,
+            replicate_model=replicate_model,
+            local_model_path=local_model_path,
+            local_state_cache_dir=local_state_cache_dir,
+            local_workers=local_workers,
+            local_use_mmap=local_use_mmap,
+            local_use_mlock=local_use_mlock,
+            local_warmup_prompt=local_warmup_prompt,
+            wait_for_model=wait_for_model,
+            tokenizer_model_path=tokenizer_model_path,
+            inference_servers=inference_servers,
+            inference_server_concurrency=inference_server_concurrency,
+            other_local_models=local_models,
+        )
+        if not (small_local_model_path or small_replicate_model):
+            return llama
+
+        if small_local_model_path:
+            if local:
+                local_models += local_workers * len(local_model_path.split(","))
+            small = self.create_local_backend(
+                small_local_model_path,
+                state_cache_dir=local_state_cache_dir,
+                workers=1,
+                n_threads=max(1, os.cpu_count() // local_models),
+                use_mmap=local_use_mmap,
+                use_mlock=local_use_mlock,
+                warmup_prompt=local_warmup_prompt,
+                wait=wait_for_model,
+            )
+        else:
+            (small,) = self.create_replicate_backends(
+                small_replicate_model, tokenizer_model_path
+            )
+        print(f"🪜 Sending easy requests to {small.name}")
+        return LlamaCascade(
+            small,
+            llama,
+            system_prompt=self.system_prompt,
+            classifier=PromptClassifier(
+                max_easy_tokens=cascade_max_easy_tokens,
+                max_easy_turns=cascade_max_easy_turns,
+                keywords=cascade_keywords,
+            ),
+        )
+
+    def _build(
+        self,
+        local,
+        *,
+        replicate_model,
+        local_model_path,
+        local_state_cache_dir,
+        local_workers,
+        local_use_mmap,
+        local_use_mlock,
+        local_warmup_prompt,
+        wait_for_model,
+        tokenizer_model_path,
+        inference_servers,
+        inference_server_concurrency,
+        other_local_models,
+    ) -> LlamaBase:
+        if inference_servers:
+            print("🛰️  Running model through inference servers")
+            return self.route(
+                self.create_remote_backends(
+                    inference_servers,
+                    tokenizer_model_path,
+                    max_concurrency=inference_server_concurrency,
+                )
+            )
+        if local:
+            print("🖥️  Running model locally")
+            assert (
+                local_model_path is not None
+            ), "local_model_path must be specified when running locally"
+            # Several comma-separated models run side by side, splitting the cores between them
+            model_paths = [path.strip() for path in local_model_path.split(",")]
+            backends = [
+                self.create_local_backend(
+                    model_path,
+                    state_cache_dir=local_state_cache_dir,
+                    workers=local_workers,
+                    n_threads=max(
+                        1,
+                        os.cpu_count()
+                        // (local_workers * len(model_paths) + other_local_models),
+                    ),
+                    use_mmap=local_use_mmap,
+                    use_mlock=local_use_mlock,
+                    warmup_prompt=local_warmup_prompt,
+                    wait=wait_for_model,
+                )
+                for model_path in model_paths
+            ]
+            # Replicate takes the requests the local models cannot, if a model is configured
+            overflow = (
+                self.create_replicate_backends(replicate_model, tokenizer_model_path)
+                if replicate_model
+                else []
+            )
+            return self.route(backends, overflow)
+        print("☁️  Running model through replicate")
+        assert (
+            replicate_model is not None
+        ), "replicate_model must be specified when running through replicate"
+        return self.route(
+            self.create_replicate_backends(replicate_model, tokenizer_model_path)
+        )
+
+    def create_local_backend(
+        self,
+        model_path,
+        *,
+        state_cache_dir,
+        workers,
+        n_threads,
+        use_mmap,
+        use_mlock,
+        warmup_prompt,
+        wait,
+    ) -> LlamaBase:
+        """Create a local model, either running in worker processes or loading in the background."""
+
+        create_llama = functools.partial(
+            LlamaLocal,
+            model_path=model_path,
+            system_prompt=self.system_prompt,
+            state_cache_dir=state_cache_dir,
+            n_threads=n_threads,
+            use_mmap=use_mmap,
+            use_mlock=use_mlock,
+            generation_config=self.generation_config,
+        )
+        if workers > 1:
+            print(f"🧵 Running {workers} model worker processes")
+            pool = LlamaWorkerPool(
+                create_llama,
+                workers=workers,
+                system_prompt=self.system_prompt,
+                name=f"{LlamaLocal.__name__}:{model_path}",
+                # The vocabulary is loaded in a thread once the pool is started, like the model of a loader
+                tokenizer=functools.partial(llama_cpp_token_counter, model_path),
+                context_window=LlamaLocal.CONTEXT_WINDOW,
+                generation_config=self.generation_config,
+                warmup_prompt=warmup_prompt,
+                wait=wait,
+            )
+            self.worker_pools.append(pool)
+            return pool
+        # The model loads in the background, once the loaders are started
+        return BackgroundLoadedLlama(
+            create_llama,
+            system_prompt=self.system_prompt,
+            name=f"{LlamaLocal.__name__}:{model_path}",
+            context_window=LlamaLocal.CONTEXT_WINDOW,
+            max_concurrency=LlamaLocal.MAX_CONCURRENCY,
+            wait=wait,
+            warmup_prompt=warmup_prompt,
+            generation_config=self.generation_config,
+        )
+
+    def create_replicate_backends(
+        self, replicate_models, tokenizer_model_path
+    ) -> list[LlamaBase]:
+        """Create a backend for each of the comma-separated replicate models, sharing one client."""
+
+        # pylint: disable=import-outside-toplevel
+        from llama_discord_bot.replicate_client import ReplicateClient
+
+        if self.replicate_client is None:
+            self.replicate_client = ReplicateClient()
+        count_tokens = (
+            llama_cpp_token_counter(tokenizer_model_path)
+            if tokenizer_model_path
+            else None
+        )
+        return [
+            LlamaReplicate(
+                replicate_model=replicate_model.strip(),
+                client=self.replicate_client,
+                system_prompt=self.system_prompt,
+                count_tokens=count_tokens,
+                generation_config=self.generation_config,
+            )
+            for replicate_model in replicate_models.split(",")
+        ]
+
+    def create_remote_backends(
+        self, urls, tokenizer_model_path, max_concurrency
+    ) -> list[LlamaBase]:
+        """Create a backend for each of the comma-separated inference server URLs."""
+
+        count_tokens = (
+            llama_cpp_token_counter(tokenizer_model_path)
+            if tokenizer_model_path
+            else None
+        )
+        backends = [
+            RemoteLlama(
+                url.strip(),
+                system_prompt=self.system_prompt,
+                count_tokens=count_tokens,
+                max_concurrency=max_concurrency,
+            )
+            for url in urls.split(",")
+        ]
+        self.remote_backends.extend(backends)
+        return backends
+
+    def route(self, backends, overflow=()) -> LlamaBase:
+        """Put a router in front of the backends, unless there is only one."""
+
+        if len(backends) == 1 and not overflow:
+            return backends[0]
+        print(
+            f"🔀 Routing between {len(backends)} backends"
+            + (f" and {len(overflow)} overflow backends" if overflow else "")
+        )
+        return LlamaRouter(
+            backends, system_prompt=self.system_prompt, overflow=list(overflow)
+        )
+
+    @staticmethod
+    def loaders(
+        llama: LlamaBase,
+    ) -> list[BackgroundLoadedLlama | LlamaWorkerPool]:
+        """The backends of `llama` that load in the background (or in worker processes), and have to be started."""
+
+        if isinstance(llama, LlamaRouter):
+            backends = [replica.llama for replica in llama.replicas]
+        elif isinstance(llama, LlamaCascade):
+            backends = [tier.llama for tier in llama.tiers.values()]
+        else:
+            return (
+                [llama]
+                if isinstance(llama, (BackgroundLoadedLlama, LlamaWorkerPool))
+                else []
+            )
+        return [
+            loader for backend in backends for loader in BackendBuilder.loaders(backend)
+        ]
+
+    async def close(self) -> None:
+        """Close the connections to replicate and the inference servers, and stop the worker processes."""
+
+        if self.replicate_client is not None:
+            await self.replicate_client.close()
+        for backend in self.remote_backends:
+            await backend.close()
+        for pool in self.worker_pools:
+            await pool.close()
+        self.worker_pools = []
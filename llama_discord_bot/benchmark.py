@@ -0,0 +1,309 @@
+"""Offline load test of the bot. Simulates busy channels with a fake Discord and a fake backend, and reports
+latencies and throughput. Run it with `python -m llama_discord_bot.benchmark --help`."""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from contextvars import ContextVar
+from dataclasses import dataclass
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeMessage, FakeUser
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaBase, Message
+
+# The request whose events are being handled. Handler tasks inherit it from the task that posted the request
+_current_request: ContextVar["Request | None"] = ContextVar(
+    "current_request", default=None
+)
+
+
+@dataclass(eq=False)
+class Request:
+    """A message or button click, and when each stage of handling it happened."""
+
+    kind: str
+    channel_id: int
+    arrival: float
+    started: float | None = None
+    first_token: float | None = None
+    finished: float | None = None
+    done: float | None = None
+    rejected: bool = False
+
+    @property
+    def outcome(self) -> str:
+        if self.finished is not None:
+            return "completed"
+        if self.rejected:
+            return "rejected"
+        # Cancelled by a newer request of the same channel, either while waiting or while generating
+        return "superseded"
+
+
+def _on_backend_event(event: str) -> None:
+    request = _current_request.get()
+    if request is None:
+        return
+    now = time.monotonic()
+    if event == "start":
+        request.started = now
+    elif event == "token" and request.first_token is None:
+        request.first_token = now
+    elif event == "finish":
+        request.finished = now
+
+
+def on_bot_message(message: FakeMessage) -> None:
+    """Mark the current request as rejected if the bot replied with an error."""
+
+    request = _current_request.get()
+    if request is not None and message.embed is not None:
+        # Errors, like the 'busy' reply, are sent as embeds
+        request.rejected = True
+
+
+def track(request: Request) -> None:
+    """Make `request` the current one, so the events of the tasks posted from now on are attributed to it."""
+
+    _current_request.set(request)
+
+
+class TimedLlama(LlamaBase):
+    """Wraps any backend to record when the generations of the current request start, stream and finish,
+    like `FakeLlama` does with `on_event`."""
+
+    def __init__(self, llama: LlamaBase):
+        super().__init__(llama.system_prompt)
+        # pylint: disable=invalid-name
+        self.MAX_CONCURRENCY = llama.MAX_CONCURRENCY
+        self.CONTEXT_WINDOW = llama.CONTEXT_WINDOW
+        self.llama = llama
+        self.tokens = 0
+
+    @property
+    def name(self) -> str:
+        return self.llama.name
+
+    def count_tokens(self, text: str) -> int:
+        return self.llama.count_tokens(text)
+
+    def resolve_config(
+        self, config: GenerationConfig | None = None
+    ) -> GenerationConfig:
+        return self.llama.resolve_config(config)
+
+    def select_context(
+        self, messages: list[Message], suffix: str = "", max_tokens: int | None = None
+    ) -> list[Message]:
+        return self.llama.select_context(messages, suffix, max_tokens)
+
+    async def generate_response(
+        self, messages: list[Message], suffix: str = "", **kwargs
+    ) -> str:
+        chunks = self.stream_response(messages, suffix, **kwargs)
+        return "".join([chunk async for chunk in chunks])
+
+    async def stream_response(
+        self, messages: list[Message], suffix: str = "", **kwargs
+    ) -> AsyncIterator[str]:
+        _on_backend_event("start")
+        async with aclosing(
+            self.llama.stream_response(messages, suffix, **kwargs)
+        ) as chunks:
+            async for chunk in chunks:
+                self.tokens += 1
+                _on_backend_event("token")
+                yield chunk
+        _on_backend_event("finish")
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of a list of values, or 0 if it is empty."""
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def _latencies(values: list[float]) -> dict[str, float]:
+    return {
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values, default=0.0),
+    }
+
+
+def summarize(
+    requests: list[Request], elapsed: float, tokens: int
+) -> dict[str, object]:
+    """Aggregate the requests of a run into latency percentiles, throughput and outcome counts."""
+
+    completed = [request for request in requests if request.outcome == "completed"]
+    outcomes = {}
+    for request in requests:
+        outcomes[request.outcome] = outcomes.get(request.outcome, 0) + 1
+    return {
+        "requests": len(requests),
+        "outcomes": outcomes,
+        "elapsed_seconds": elapsed,
+        "throughput_responses_per_second": len(completed) / elapsed,
+        "throughput_tokens_per_second": tokens / elapsed,
+        "end_to_end_seconds": _latencies(
+            [request.done - request.arrival for request in completed]
+        ),
+        "first_token_seconds": _latencies(
+            [request.first_token - request.arrival for request in completed]
+        ),
+        "queue_wait_seconds": _latencies(
+            [
+                request.started - request.arrival
+                for request in requests
+                if request.started is not None
+            ]
+        ),
+    }
+
+
+async def run_benchmark(
+    channels: int = 4,
+    guilds: int = 1,
+    rate: float = 0.5,
+    duration: float = 10.0,
+    response_tokens: int = 64,
+    token_latency: float = 0.01,
+    first_token_latency: float = 0.0,
+    concurrency: int = 1,
+    queue_size: int = 32,
+    rewrite_probability: float = 0.0,
+    seed: int = 0,
+) -> dict[str, object]:
+    """Post messages to `channels` channels for `duration` seconds, each channel receiving `rate` messages per
+    second on average (with exponential inter-arrival times), and wait for the bot to handle all of them.
+    With `rewrite_probability`, arrivals click 'Rewrite response' on the latest response instead.
+    """
+
+    rng = random.Random(seed)
+    llama = FakeLlama(
+        DiscordBot.SYSTEM_PROMPT,
+        response_tokens=response_tokens,
+        token_latency=token_latency,
+        first_token_latency=first_token_latency,
+        max_concurrency=concurrency,
+        on_event=_on_backend_event,
+    )
+    bot = DiscordBot(
+        local=False,
+        discord_api_token=None,
+        llama=llama,
+        inference_queue_size=queue_size,
+    )
+    fake_discord = FakeDiscord(
+        bot, channels=channels, guilds=guilds, on_bot_message=on_bot_message
+    )
+    requests: list[Request] = []
+
+    async def handle(request: Request, task: asyncio.Task) -> None:
+        await asyncio.gather(task, return_exceptions=True)
+        request.done = time.monotonic()
+
+    async def simulate_channel(channel, user, end):
+        handlers = []
+        count = 0
+        while True:
+            delay = rng.expovariate(rate)
+            if time.monotonic() + delay >= end:
+                break
+            await asyncio.sleep(delay)
+            responses = [
+                message
+                for message in channel.messages
+                if message.view is not None and message.author is fake_discord.bot_user
+            ]
+            rewrite = responses and rng.random() < rewrite_probability
+            request = Request(
+                "rewrite" if rewrite else "message", channel.id, time.monotonic()
+            )
+            requests.append(request)
+            track(request)
+            if rewrite:
+                task = fake_discord.click(responses[-1], "rewrite_response", user)
+            else:
+                count += 1
+                task = fake_discord.send_message(
+                    channel, user, f"Message {count} from {user.name}"
+                )
+            handlers.append(asyncio.create_task(handle(request, task)))
+        await asyncio.gather(*handlers)
+
+    start = time.monotonic()
+    await asyncio.gather(
+        *[
+            simulate_channel(
+                channel,
+                FakeUser(1_000_000 + channel.id, f"user{channel.id}"),
+                start + duration,
+            )
+            for channel in fake_discord.channels
+        ]
+    )
+    await fake_discord.drain()
+    elapsed = time.monotonic() - start
+
+    report = summarize(requests, elapsed, llama.tokens)
+    report["scheduler"] = bot.scheduler.stats()
+    report["generations"] = bot.generations.stats()
+    return report
+
+
+def format_report(report: dict[str, object]) -> str:
+    """Render the main numbers of a report as text."""
+    lines = [
+        f"Requests: {report['requests']} {report['outcomes']}",
+        f"Elapsed: {report['elapsed_seconds']:.2f}s",
+        f"Throughput: {report['throughput_responses_per_second']:.2f} responses/s, "
+        f"{report['throughput_tokens_per_second']:.1f} tokens/s",
+    ]
+    for key in ["end_to_end_seconds", "first_token_seconds", "queue_wait_seconds"]:
+        latencies = report[key]
+        lines.append(
+            f"{key}: "
+            + ", ".join(f"{name}={value:.3f}" for name, value in latencies.items())
+        )
+    return "\n".join(lines)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--guilds", type=int, default=1)
+    parser.add_argument(
+        "--rate", type=float, default=0.5, help="Messages per second per channel"
+    )
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds")
+    parser.add_argument("--response-tokens", type=int, default=64)
+    parser.add_argument(
+        "--token-latency", type=float, default=0.01, help="Seconds per token"
+    )
+    parser.add_argument("--first-token-latency", type=float, default=0.0)
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="Concurrent generations"
+    )
+    parser.add_argument("--queue-size", type=int, default=32)
+    parser.add_argument("--rewrite-probability", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = vars(parser.parse_args(argv))
+    as_json = args.pop("json")
+
+    report = asyncio.run(run_benchmark(**args))
+    print(json.dumps(report, indent=2) if as_json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
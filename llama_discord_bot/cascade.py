@@ -0,0 +1,270 @@
+import re
+import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import ChatUser, LlamaBase, Message
+from llama_discord_bot.loader import BackendLoadingError
+from llama_discord_bot.metrics import CASCADE_ROUTES, TIER_FIRST_TOKEN_SECONDS
+from llama_discord_bot.scheduler import InferenceScheduler
+
+SMALL = "small"
+LARGE = "large"
+
+
+class PromptClassifier:
+    """Decides whether a request is easy enough for the small model of a cascade, without running a model:
+    the latest message has to be short, the conversation shallow, and it cannot ask for the kind of work
+    (explaining, coding, reasoning) that the keywords describe. Returns the tier and the reason for it.
+    """
+
+    KEYWORDS = (
+        "explain",
+        "why",
+        "how does",
+        "how do",
+        "code",
+        "function",
+        "debug",
+        "error",
+        "prove",
+        "calculate",
+        "compare",
+        "analyze",
+        "step by step",
+        "translate",
+        "summarize",
+        "write",
+    )
+
+    def __init__(
+        self,
+        max_easy_tokens: int = 48,
+        max_easy_turns: int = 8,
+        keywords: tuple[str, ...] | None = None,
+    ):
+        self.max_easy_tokens = max_easy_tokens
+        self.max_easy_turns = max_easy_turns
+        keywords = self.KEYWORDS if keywords is None else keywords
+        self._keywords = (
+            re.compile(
+                r"\b(?:" + "|".join(re.escape(keyword) for keyword in keywords) + r")",
+                re.IGNORECASE,
+            )
+            if keywords
+            else None
+        )
+
+    def classify(
+        self, messages: list[Message], count_tokens: Callable[[str], int]
+    ) -> tuple[str, str]:
+        turns = [message for message in messages if message.user != ChatUser.SYSTEM]
+        latest = next(
+            (message for message in reversed(turns) if message.user == ChatUser.HUMAN),
+            None,
+        )
+        if latest is None:
+            return SMALL, "easy"
+        if "```" in latest.content or (
+            self._keywords is not None and self._keywords.search(latest.content)
+        ):
+            return LARGE, "keyword"
+        if count_tokens(latest.content) > self.max_easy_tokens:
+            return LARGE, "length"
+        if len(turns) > self.max_easy_turns:
+            return LARGE, "depth"
+        return SMALL, "easy"
+
+
+class _Tier:
+    """A model of a cascade, and what the cascade has observed of it. Its scheduler keeps it from running
+    more generations than it supports, whatever the number of requests the cascade lets in.
+    """
+
+    def __init__(self, llama: LlamaBase, max_queue: int):
+        self.llama = llama
+        self.scheduler = InferenceScheduler(
+            max_concurrency=llama.MAX_CONCURRENCY, max_queue=max_queue
+        )
+        self.requests = 0
+        self.failures = 0
+        # Exponentially weighted moving averages of the seconds until the first chunk, and until the end
+        self.first_token_latency: float | None = None
+        self.latency: float | None = None
+
+    @property
+    def ready(self) -> bool:
+        return getattr(self.llama, "ready", True)
+
+    def observe_first_token(self, seconds: float, alpha: float) -> None:
+        self.first_token_latency = _average(self.first_token_latency, seconds, alpha)
+
+    def observe_latency(self, seconds: float, alpha: float) -> None:
+        self.latency = _average(self.latency, seconds, alpha)
+
+
+def _average(average: float | None, seconds: float, alpha: float) -> float:
+    return seconds if average is None else alpha * seconds + (1 - alpha) * average
+
+
+class LlamaCascade(LlamaBase):
+    """Sends easy requests to a small, fast model, and hard ones to a large model, as a `PromptClassifier`
+    decides. Rewrites always go to the large model, since the user did not like the response they got.
+    While the chosen model is loading, the other one answers, and if the small model fails before producing
+    any text, the large one takes over. Each model runs at most its own `MAX_CONCURRENCY` generations, and
+    the cascade as many as both: requests for a busy model go to the other one if it has a free slot, so
+    waiting work stays in the scheduler in front of the cascade, where it counts towards the load.
+    The decisions and the latencies of each tier are kept in `stats`.
+    """
+
+    def __init__(
+        self,
+        small: LlamaBase,
+        large: LlamaBase,
+        system_prompt: str = "",
+        *,
+        classifier: PromptClassifier | None = None,
+        alpha: float = 0.3,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(system_prompt)
+        # pylint: disable=invalid-name
+        self.MAX_CONCURRENCY = small.MAX_CONCURRENCY + large.MAX_CONCURRENCY
+        # Escalations can still end up waiting for the large tier
+        self.tiers = {
+            SMALL: _Tier(small, max_queue=self.MAX_CONCURRENCY),
+            LARGE: _Tier(large, max_queue=self.MAX_CONCURRENCY),
+        }
+        self.classifier = classifier or PromptClassifier()
+        self.alpha = alpha
+        self.clock = clock
+        self.CONTEXT_WINDOW = min(small.CONTEXT_WINDOW, large.CONTEXT_WINDOW)
+        self.RESPONSE_TOKENS = min(small.RESPONSE_TOKENS, large.RESPONSE_TOKENS)
+        self.routes: dict[tuple[str, str], int] = {}
+        self.escalations = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.tiers[SMALL].llama.name}>{self.tiers[LARGE].llama.name}"
+
+    def count_tokens(self, text: str) -> int:
+        # Both models use the same prompt format, and the large one decides what fits
+        return self.tiers[LARGE].llama.count_tokens(text)
+
+    def resolve_config(
+        self, config: GenerationConfig | None = None
+    ) -> GenerationConfig:
+        return self.tiers[LARGE].llama.resolve_config(config)
+
+    def route(self, messages: list[Message], rewrite: bool = False) -> tuple[str, str]:
+        """The tier a request goes to, and why."""
+
+        if rewrite:
+            tier, reason = LARGE, "rewrite"
+        else:
+            tier, reason = self.classifier.classify(messages, self.count_tokens)
+        other = LARGE if tier == SMALL else SMALL
+        if not self.tiers[tier].ready and self.tiers[other].ready:
+            tier, reason = other, "loading"
+        elif (
+            not self.tiers[tier].scheduler.available
+            and self.tiers[other].ready
+            and self.tiers[other].scheduler.available
+        ):
+            tier, reason = other, "saturated"
+        return tier, reason
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        chunks = self.stream_response(
+            messages=messages,
+            suffix=suffix,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            rewrite=rewrite,
+            config=config,
+        )
+        return "".join([chunk async for chunk in chunks])
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        name, reason = self.route(messages, rewrite)
+        while True:
+            self.routes[(name, reason)] = self.routes.get((name, reason), 0) + 1
+            CASCADE_ROUTES.inc(tier=name, reason=reason)
+            tier = self.tiers[name]
+            tier.requests += 1
+            start = self.clock()
+            started = False
+            try:
+                async with tier.scheduler.slot(
+                    channel_id=channel_id, guild_id=guild_id
+                ), aclosing(
+                    tier.llama.stream_response(
+                        messages=messages,
+                        suffix=suffix,
+                        channel_id=channel_id,
+                        guild_id=guild_id,
+                        rewrite=rewrite,
+                        config=config,
+                    )
+                ) as chunks:
+                    async for chunk in chunks:
+                        if not started:
+                            started = True
+                            seconds = self.clock() - start
+                            tier.observe_first_token(seconds, self.alpha)
+                            TIER_FIRST_TOKEN_SECONDS.observe(seconds, tier=name)
+                        yield chunk
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                if not isinstance(exception, BackendLoadingError):
+                    tier.failures += 1
+                # Text was already sent to the user, and the large model has no one to escalate to
+                if started or name == LARGE:
+                    raise
+                self.escalations += 1
+                print(
+                    f"🪜 {tier.llama.name} failed ({exception.__class__.__name__}: {exception}), escalating"
+                )
+                name, reason = LARGE, "escalation"
+            else:
+                tier.observe_latency(self.clock() - start, self.alpha)
+                return
+
+    def stats(self) -> dict[str, int | float]:
+        """Routing decisions by tier and reason, and the requests, failures and latencies of each tier."""
+
+        stats = {"escalations": self.escalations}
+        for (name, reason), count in sorted(self.routes.items()):
+            stats[f"{name}_routes_{reason}"] = count
+        for name, tier in self.tiers.items():
+            stats.update(
+                {
+                    f"{name}_requests": tier.requests,
+                    f"{name}_in_flight": tier.scheduler.running,
+                    f"{name}_waiting": tier.scheduler.queued,
+                    f"{name}_failures": tier.failures,
+                    f"{name}_first_token_seconds": tier.first_token_latency or 0.0,
+                    f"{name}_latency_seconds": tier.latency or 0.0,
+                }
+            )
+            if hasattr(tier.llama, "stats"):
+                for key, value in tier.llama.stats().items():
+                    stats[f"{name}_{key}"] = value
+        return stats
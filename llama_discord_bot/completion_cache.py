@@ -0,0 +1,172 @@
+import hashlib
+import json
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaBase, Message
+from llama_discord_bot.run_async import run_async
+
+
+class CompletionCache:
+    """Disk-backed cache of completions, keyed by a hash of everything that determines them.
+    Entries expire after `ttl` seconds, and the least recently used ones are evicted once the cache
+    grows over `size_limit` bytes. Its size is measured in the threads that access it, so `stats` does
+    not touch the disk."""
+
+    def __init__(
+        self, directory: str, size_limit: int = (256 << 20), ttl: float | None = 86400
+    ):
+        # Only imported when the cache is enabled
+        import diskcache  # pylint: disable=import-outside-toplevel
+
+        self._cache = diskcache.Cache(
+            directory, size_limit=size_limit, eviction_policy="least-recently-used"
+        )
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.entries = len(self._cache)
+        self.size_bytes = self._cache.volume()
+
+    @staticmethod
+    def key(prompt: str, backend: str, parameters: dict | None = None) -> str:
+        """Hash the rendered prompt, the backend and model, and the generation parameters."""
+
+        payload = json.dumps([backend, parameters or {}, prompt], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @run_async
+    def get(self, key: str) -> str | None:
+        """Get a cached completion, or None if there is none."""
+
+        completion = self._cache.get(key)
+        if completion is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return completion
+
+    @run_async
+    def set(self, key: str, completion: str) -> None:
+        """Cache a completion."""
+
+        self._cache.set(key, completion, expire=self.ttl)
+        self.stores += 1
+        self.entries = len(self._cache)
+        self.size_bytes = self._cache.volume()
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing how effective the cache is."""
+
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.entries,
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedLlama(LlamaBase):
+    """Wraps a backend so repeated prompts are answered from a `CompletionCache` instead of generating them again.
+    Rewrites always bypass the cache, since the user explicitly asked for a different response.
+    """
+
+    def __init__(self, llama: LlamaBase, cache: CompletionCache):
+        super().__init__(llama.system_prompt)
+        self.llama = llama
+        self.cache = cache
+
+    @property
+    def name(self) -> str:
+        return self.llama.name
+
+    def count_tokens(self, text: str) -> int:
+        return self.llama.count_tokens(text)
+
+    def resolve_config(
+        self, config: GenerationConfig | None = None
+    ) -> GenerationConfig:
+        return self.llama.resolve_config(config)
+
+    def select_context(
+        self, messages: list[Message], suffix: str = "", max_tokens: int | None = None
+    ) -> list[Message]:
+        return self.llama.select_context(messages, suffix, max_tokens)
+
+    def _key(
+        self, messages: list[Message], suffix: str, config: GenerationConfig | None
+    ) -> str:
+        # The settings the backend generates with, which can change between restarts, are part of the key
+        return self.cache.key(
+            self._generate_prompt(messages, suffix),
+            self.name,
+            self.llama.resolve_config(config).to_dict(),
+        )
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        key = None if rewrite else self._key(messages, suffix, config)
+        if key is not None:
+            completion = await self.cache.get(key)
+            if completion is not None:
+                return completion
+
+        completion = await self.llama.generate_response(
+            messages=messages,
+            suffix=suffix,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            rewrite=rewrite,
+            config=config,
+        )
+        if key is not None:
+            await self.cache.set(key, completion)
+        return completion
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        key = None if rewrite else self._key(messages, suffix, config)
+        if key is not None:
+            completion = await self.cache.get(key)
+            if completion is not None:
+                yield completion
+                return
+
+        parts = []
+        async with aclosing(
+            self.llama.stream_response(
+                messages=messages,
+                suffix=suffix,
+                channel_id=channel_id,
+                guild_id=guild_id,
+                rewrite=rewrite,
+                config=config,
+            )
+        ) as chunks:
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+
+        # Only completions that were streamed until the end are cached
+        if key is not None:
+            await self.cache.set(key, "".join(parts))
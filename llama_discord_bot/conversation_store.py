@@ -0,0 +1,330 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from llama_discord_bot.llama import ChatUser, Message
+from llama_discord_bot.run_async import run_async
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    exhausted INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (channel_id, message_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS channels_updated_at ON channels (updated_at);
+"""
+
+
+class ConversationStore:
+    """SQLite copy of the latest messages of each channel, so the history survives restarts without
+    fetching it again from Discord. Like `ChannelMessageCache`, a channel is only stored once its history
+    was seeded, and is then kept up to date with its new, edited and deleted messages.
+    Writes are queued and flushed in batches from a thread, every `flush_interval` seconds or every
+    `batch_size` writes. Each channel keeps at most `messages_per_channel` messages, and channels are
+    dropped after `max_age` seconds without messages, or when there are more than `max_channels`.
+    Messages sent while the bot is offline are not seen, so the stored history can miss them.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        messages_per_channel: int = 50,
+        max_channels: int = 10_000,
+        max_age: float = 30 * 86400,
+        flush_interval: float = 1.0,
+        batch_size: int = 256,
+        compact_interval: float = 3600,
+    ):
+        self.path = path
+        self.messages_per_channel = messages_per_channel
+        self.max_channels = max_channels
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.compact_interval = compact_interval
+        # The connection is used from the threads of `run_async`, one flush, load or compaction at a time
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # Incremental vacuum only works if it is enabled before the tables are created
+        self._connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._channels = {
+            channel_id
+            for (channel_id,) in self._connection.execute(
+                "SELECT channel_id FROM channels"
+            )
+        }
+        self._pending: list[tuple] = []
+        # Flushes run one after the other, so the writes are applied in order
+        self._flush_lock = asyncio.Lock()
+        self._flush_needed: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._last_compaction = time.monotonic()
+        self.flushes = 0
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._channels
+
+    def _queue(self, operation: tuple) -> None:
+        self._pending.append(operation)
+        if len(self._pending) >= self.batch_size and self._flush_needed is not None:
+            self._flush_needed.set()
+
+    def seed(self, channel_id: int, entries: list[tuple[int, Message]]) -> None:
+        """Store the history of a channel, as `(message_id, message)` pairs, oldest first."""
+
+        entries = entries[-self.messages_per_channel :]
+        self._channels.add(channel_id)
+        self._queue(
+            ("seed", channel_id, entries, len(entries) < self.messages_per_channel)
+        )
+
+    def append(self, channel_id: int, message_id: int, message: Message) -> None:
+        """Store a new message. Channels that are not stored are ignored, like in the message cache."""
+
+        if channel_id in self._channels:
+            self._queue(("append", channel_id, message_id, message))
+
+    def update(self, channel_id: int, message_id: int, content: str) -> None:
+        """Replace the content of a stored message after it has been edited."""
+
+        if channel_id in self._channels:
+            self._queue(("update", channel_id, message_id, content))
+
+    def remove(self, channel_id: int, message_ids: set[int]) -> None:
+        """Remove deleted messages."""
+
+        if channel_id in self._channels:
+            self._queue(("remove", channel_id, list(message_ids)))
+
+    @run_async
+    def _write(self, operations: list[tuple]) -> None:
+        now = time.time()
+        touched = set()
+        with self._lock, self._connection:
+            for operation in operations:
+                kind, channel_id = operation[0], operation[1]
+                if kind == "seed":
+                    _, _, entries, exhausted = operation
+                    self._connection.execute(
+                        "DELETE FROM messages WHERE channel_id = ?", (channel_id,)
+                    )
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO channels VALUES (?, ?, ?)",
+                        (channel_id, int(exhausted), now),
+                    )
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                        [
+                            (
+                                channel_id,
+                                message_id,
+                                message.user.value,
+                                message.content,
+                            )
+                            for message_id, message in entries
+                        ],
+                    )
+                elif kind == "append":
+                    _, _, message_id, message = operation
+                    # The channel may have been dropped by a compaction since the message was queued
+                    self._connection.execute(
+                        """INSERT OR REPLACE INTO messages SELECT ?, ?, ?, ?
+                        WHERE EXISTS (SELECT 1 FROM channels WHERE channel_id = ?)""",
+                        (
+                            channel_id,
+                            message_id,
+                            message.user.value,
+                            message.content,
+                            channel_id,
+                        ),
+                    )
+                    self._connection.execute(
+                        "UPDATE channels SET updated_at = ? WHERE channel_id = ?",
+                        (now, channel_id),
+                    )
+                    touched.add(channel_id)
+                elif kind == "update":
+                    _, _, message_id, content = operation
+                    self._connection.execute(
+                        "UPDATE messages SET content = ? WHERE channel_id = ? AND message_id = ?",
+                        (content, channel_id, message_id),
+                    )
+                elif kind == "remove":
+                    _, _, message_ids = operation
+                    self._connection.executemany(
+                        "DELETE FROM messages WHERE channel_id = ? AND message_id = ?",
+                        [(channel_id, message_id) for message_id in message_ids],
+                    )
+
+            # Only the latest messages of a channel are kept. Once older ones are dropped,
+            # a short history no longer means the channel has no more messages
+            for channel_id in touched:
+                trimmed = self._connection.execute(
+                    """DELETE FROM messages WHERE channel_id = ? AND message_id NOT IN (
+                        SELECT message_id FROM messages WHERE channel_id = ?
+                        ORDER BY message_id DESC LIMIT ?
+                    )""",
+                    (channel_id, channel_id, self.messages_per_channel),
+                ).rowcount
+                if trimmed:
+                    self._connection.execute(
+                        "UPDATE channels SET exhausted = 0 WHERE channel_id = ?",
+                        (channel_id,),
+                    )
+        self.flushes += 1
+        self.writes += len(operations)
+
+    async def flush(self) -> None:
+        """Write the queued changes."""
+
+        async with self._flush_lock:
+            if self._pending:
+                operations, self._pending = self._pending, []
+                await self._write(operations)
+
+    @run_async
+    def _read(self, channel_id: int) -> tuple[list[tuple[int, Message]], bool] | None:
+        with self._lock:
+            channel = self._connection.execute(
+                "SELECT exhausted FROM channels WHERE channel_id = ?", (channel_id,)
+            ).fetchone()
+            if channel is None:
+                return None
+            rows = self._connection.execute(
+                "SELECT message_id, user, content FROM messages WHERE channel_id = ? ORDER BY message_id",
+                (channel_id,),
+            ).fetchall()
+        entries = [
+            (message_id, Message(ChatUser(user), content))
+            for message_id, user, content in rows
+        ]
+        return entries, bool(channel[0])
+
+    async def load(self, channel_id: int) -> list[tuple[int, Message]] | None:
+        """Get the stored history of a channel, oldest first, or None if it is not stored or incomplete
+        (some of its messages were deleted, so older ones would have to be fetched)."""
+
+        if channel_id not in self._channels:
+            self.misses += 1
+            return None
+        await self.flush()
+        stored = await self._read(channel_id)
+        if stored is None or (
+            len(stored[0]) < self.messages_per_channel and not stored[1]
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return stored[0]
+
+    @run_async
+    def recent_channels(self, limit: int) -> list[int]:
+        """The channels with the most recent messages, most recent first."""
+
+        with self._lock:
+            return [
+                channel_id
+                for (channel_id,) in self._connection.execute(
+                    "SELECT channel_id FROM channels ORDER BY updated_at DESC LIMIT ?",
+                    (limit,),
+                )
+            ]
+
+    @run_async
+    def compact(self) -> int:
+        """Drop the channels that are too old or too many, and give the free pages back to the file system.
+        Returns how many channels were dropped."""
+
+        with self._lock:
+            with self._connection:
+                dropped = [
+                    channel_id
+                    for (channel_id,) in self._connection.execute(
+                        """SELECT channel_id FROM channels WHERE updated_at < ? OR channel_id NOT IN (
+                            SELECT channel_id FROM channels ORDER BY updated_at DESC LIMIT ?
+                        )""",
+                        (time.time() - self.max_age, self.max_channels),
+                    )
+                ]
+                self._connection.executemany(
+                    "DELETE FROM messages WHERE channel_id = ?",
+                    [(channel_id,) for channel_id in dropped],
+                )
+                self._connection.executemany(
+                    "DELETE FROM channels WHERE channel_id = ?",
+                    [(channel_id,) for channel_id in dropped],
+                )
+            self._connection.execute("PRAGMA incremental_vacuum").fetchall()
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._channels.difference_update(dropped)
+        self.compactions += 1
+        return len(dropped)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._flush_needed.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_compaction >= self.compact_interval:
+                    self._last_compaction = time.monotonic()
+                    await self.compact()
+            except sqlite3.Error as exception:
+                print(
+                    f"Failed to write the conversation store: {exception.__class__.__name__}: {exception}"
+                )
+
+    async def start(self) -> None:
+        """Compact the store and start flushing writes in the background."""
+
+        dropped = await self.compact()
+        self._last_compaction = time.monotonic()
+        if dropped:
+            print(f"🗄️  Dropped {dropped} old channels from the conversation store")
+        self._flush_needed = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        """Flush the queued writes and close the database."""
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        with self._lock:
+            self._connection.close()
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing the store and how often it served a history."""
+
+        lookups = self.hits + self.misses
+        return {
+            "channels": len(self._channels),
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "writes": self.writes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "compactions": self.compactions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,6 +1,35 @@
+import contextlib
+import math
+import time
 import discord
 from llama_discord_bot.view import BotResponseView
-from llama_discord_bot.llama import Message, LlamaLocal, LlamaReplicate, ChatUser
+from llama_discord_bot.admission import ALL, AdmissionFilter, MessageDebouncer
+from llama_discord_bot.llama import Message, LlamaBase, ChatUser
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.backends import BackendBuilder
+from llama_discord_bot.message_cache import ChannelMessageCache
+from llama_discord_bot.conversation_store import ConversationStore
+from llama_discord_bot.streaming import stream_to_message
+from llama_discord_bot.outbound import OutboundScheduler
+from llama_discord_bot.quotas import QuotaExceededError, QuotaLimit, RequestQuotas
+from llama_discord_bot.traces import CONTINUE, REWRITE, TraceRecorder
+from llama_discord_bot.scheduler import ScheduledLlama, SchedulerBusyError
+from llama_discord_bot.completion_cache import CachedLlama, CompletionCache
+from llama_discord_bot.loader import BackendLoadingError, BackgroundLoadedLlama
+from llama_discord_bot.router import LlamaRouter
+from llama_discord_bot.summarizer import ConversationSummarizer
+from llama_discord_bot.speculation import ContinuationSpeculator
+from llama_discord_bot.generations import GenerationTracker
+from llama_discord_bot.instrumentation import InstrumentedLlama
+from llama_discord_bot.metrics import (
+    ERRORS,
+    EVENTS,
+    RESPONSE_TOKEN_CAPS,
+    STAGE_SECONDS,
+    MetricsServer,
+    metrics,
+)
+from llama_discord_bot.profiler import SlowRequestProfiler
 
 
 class DiscordBot(discord.Client):
@@ -11,116 +40,769 @@ class DiscordBot(discord.Client):
         """This is a conversation you were having. Please continue your response."""
     )
     MESSAGES_AFTER_THIS_ONE = """There has already been messages after this one. You cannot continue the response."""
+    BUSY = (
+        """I'm receiving too many messages right now. Please try again in a moment."""
+    )
+    WARMING_UP = """I'm still waking up. Please try again in a moment."""
+    OVER_QUOTA = (
+        """You're sending requests too fast. Please try again in {seconds} seconds."""
+    )
+    # Minimum number of seconds between two edits of a response that is being streamed
+    STREAM_EDIT_INTERVAL = 1.0
 
     def __init__(
-        self, local, discord_api_token, *, replicate_model=None, local_model_path=None
+        self,
+        local,
+        discord_api_token,
+        *,
+        replicate_model=None,
+        local_model_path=None,
+        local_state_cache_dir=None,
+        local_workers=1,
+        local_use_mmap=True,
+        local_use_mlock=False,
+        local_warmup_prompt=None,
+        wait_for_model=False,
+        tokenizer_model_path=None,
+        inference_servers=None,
+        inference_server_concurrency=None,
+        small_local_model_path=None,
+        small_replicate_model=None,
+        cascade_max_easy_tokens=48,
+        cascade_max_easy_turns=8,
+        cascade_keywords=None,
+        context_tokens=None,
+        history_cache_channels=256,
+        history_cache_size=50,
+        conversation_store_path=None,
+        conversation_store_max_age=30 * 86400,
+        summary_keep_messages=None,
+        speculation_token_budget=None,
+        user_quota: QuotaLimit | None = None,
+        guild_quota: QuotaLimit | None = None,
+        channel_quota: QuotaLimit | None = None,
+        inference_concurrency=None,
+        inference_queue_size=32,
+        generation_config: GenerationConfig | None = None,
+        guild_generation_configs: dict[int, GenerationConfig] | None = None,
+        min_response_tokens=None,
+        completion_cache_dir=None,
+        completion_cache_size=256 << 20,
+        completion_cache_ttl=86400,
+        llama: LlamaBase | None = None,
+        metrics_host="127.0.0.1",
+        metrics_port=None,
+        profile_threshold=None,
+        profile_dir=None,
+        trace_path=None,
+        trace_salt: bytes | None = None,
+        respond_to=frozenset({ALL}),
+        respond_channels=frozenset(),
+        debounce_seconds=0.0,
+        **client_options,
     ):
+        created = time.monotonic()
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(intents=intents)
-
-        if local:
-            print("🖥️  Running model locally")
-            assert (
-                local_model_path is not None
-            ), "local_model_path must be specified when running locally"
-            self.llama = LlamaLocal(
-                model_path=local_model_path, system_prompt=self.SYSTEM_PROMPT
+        # Other options are passed to the Discord client, like the shards of a `ShardedDiscordBot`
+        super().__init__(intents=intents, **client_options)
+
+        self.backends = BackendBuilder(self.SYSTEM_PROMPT, generation_config)
+        if llama is None:
+            llama = self.backends.build(
+                local,
+                replicate_model=replicate_model,
+                local_model_path=local_model_path,
+                local_state_cache_dir=local_state_cache_dir,
+                local_workers=local_workers,
+                local_use_mmap=local_use_mmap,
+                local_use_mlock=local_use_mlock,
+                local_warmup_prompt=local_warmup_prompt,
+                wait_for_model=wait_for_model,
+                tokenizer_model_path=tokenizer_model_path,
+                inference_servers=inference_servers,
+                inference_server_concurrency=inference_server_concurrency,
+                small_local_model_path=small_local_model_path,
+                small_replicate_model=small_replicate_model,
+                cascade_max_easy_tokens=cascade_max_easy_tokens,
+                cascade_max_easy_turns=cascade_max_easy_turns,
+                cascade_keywords=cascade_keywords,
             )
-        else:
-            print("☁️  Running model through replicate")
-            assert (
-                replicate_model is not None
-            ), "replicate_model must be specified when running through replicate"
-            self.llama = LlamaReplicate(
-                replicate_model=replicate_model, system_prompt=self.SYSTEM_PROMPT
+        # Otherwise a backend was given, like the fake one used by the benchmarks
+        self.replicate_client = self.backends.replicate_client
+        self.backend = llama
+        self.loaders = self.backends.loaders(llama)
+        if hasattr(llama, "stats"):
+            metrics.register_collector("backend", llama.stats)
+        metrics.register_collector("prompt_builder", self._prompt_builder_stats)
+        # Generations are queued, so the backend is never given more work than it can handle
+        self.llama = ScheduledLlama(
+            InstrumentedLlama(llama),
+            max_concurrency=inference_concurrency,
+            max_queue=inference_queue_size,
+        )
+        self.scheduler = self.llama.scheduler
+        metrics.register_collector("scheduler", self.scheduler.stats)
+        # Generation settings of each guild, over the ones of the backend
+        self.guild_generation_configs = guild_generation_configs or {}
+        # Under load, responses are shortened down to this many tokens, so the queue drains faster
+        self.min_response_tokens = min_response_tokens
+        if completion_cache_dir:
+            # Cached completions are served without waiting in the queue
+            completion_cache = CompletionCache(
+                completion_cache_dir,
+                size_limit=completion_cache_size,
+                ttl=completion_cache_ttl,
+            )
+            self.llama = CachedLlama(self.llama, completion_cache)
+            metrics.register_collector("completion_cache", completion_cache.stats)
+        if self.replicate_client is not None:
+            metrics.register_collector("replicate", self.replicate_client.stats)
+        self.message_cache = ChannelMessageCache(
+            max_channels=history_cache_channels,
+            messages_per_channel=history_cache_size,
+        )
+        metrics.register_collector("message_cache", self.message_cache.stats)
+        # The history also survives restarts if it is stored on disk
+        self.conversation_store = (
+            ConversationStore(
+                conversation_store_path,
+                messages_per_channel=history_cache_size,
+                max_age=conversation_store_max_age,
+            )
+            if conversation_store_path
+            else None
+        )
+        # Both keep the latest messages of channels, and are updated the same way
+        self.histories = [self.message_cache]
+        if self.conversation_store is not None:
+            self.histories.append(self.conversation_store)
+            metrics.register_collector(
+                "conversation_store", self.conversation_store.stats
             )
+        self.context_tokens = context_tokens
+        # Older messages can be replaced by a summary, refreshed while the backend is idle
+        self.summarizer = (
+            ConversationSummarizer(
+                self.llama,
+                self.scheduler,
+                keep_messages=summary_keep_messages,
+                context_window=self.backend.CONTEXT_WINDOW,
+            )
+            if summary_keep_messages
+            else None
+        )
+        if self.summarizer is not None:
+            metrics.register_collector("summarizer", self.summarizer.stats)
+        # Continuations can be generated ahead of time while the backend is idle, within a budget of tokens a minute
+        self.speculator = (
+            ContinuationSpeculator(
+                self.llama,
+                self.scheduler,
+                self.CONTINUE_RESPONSE_SUFFIX,
+                token_budget=speculation_token_budget,
+            )
+            if speculation_token_budget
+            else None
+        )
+        if self.speculator is not None:
+            metrics.register_collector("speculation", self.speculator.stats)
+        # Only the messages addressed to the bot are answered, and bursts of them only once
+        self.admission = AdmissionFilter(respond_to, respond_channels)
+        metrics.register_collector("admission", self.admission.stats)
+        self.debouncer = (
+            MessageDebouncer(debounce_seconds) if debounce_seconds > 0 else None
+        )
+        if self.debouncer is not None:
+            metrics.register_collector("debounce", self.debouncer.stats)
+        # Users, guilds and channels can only take their share of the backend
+        self.quotas = (
+            RequestQuotas(user=user_quota, guild=guild_quota, channel=channel_quota)
+            if user_quota or guild_quota or channel_quota
+            else None
+        )
+        if self.quotas is not None:
+            metrics.register_collector("quotas", self.quotas.stats)
+        # Edits of the bot's messages are merged and kept within the rate limits
+        self.outbound = OutboundScheduler()
+        metrics.register_collector("outbound", self.outbound.stats)
+        # A new generation in a channel cancels the one running there
+        self.generations = GenerationTracker()
+        metrics.register_collector("generations", self.generations.stats)
+        self.metrics_server = (
+            MetricsServer(metrics, host=metrics_host, port=metrics_port)
+            if metrics_port is not None
+            else None
+        )
+        self.profiler = (
+            SlowRequestProfiler(profile_threshold, output_dir=profile_dir)
+            if profile_threshold is not None
+            else None
+        )
+        if self.profiler is not None:
+            metrics.register_collector("profiler", self.profiler.stats)
+        # Anonymized traces of the events, to replay them with `python -m llama_discord_bot.replay`
+        self.tracer = TraceRecorder(trace_path, salt=trace_salt) if trace_path else None
+        if self.tracer is not None:
+            metrics.register_collector("traces", self.tracer.stats)
         self.discord_api_token = discord_api_token
-        self.run(discord_api_token)
-
-    async def _get_channel_messages(self, channel, limit=5, skip=0) -> list[Message]:
-        """Get the last `limit` messages from a channel, skipping `skip` messages."""
-
-        messages: list[Message] = []
-        async for message in channel.history():
-            if skip > 0:
-                skip -= 1
-                continue
-            if len(messages) >= limit:
-                break
-            content = message.content
-            if message.author == self.user:
-                messages.append(Message(user=ChatUser.AI, content=content))
-            else:
-                messages.append(Message(user=ChatUser.HUMAN, content=content))
-        return list(reversed(messages))
+        # Seconds since the bot was created at which each startup phase finished
+        self._created = created
+        self.startup_timings = {"init_seconds": time.monotonic() - created}
+        metrics.register_collector("startup", lambda: self.startup_timings)
+
+    def _prompt_builder_stats(self) -> dict[str, int | float]:
+        """Stats of the prompt builder of the (first) backend, which is only known once it has loaded."""
+
+        llama = self.backend
+        if isinstance(llama, LlamaRouter):
+            llama = llama.replicas[0].llama
+        if isinstance(llama, BackgroundLoadedLlama):
+            llama = llama.llama or llama
+        return llama.prompt_builder.stats()
+
+    def _to_chat_message(self, message: discord.Message) -> Message:
+        """Convert a Discord message to a chat message, attributing it to the AI if the bot sent it."""
+
+        if message.author == self.user:
+            return Message(user=ChatUser.AI, content=message.content)
+        return Message(user=ChatUser.HUMAN, content=message.content)
+
+    async def _get_channel_messages(
+        self, channel, limit=None, skip=0, suffix=""
+    ) -> list[Message]:
+        """Get the latest messages from a channel that fit in the context of the model, skipping `skip`
+        messages and considering at most `limit` (by default, as many as the message cache holds).
+        Messages are served from the message cache, then from the conversation store, and the channel history
+        is only fetched on a cold miss."""
+
+        if limit is None:
+            limit = max(self.message_cache.messages_per_channel - skip, 1)
+        count = limit + skip
+        messages = self.message_cache.get(channel.id, count)
+        if (
+            messages is None
+            and self.conversation_store is not None
+            and count <= self.message_cache.messages_per_channel
+        ):
+            entries = await self.conversation_store.load(channel.id)
+            if entries is not None:
+                self.message_cache.seed(channel.id, entries)
+                messages = [message for _, message in entries[-count:]]
+        if messages is None:
+            history_limit = max(count, self.message_cache.messages_per_channel)
+            entries = [
+                (message.id, self._to_chat_message(message))
+                async for message in channel.history(limit=history_limit)
+            ]
+            entries.reverse()
+            if count <= self.message_cache.messages_per_channel:
+                for history in self.histories:
+                    history.seed(channel.id, entries)
+            messages = [message for _, message in entries[-count:]]
+
+        if skip:
+            messages = messages[: max(len(messages) - skip, 0)]
+        if self.summarizer is not None and messages:
+            messages = self.summarizer.apply(channel.id, messages)
+        return self.llama.select_context(
+            messages, suffix=suffix, max_tokens=self.context_tokens
+        )
+
+    def _generation_config(self, guild_id: int | None) -> GenerationConfig | None:
+        """The generation settings of a request: the ones of its guild, with a length limit that shrinks
+        linearly from the configured one (of the guild or the backend) to `min_response_tokens` as the
+        inference queue fills up.
+        """
+
+        config = self.guild_generation_configs.get(guild_id)
+        load = self.scheduler.load
+        if self.min_response_tokens is None or load == 0:
+            return config
+        max_tokens = (
+            self.backend.resolve_config(config).max_tokens
+            or self.backend.RESPONSE_TOKENS
+        )
+        cap = round(max_tokens - (max_tokens - self.min_response_tokens) * load)
+        # Limits already below `min_response_tokens` are left as they are
+        if cap >= max_tokens:
+            return config
+        RESPONSE_TOKEN_CAPS.observe(cap)
+        return (config or GenerationConfig()).merge(GenerationConfig(max_tokens=cap))
+
+    def _record_response(self, response: discord.Message, content: str) -> None:
+        """Put the final content of a response in the history, before the events of its edits arrive.
+        Like Discord does, the content is trimmed."""
+
+        for history in self.histories:
+            history.update(response.channel.id, response.id, content.strip())
+
+    async def _speculate_after(
+        self, response: discord.Message, guild_id: int | None, content: str
+    ) -> None:
+        """Start generating the continuation of a response that was just sent, if the backend is idle."""
+
+        if not self.speculator.can_start():
+            return
+        messages = await self._get_channel_messages(
+            channel=response.channel, suffix=self.CONTINUE_RESPONSE_SUFFIX
+        )
+        self.speculator.start(
+            response.id,
+            messages,
+            response.channel.id,
+            guild_id,
+            config=self._generation_config(guild_id),
+        )
+
+    async def _admit_interaction(
+        self, interaction: discord.Interaction, handler: str, guild_id: int | None
+    ) -> bool:
+        """Check the quotas of a click, telling the user if it is rejected. Returns whether it is admitted."""
+
+        if self.quotas is None:
+            return True
+        try:
+            self.quotas.admit(interaction.user.id, guild_id, interaction.channel.id)
+        except QuotaExceededError as exception:
+            EVENTS.inc(handler=handler, outcome="over_quota")
+            await interaction.followup.send(
+                embed=self._over_quota_embed(exception), ephemeral=True
+            )
+            return False
+        return True
+
+    async def _click_failed(
+        self, interaction: discord.Interaction, handler: str, exception: Exception
+    ) -> None:
+        """Report an error of a click like `on_message` does, so the buttons of the response are reset."""
+
+        if isinstance(exception, SchedulerBusyError):
+            EVENTS.inc(handler=handler, outcome="busy")
+            await interaction.followup.send(
+                embed=self._error_embed(self.BUSY), ephemeral=True
+            )
+        elif isinstance(exception, BackendLoadingError):
+            EVENTS.inc(handler=handler, outcome="warming_up")
+            await interaction.followup.send(
+                embed=self._error_embed(self.WARMING_UP), ephemeral=True
+            )
+        else:
+            EVENTS.inc(handler=handler, outcome="error")
+            ERRORS.inc(handler=handler, type=exception.__class__.__name__)
+            print(f"An error occurred: {exception.__class__.__name__}: {exception}")
+
+    def _charge(
+        self, user_id: int, guild_id: int | None, channel_id: int, content: str
+    ) -> None:
+        """Charge the tokens of a response to the quotas of the request."""
+
+        if self.quotas is not None:
+            self.quotas.charge(
+                user_id, guild_id, channel_id, self.llama.count_tokens(content)
+            )
+
+    def _over_quota_embed(self, exception: QuotaExceededError) -> discord.Embed:
+        return self._error_embed(
+            self.OVER_QUOTA.format(seconds=max(math.ceil(exception.retry_after), 1))
+        )
+
+    def _error_embed(self, description: str) -> discord.Embed:
+        """Build the embed used to report errors to users."""
+
+        return discord.Embed(
+            title="Error", description=description, color=discord.Color.red()
+        )
+
+    def _profile(self, handler: str):
+        """Profile a handler, if slow requests are being profiled."""
+
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.profile(handler)
+
+    def _record_startup(self, phase: str) -> None:
+        if phase not in self.startup_timings:
+            self.startup_timings[phase] = time.monotonic() - self._created
+
+    def _on_model_loaded(self, task) -> None:
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            exception = task.exception()
+            print(
+                f"Failed to load the model: {exception.__class__.__name__}: {exception}"
+            )
+            return
+        # The bot can answer as soon as the first model is ready
+        if "model_ready_seconds" not in self.startup_timings:
+            self._record_startup("model_ready_seconds")
+            print(
+                f"⏱️  Model ready {self.startup_timings['model_ready_seconds']:.2f}s after startup"
+            )
+
+    async def _restore_history(self) -> None:
+        """Fill the message cache with the most recently active channels of the conversation store."""
+
+        restored = 0
+        for channel_id in await self.conversation_store.recent_channels(
+            self.message_cache.max_channels
+        ):
+            entries = await self.conversation_store.load(channel_id)
+            if entries is not None:
+                self.message_cache.seed(channel_id, entries)
+                restored += 1
+        print(f"🗄️  Restored the history of {restored} channels")
+
+    async def setup_hook(self):
+        """Called before the bot connects to Discord. Starts loading the model and the metrics endpoint,
+        and restores the history of the conversation store."""
+
+        self._record_startup("setup_hook_seconds")
+        for loader in self.loaders:
+            loader.start().add_done_callback(self._on_model_loaded)
+        if self.conversation_store is not None:
+            await self.conversation_store.start()
+            await self._restore_history()
+            self._record_startup("history_restored_seconds")
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+            print(
+                f"📈 Serving metrics at http://{self.metrics_server.host}:{self.metrics_server.port}/metrics"
+            )
 
     async def on_ready(self):
         """Called when the bot is ready to receive events."""
 
         print(f"Bot initialized as {self.user}")
+        if "gateway_ready_seconds" not in self.startup_timings:
+            self._record_startup("gateway_ready_seconds")
+            print(
+                "⏱️  Startup: "
+                + ", ".join(
+                    f"{phase.removesuffix('_seconds')} {seconds:.2f}s"
+                    for phase, seconds in self.startup_timings.items()
+                )
+            )
+
+    async def close(self):
+        """Called when the bot shuts down. Also closes the connections to the backends and the metrics endpoint,
+        and writes what is left to the conversation store."""
+
+        await super().close()
+        await self.backends.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        if self.summarizer is not None:
+            await self.summarizer.close()
+        if self.speculator is not None:
+            await self.speculator.close()
+        if self.conversation_store is not None:
+            await self.conversation_store.close()
+        if self.tracer is not None:
+            self.tracer.close()
+
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        """Called when a message is edited. Keeps the message history up to date."""
+
+        if "content" in payload.data:
+            for history in self.histories:
+                history.update(
+                    payload.channel_id, payload.message_id, payload.data["content"]
+                )
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        """Called when a message is deleted. Keeps the message history up to date."""
+
+        for history in self.histories:
+            history.remove(payload.channel_id, {payload.message_id})
+
+    async def on_raw_bulk_message_delete(
+        self, payload: discord.RawBulkMessageDeleteEvent
+    ):
+        """Called when messages are deleted in bulk. Keeps the message history up to date."""
+
+        for history in self.histories:
+            history.remove(payload.channel_id, payload.message_ids)
 
     async def on_message(self, message: discord.Message):
         """Called when a message is sent to any channel the bot can see."""
 
         try:
+            # Every message, including our own responses, is part of the conversation history
+            for history in self.histories:
+                history.append(
+                    message.channel.id, message.id, self._to_chat_message(message)
+                )
             # Ignore messages from self
             if message.author == self.user:
                 return
 
-            response: discord.Message = None
+            # Continuations generated ahead of time are out of date once someone else replies
+            if self.speculator is not None:
+                self.speculator.invalidate(message.channel.id)
+
+            if not self.admission.admit(message, self.user):
+                EVENTS.inc(handler="on_message", outcome="dropped")
+                return
+            guild_id = message.guild.id if message.guild else None
+            if self.tracer is not None:
+                self.tracer.message(
+                    message.channel.id,
+                    guild_id,
+                    message.author.id,
+                    message.id,
+                    len(message.content),
+                )
+            # A burst of messages is answered once, by its last message
+            if self.debouncer is not None and not await self.debouncer.settle(
+                message.channel.id, message.id
+            ):
+                EVENTS.inc(handler="on_message", outcome="coalesced")
+                return
+            # Requests over quota are rejected before doing any work
+            if self.quotas is not None:
+                self.quotas.admit(message.author.id, guild_id, message.channel.id)
+
+            # Content of the latest response, which can be rewritten
+            response_content = ""
 
             async def on_continue_response(interaction: discord.Interaction):
                 """Called when the user clicks the 'Continue response' button. It will send a new response continuing the old one"""
 
-                # Since the text generation will probably take longer than 3 seconds, we need to defer
-                # the interaction response. If we don't, it'll fail
-                await interaction.response.defer()
-                messages = await self._get_channel_messages(channel=message.channel)
-
-                # If the last message is not the same as the current message, do not continue response.
-                # This might be the case if the user already sent a message after this one
-                if messages[-1].content != response.content:
-                    await interaction.followup.send(
-                        embed=discord.Embed(
-                            title="Error",
-                            description=self.MESSAGES_AFTER_THIS_ONE,
-                            color=discord.Color.red(),
-                        ),
-                        ephemeral=True,
+                handler = "on_continue_response"
+                if self.tracer is not None:
+                    self.tracer.click(
+                        CONTINUE,
+                        message.channel.id,
+                        guild_id,
+                        interaction.user.id,
+                        message.id,
                     )
+
+                # Since the text generation will probably take longer than 3 seconds, we need to defer
+                # the interaction response, unless the view already acknowledged it. If we don't, it'll fail
+                if not interaction.response.is_done():
+                    await interaction.response.defer()
+                if not await self._admit_interaction(interaction, handler, guild_id):
                     return
+                try:
+                    async with self.generations.generation(message.channel.id):
+                        with self._profile(handler):
+                            with STAGE_SECONDS.time(handler=handler, stage="history"):
+                                messages = await self._get_channel_messages(
+                                    channel=message.channel,
+                                    suffix=self.CONTINUE_RESPONSE_SUFFIX,
+                                )
 
-                llama_response = await self.llama.generate_response(
-                    messages=messages, suffix=self.CONTINUE_RESPONSE_SUFFIX
-                )
-                await interaction.followup.send(content=llama_response)
+                            # If the last message is not the same as the current message, do not continue response.
+                            # This might be the case if the user already sent a message after this one.
+                            # Discord trims the content of messages, so both are compared trimmed
+                            if (
+                                not messages
+                                or messages[-1].content.strip()
+                                != response_content.strip()
+                            ):
+                                EVENTS.inc(handler=handler, outcome="stale")
+                                await interaction.followup.send(
+                                    embed=self._error_embed(
+                                        self.MESSAGES_AFTER_THIS_ONE
+                                    ),
+                                    ephemeral=True,
+                                )
+                                return
+
+                            async def send(content):
+                                with STAGE_SECONDS.time(handler=handler, stage="send"):
+                                    return await interaction.followup.send(
+                                        content=content, wait=True
+                                    )
+
+                            async def edit(followup, content):
+                                return await self.outbound.edit(
+                                    followup, content=content, wait=False
+                                )
+
+                            # The continuation may already be generated (or being generated) in the background
+                            chunks = (
+                                self.speculator.take(interaction.message.id, messages)
+                                if self.speculator is not None
+                                else None
+                            )
+                            outcome = "ok" if chunks is None else "speculated"
+                            if chunks is None:
+                                chunks = self.llama.stream_response(
+                                    messages=messages,
+                                    suffix=self.CONTINUE_RESPONSE_SUFFIX,
+                                    channel_id=message.channel.id,
+                                    guild_id=guild_id,
+                                    config=self._generation_config(guild_id),
+                                )
+
+                            with STAGE_SECONDS.time(handler=handler, stage="response"):
+                                followup, content = await stream_to_message(
+                                    chunks,
+                                    send=send,
+                                    edit=edit,
+                                    min_edit_interval=self.STREAM_EDIT_INTERVAL,
+                                )
+                            with STAGE_SECONDS.time(handler=handler, stage="edit"):
+                                await self.outbound.flush(followup)
+                            self._record_response(followup, content)
+                            self._charge(
+                                interaction.user.id,
+                                guild_id,
+                                message.channel.id,
+                                content,
+                            )
+                            EVENTS.inc(handler=handler, outcome=outcome)
+                except Exception as exception:  # pylint: disable=broad-exception-caught
+                    await self._click_failed(interaction, handler, exception)
 
             async def on_rewrite_response(interaction: discord.Interaction):
                 """Called when the user clicks the 'Rewrite response' button. It will rewrite the response and edit the original message"""
 
-                nonlocal response
+                nonlocal response_content
+                handler = "on_rewrite_response"
+                if self.tracer is not None:
+                    self.tracer.click(
+                        REWRITE,
+                        message.channel.id,
+                        guild_id,
+                        interaction.user.id,
+                        message.id,
+                    )
 
                 # Since the text generation will probably take longer than 3 seconds, we need to defer
-                # the interaction response. If we don't, it'll fail
-                await interaction.response.defer()
-                messages = await self._get_channel_messages(
-                    channel=message.channel, skip=1
-                )
-                llama_response = await self.llama.generate_response(messages=messages)
+                # the interaction response, unless the view already acknowledged it. If we don't, it'll fail
+                if not interaction.response.is_done():
+                    await interaction.response.defer()
+                if not await self._admit_interaction(interaction, handler, guild_id):
+                    return
+                if self.speculator is not None:
+                    self.speculator.discard(interaction.message.id)
+                # A newer message ends the block early, leaving a partial rewrite that is not speculated on
+                finished = False
+                try:
+                    async with self.generations.generation(message.channel.id):
+                        with self._profile(handler):
+                            with STAGE_SECONDS.time(handler=handler, stage="history"):
+                                messages = await self._get_channel_messages(
+                                    channel=message.channel, skip=1
+                                )
+
+                            # Since we're editing the original message, we will just edit the response.
+                            # The last edit is not waited for, so it is merged with the reset of the buttons
+                            async def edit(_, content):
+                                return await self.outbound.edit(
+                                    interaction.message, content=content, wait=False
+                                )
 
-                # Since we're editing the original message, we will just edit the response
-                response = await interaction.message.edit(content=llama_response)
+                            with STAGE_SECONDS.time(handler=handler, stage="response"):
+                                _, response_content = await stream_to_message(
+                                    self.llama.stream_response(
+                                        messages=messages,
+                                        channel_id=message.channel.id,
+                                        guild_id=guild_id,
+                                        rewrite=True,
+                                        config=self._generation_config(guild_id),
+                                    ),
+                                    send=lambda content: edit(None, content),
+                                    edit=edit,
+                                    min_edit_interval=self.STREAM_EDIT_INTERVAL,
+                                )
+                            # The edits of the response are only known once their events arrive
+                            self._record_response(interaction.message, response_content)
+                            self._charge(
+                                interaction.user.id,
+                                guild_id,
+                                message.channel.id,
+                                response_content,
+                            )
+                            EVENTS.inc(handler=handler, outcome="ok")
+                            finished = True
+                    if finished and self.speculator is not None:
+                        await self._speculate_after(
+                            interaction.message, guild_id, response_content
+                        )
+                except Exception as exception:  # pylint: disable=broad-exception-caught
+                    await self._click_failed(interaction, handler, exception)
 
             view = BotResponseView(
                 on_continue_response=on_continue_response,
                 on_rewrite_response=on_rewrite_response,
+                outbound=self.outbound,
             )
 
-            async with message.channel.typing():
-                messages = await self._get_channel_messages(channel=message.channel)
-                llama_response = await self.llama.generate_response(messages=messages)
-                response = await message.channel.send(content=llama_response, view=view)
+            async def send(content):
+                with STAGE_SECONDS.time(handler="on_message", stage="send"):
+                    return await message.channel.send(content=content, view=view)
 
+            async def edit(sent, content):
+                return await self.outbound.edit(sent, content=content, wait=False)
+
+            # The response is posted as soon as the first chunk is generated, and then edited as it grows.
+            # A newer message in the channel cancels the generation, since this response would be out of date
+            finished = False
+            async with self.generations.generation(message.channel.id):
+                with self._profile("on_message"):
+                    async with message.channel.typing():
+                        with STAGE_SECONDS.time(handler="on_message", stage="history"):
+                            messages = await self._get_channel_messages(
+                                channel=message.channel
+                            )
+                        with STAGE_SECONDS.time(handler="on_message", stage="response"):
+                            response, response_content = await stream_to_message(
+                                self.llama.stream_response(
+                                    messages=messages,
+                                    channel_id=message.channel.id,
+                                    guild_id=guild_id,
+                                    config=self._generation_config(guild_id),
+                                ),
+                                send=send,
+                                edit=edit,
+                                min_edit_interval=self.STREAM_EDIT_INTERVAL,
+                            )
+                        with STAGE_SECONDS.time(handler="on_message", stage="edit"):
+                            await self.outbound.flush(response)
+                        self._record_response(response, response_content)
+                    self._charge(
+                        message.author.id,
+                        guild_id,
+                        message.channel.id,
+                        response_content,
+                    )
+                    if self.tracer is not None:
+                        self.tracer.response(
+                            message.channel.id,
+                            guild_id,
+                            message.id,
+                            len(response_content),
+                        )
+                    EVENTS.inc(handler="on_message", outcome="ok")
+                    finished = True
+            if finished and self.speculator is not None:
+                await self._speculate_after(response, guild_id, response_content)
+
+        except SchedulerBusyError:
+            # Shed load with a quick reply instead of queueing more work
+            EVENTS.inc(handler="on_message", outcome="busy")
+            await message.channel.send(embed=self._error_embed(self.BUSY))
+        except BackendLoadingError:
+            EVENTS.inc(handler="on_message", outcome="warming_up")
+            await message.channel.send(embed=self._error_embed(self.WARMING_UP))
+        except QuotaExceededError as exception:
+            EVENTS.inc(handler="on_message", outcome="over_quota")
+            # Every message past the quota would otherwise get a public reply of its own
+            if self.quotas.notify(message.author.id, exception):
+                await message.channel.send(embed=self._over_quota_embed(exception))
         except Exception as exception:
+            EVENTS.inc(handler="on_message", outcome="error")
+            ERRORS.inc(handler="on_message", type=exception.__class__.__name__)
             print(f"An error occurred: {exception.__class__.__name__}: {exception}")
+
+
+class ShardedDiscordBot(DiscordBot, discord.AutoShardedClient):
+    """Bot that connects to Discord through several gateway shards, given with `shard_count` and `shard_ids`
+    (by default, as many as Discord recommends). Several processes can each run some of the shards,
+    sharing a pool of inference servers."""
@@ -0,0 +1,264 @@
+import asyncio
+import itertools
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any
+import discord
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaBase, Message
+
+# Discord uses None to clear fields when editing, so a different value marks the ones left unchanged
+MISSING: Any = object()
+
+
+class FakeLlama(LlamaBase):
+    """Backend that streams a fixed response with a configurable latency, without running a model.
+    Responses are cut at the `max_tokens` of the generation config. `on_event` is called with "start", "token" and "finish" (or "cancel") as the generation progresses.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str = "",
+        *,
+        response_tokens: int = 64,
+        token_latency: float = 0.01,
+        first_token_latency: float = 0.0,
+        max_concurrency: int = 1,
+        context_window: int = LlamaBase.CONTEXT_WINDOW,
+        on_event: Callable[[str], None] | None = None,
+        generation_config: GenerationConfig | None = None,
+    ):
+        super().__init__(system_prompt, generation_config=generation_config)
+        # pylint: disable=invalid-name
+        self.MAX_CONCURRENCY = max_concurrency
+        self.CONTEXT_WINDOW = context_window
+        self.response_tokens = response_tokens
+        self.token_latency = token_latency
+        self.first_token_latency = first_token_latency
+        self.on_event = on_event or (lambda event: None)
+        self.generations = 0
+        self.tokens = 0
+
+    async def generate_response(
+        self, messages: list[Message], suffix: str = "", **kwargs
+    ) -> str:
+        chunks = self.stream_response(messages, suffix, **kwargs)
+        return "".join([chunk async for chunk in chunks])
+
+    async def stream_response(
+        self, messages: list[Message], suffix: str = "", **kwargs
+    ) -> AsyncIterator[str]:
+        self._generate_prompt(messages, suffix)
+        config = self.resolve_config(kwargs.get("config"))
+        self.generations += 1
+        self.on_event("start")
+        finished = False
+        try:
+            await asyncio.sleep(self.first_token_latency)
+            for i in range(min(self.response_tokens, config.max_tokens)):
+                await asyncio.sleep(self.token_latency)
+                self.tokens += 1
+                self.on_event("token")
+                yield f"token{i} "
+            finished = True
+        finally:
+            self.on_event("finish" if finished else "cancel")
+
+
+@dataclass(eq=False)
+class FakeUser:
+    id: int
+    name: str
+    bot: bool = False
+
+
+@dataclass
+class FakeGuild:
+    id: int
+
+
+@dataclass(eq=False)
+class FakeMessage:
+    """Message in a `FakeChannel`. Edits are dispatched to the bot like Discord does."""
+
+    id: int
+    channel: "FakeChannel"
+    author: FakeUser
+    content: str = ""
+    embed: discord.Embed | None = None
+    view: discord.ui.View | None = None
+    edits: int = 0
+    mentions: list[FakeUser] = field(default_factory=list)
+    # Like discord.MessageReference, with the message replied to as `resolved`
+    reference: SimpleNamespace | None = None
+
+    @property
+    def guild(self) -> FakeGuild | None:
+        return self.channel.guild
+
+    async def edit(self, *, content: str | None = MISSING, view=MISSING, **kwargs):
+        if content is not MISSING:
+            # Discord trims the content of messages
+            self.content = (content or "").strip()
+            self.channel.discord.dispatch(
+                "on_raw_message_edit",
+                SimpleNamespace(
+                    channel_id=self.channel.id,
+                    message_id=self.id,
+                    data={"content": self.content},
+                ),
+            )
+        if view is not MISSING:
+            self.view = view
+        self.edits += 1
+        return self
+
+
+@dataclass(eq=False)
+class FakeChannel:
+    """Text channel that keeps its messages in memory, and tells the bot about the ones it sends."""
+
+    id: int
+    discord: "FakeDiscord"
+    guild: FakeGuild | None = None
+    messages: list[FakeMessage] = field(default_factory=list)
+
+    def _create_message(self, author: FakeUser, content: str, **kwargs) -> FakeMessage:
+        message = FakeMessage(
+            next(self.discord.ids), self, author, (content or "").strip(), **kwargs
+        )
+        self.messages.append(message)
+        return message
+
+    async def send(self, content: str | None = None, *, embed=None, view=None):
+        message = self._create_message(
+            self.discord.bot_user, content, embed=embed, view=view
+        )
+        self.discord.on_bot_message(message)
+        self.discord.dispatch("on_message", message)
+        return message
+
+    async def history(self, limit: int | None = 100) -> AsyncIterator[FakeMessage]:
+        for message in reversed(self.messages[-limit:] if limit else self.messages):
+            yield message
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class FakeFollowup:
+    def __init__(self, channel: FakeChannel):
+        self.channel = channel
+
+    async def send(self, content: str | None = None, *, embed=None, **kwargs):
+        return await self.channel.send(content=content, embed=embed)
+
+
+class FakeInteractionResponse:
+    def __init__(self, message: FakeMessage):
+        self.message = message
+        self.deferred = False
+        self.acknowledged = False
+
+    def is_done(self) -> bool:
+        return self.acknowledged
+
+    async def defer(self, **kwargs):
+        self.deferred = self.acknowledged = True
+
+    async def edit_message(self, *, content: str | None = MISSING, view=MISSING):
+        self.acknowledged = True
+        await self.message.edit(content=content, view=view)
+
+
+class FakeInteraction:
+    """Interaction of a user with a button of a bot message."""
+
+    def __init__(self, message: FakeMessage, user: FakeUser):
+        self.message = message
+        self.user = user
+        self.channel = message.channel
+        self.response = FakeInteractionResponse(message)
+        self.followup = FakeFollowup(message.channel)
+
+
+class FakeDiscord:
+    """In-process stand-in for the Discord gateway and API. Messages are delivered to the bot's event handlers
+    as tasks, like discord.py does, and the bot's responses are stored in fake channels.
+    """
+
+    def __init__(
+        self,
+        bot: discord.Client,
+        channels: int = 1,
+        guilds: int = 1,
+        on_bot_message: Callable[[FakeMessage], None] | None = None,
+    ):
+        self.bot = bot
+        self.ids = itertools.count(1)
+        self.bot_user = FakeUser(next(self.ids), "bot", bot=True)
+        self.on_bot_message = on_bot_message or (lambda message: None)
+        self.tasks: set[asyncio.Task] = set()
+        # pylint: disable=protected-access
+        bot._connection.user = self.bot_user
+        self.channels = [
+            FakeChannel(
+                next(self.ids), self, FakeGuild(i % guilds + 1) if guilds else None
+            )
+            for i in range(channels)
+        ]
+
+    def dispatch(self, event: str, *args) -> asyncio.Task | None:
+        """Run an event handler of the bot in its own task, if it has one."""
+
+        handler = getattr(self.bot, event, None)
+        if handler is None:
+            return None
+        task = asyncio.get_running_loop().create_task(handler(*args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def send_message(
+        self,
+        channel: FakeChannel,
+        author: FakeUser,
+        content: str,
+        *,
+        mentions: list[FakeUser] | None = None,
+        reply_to: FakeMessage | None = None,
+    ) -> asyncio.Task:
+        """Post a message as a user, optionally mentioning users or replying to a message.
+        Returns the task of the bot handling it."""
+
+        message = channel._create_message(
+            author,
+            content,
+            mentions=mentions or [],
+            reference=(
+                SimpleNamespace(message_id=reply_to.id, resolved=reply_to)
+                if reply_to is not None
+                else None
+            ),
+        )
+        return self.dispatch("on_message", message)
+
+    def click(self, message: FakeMessage, button: str, user: FakeUser) -> asyncio.Task:
+        """Click a button of the view attached to a bot message, like 'rewrite_response'."""
+
+        callback = getattr(message.view, button).callback
+        task = asyncio.get_running_loop().create_task(
+            callback(FakeInteraction(message, user))
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def drain(self) -> None:
+        """Wait for every running handler to finish."""
+
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
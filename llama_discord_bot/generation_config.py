@@ -0,0 +1,102 @@
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from dataclasses import dataclass, fields
+
+
+@dataclass(frozen=True)
+class GenerationConfig:
+    """Settings of a generation. Configs are layered (the defaults of the backend, then the settings of the
+    guild, then the ones of the request) with `merge`, and settings left as None are taken from the layers below.
+    """
+
+    max_tokens: int | None = None
+    temperature: float | None = None
+    top_p: float | None = None
+    stop: tuple[str, ...] = ()
+
+    def merge(self, other: "GenerationConfig | None") -> "GenerationConfig":
+        """Layer `other` over this config. Its settings replace these, except that `max_tokens` can only be
+        lowered, since the context leaves room for that many tokens at most, and stop sequences add up.
+        """
+
+        if other is None:
+            return self
+        max_tokens = [
+            value for value in [self.max_tokens, other.max_tokens] if value is not None
+        ]
+        return GenerationConfig(
+            max_tokens=min(max_tokens) if max_tokens else None,
+            temperature=(
+                other.temperature if other.temperature is not None else self.temperature
+            ),
+            top_p=other.top_p if other.top_p is not None else self.top_p,
+            stop=tuple(dict.fromkeys(self.stop + other.stop)),
+        )
+
+    def to_dict(self) -> dict[str, object]:
+        """The settings that are set, as JSON-compatible values."""
+
+        data = {
+            field.name: getattr(self, field.name)
+            for field in fields(self)
+            if getattr(self, field.name) not in (None, ())
+        }
+        if self.stop:
+            data["stop"] = list(self.stop)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict[str, object]) -> "GenerationConfig":
+        """Parse the settings of `to_dict`, like the ones in GUILD_GENERATION_CONFIGS."""
+
+        unknown = set(data) - {field.name for field in fields(cls)}
+        if unknown:
+            raise ValueError(
+                f"Unknown generation settings: {', '.join(sorted(unknown))}"
+            )
+        return cls(
+            max_tokens=int(data["max_tokens"]) if data.get("max_tokens") else None,
+            temperature=(
+                float(data["temperature"])
+                if data.get("temperature") is not None
+                else None
+            ),
+            top_p=float(data["top_p"]) if data.get("top_p") is not None else None,
+            stop=tuple(data.get("stop") or ()),
+        )
+
+
+async def stop_at(
+    chunks: AsyncIterator[str], stop: tuple[str, ...]
+) -> AsyncIterator[str]:
+    """Yield the chunks of a stream until one of the `stop` sequences, which is left out, and close the stream
+    there. Text that could be the start of a stop sequence is held back until the next chunks tell.
+    """
+
+    pending = ""
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            pending += chunk
+            index = min(
+                (i for sequence in stop if (i := pending.find(sequence)) != -1),
+                default=None,
+            )
+            if index is not None:
+                if pending[:index]:
+                    yield pending[:index]
+                return
+
+            held = max(
+                (
+                    length
+                    for sequence in stop
+                    for length in range(1, len(sequence))
+                    if pending.endswith(sequence[:length])
+                ),
+                default=0,
+            )
+            if len(pending) > held:
+                yield pending[: len(pending) - held]
+                pending = pending[len(pending) - held :]
+    if pending:
+        yield pending
@@ -0,0 +1,55 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class GenerationTracker:
+    """Keeps track of the generation running for each channel. Starting a new generation in a channel
+    cancels the one that is running there, since its response would be out of date by the time it finished.
+    The cancellation propagates to the backend, which stops generating, and ends the superseded
+    `generation` block quietly, so the code after it still runs."""
+
+    def __init__(self):
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._superseded: set[asyncio.Task] = set()
+        self.started = 0
+        self.completed = 0
+        self.superseded = 0
+
+    @asynccontextmanager
+    async def generation(self, channel_id: int):
+        """Register the current task as the generation of a channel, superseding the previous one."""
+
+        task = asyncio.current_task()
+        previous = self._tasks.get(channel_id)
+        if previous is not None and previous is not task and not previous.done():
+            previous.cancel()
+            self._superseded.add(previous)
+            self.superseded += 1
+        self._tasks[channel_id] = task
+        self.started += 1
+
+        try:
+            yield
+            self.completed += 1
+        except asyncio.CancelledError:
+            # Only swallow the cancellation if it came from a newer generation, and nothing else cancelled the task
+            if task not in self._superseded or task.uncancel() > 0:
+                raise
+        finally:
+            self._superseded.discard(task)
+            if self._tasks.get(channel_id) is task:
+                del self._tasks[channel_id]
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def stats(self) -> dict[str, int]:
+        """Counters describing the generations of all channels."""
+
+        return {
+            "running": self.running,
+            "started": self.started,
+            "completed": self.completed,
+            "superseded": self.superseded,
+        }
@@ -0,0 +1,355 @@
+import asyncio
+import json
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing
+import aiohttp
+from aiohttp import web
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.instrumentation import InstrumentedLlama
+from llama_discord_bot.llama import ChatUser, LlamaBase, Message
+from llama_discord_bot.loader import BackendLoadingError, BackgroundLoadedLlama
+from llama_discord_bot.metrics import metrics
+from llama_discord_bot.scheduler import ScheduledLlama, SchedulerBusyError
+from llama_discord_bot.worker_pool import LlamaWorkerPool
+
+
+class RemoteInferenceError(Exception):
+    """Raised when an inference server cannot be reached, or fails to generate a response."""
+
+
+# Errors raised before a response starts are sent with their type, so clients raise the same exception
+ERROR_TYPES: dict[str, type[Exception]] = {
+    "busy": SchedulerBusyError,
+    "loading": BackendLoadingError,
+}
+
+
+def _error_type(exception: Exception) -> str:
+    for name, exception_type in ERROR_TYPES.items():
+        if isinstance(exception, exception_type):
+            return name
+    return "error"
+
+
+class InferenceServer:
+    """Serves the generations of a backend over HTTP, on a TCP port or a Unix socket, so the model runs in its own
+    process and several bot processes (or shards) can share it. Generations go through a scheduler, like they do
+    in the bot, and are streamed as JSON lines: `{"chunk": ...}` for each chunk, then `{"done": true}`.
+    Errors raised before the first chunk are answered with a status code instead, and a client that disconnects
+    cancels its generation.
+
+    Endpoints: `GET /v1/info`, `POST /v1/generate`, `GET /v1/stats` and `GET /metrics`.
+    """
+
+    def __init__(
+        self,
+        llama: LlamaBase,
+        *,
+        host: str = "127.0.0.1",
+        port: int = 8100,
+        path: str | None = None,
+        max_concurrency: int | None = None,
+        max_queue: int = 32,
+        loaders: list[BackgroundLoadedLlama | LlamaWorkerPool] | None = None,
+    ):
+        self.backend = llama
+        self.llama = ScheduledLlama(
+            InstrumentedLlama(llama),
+            max_concurrency=max_concurrency,
+            max_queue=max_queue,
+        )
+        self.host = host
+        self.port = port
+        self.path = path
+        self.loaders = loaders or []
+        self._runner: web.AppRunner | None = None
+        self.requests = 0
+        self.cancellations = 0
+        self.failures = 0
+
+    @staticmethod
+    def _parse_request(body: dict) -> dict:
+        return {
+            "messages": [
+                Message(ChatUser(message["user"]), message["content"])
+                for message in body["messages"]
+            ],
+            "suffix": body.get("suffix", ""),
+            "channel_id": body.get("channel_id"),
+            "guild_id": body.get("guild_id"),
+            "rewrite": body.get("rewrite", False),
+            "config": (
+                GenerationConfig.from_dict(body["config"])
+                if body.get("config")
+                else None
+            ),
+        }
+
+    async def _info(self, _: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "name": self.backend.name,
+                "max_concurrency": self.llama.scheduler.max_concurrency,
+                "context_window": self.backend.CONTEXT_WINDOW,
+                "ready": all(loader.ready for loader in self.loaders),
+            }
+        )
+
+    async def _generate(self, request: web.Request) -> web.StreamResponse:
+        try:
+            kwargs = self._parse_request(await request.json())
+        except (ValueError, KeyError, TypeError) as exception:
+            return web.json_response(
+                {"error": f"Invalid request: {exception!r}", "type": "error"},
+                status=400,
+            )
+        # The prompt has to fit in the context of this backend, whatever the client selected
+        kwargs["messages"] = self.backend.select_context(
+            kwargs["messages"], suffix=kwargs["suffix"]
+        )
+
+        self.requests += 1
+        response = None
+        try:
+            async with aclosing(self.llama.stream_response(**kwargs)) as chunks:
+                async for chunk in chunks:
+                    if response is None:
+                        # The response starts with the first chunk, so earlier errors still get a status code
+                        response = web.StreamResponse(
+                            headers={"Content-Type": "application/x-ndjson"}
+                        )
+                        await response.prepare(request)
+                    await response.write(json.dumps({"chunk": chunk}).encode() + b"\n")
+        except asyncio.CancelledError:
+            # The client disconnected
+            self.cancellations += 1
+            raise
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            self.failures += 1
+            error = {"error": str(exception), "type": _error_type(exception)}
+            if response is None:
+                status = 503 if error["type"] in ERROR_TYPES else 500
+                return web.json_response(error, status=status)
+            await response.write(json.dumps(error).encode() + b"\n")
+            return response
+
+        if response is None:
+            response = web.StreamResponse(
+                headers={"Content-Type": "application/x-ndjson"}
+            )
+            await response.prepare(request)
+        await response.write(b'{"done": true}\n')
+        return response
+
+    async def _stats(self, _: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def _metrics(self, _: web.Request) -> web.Response:
+        return web.Response(
+            text=metrics.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def start(self) -> None:
+        """Start loading the model and serving requests."""
+
+        for loader in self.loaders:
+            loader.start()
+        app = web.Application()
+        app.router.add_get("/v1/info", self._info)
+        app.router.add_post("/v1/generate", self._generate)
+        app.router.add_get("/v1/stats", self._stats)
+        app.router.add_get("/metrics", self._metrics)
+        # Handlers are cancelled when clients disconnect, which stops their generations
+        self._runner = web.AppRunner(app, access_log=None, handler_cancellation=True)
+        await self._runner.setup()
+        if self.path is not None:
+            site = web.UnixSite(self._runner, self.path)
+        else:
+            site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if self.path is None:
+            # Find out the port if it was picked by the OS
+            self.port = self._runner.addresses[0][1]
+
+    @property
+    def url(self) -> str:
+        """URL clients reach the server at."""
+
+        if self.path is not None:
+            return f"unix:{self.path}"
+        return f"http://{self.host}:{self.port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing the requests served, and the stats of the scheduler and the backend."""
+
+        stats = {
+            "requests": self.requests,
+            "cancellations": self.cancellations,
+            "failures": self.failures,
+        }
+        stats.update(
+            {
+                f"scheduler_{key}": value
+                for key, value in self.llama.scheduler.stats().items()
+            }
+        )
+        if hasattr(self.backend, "stats"):
+            stats.update(
+                {f"backend_{key}": value for key, value in self.backend.stats().items()}
+            )
+        return stats
+
+
+class RemoteLlama(LlamaBase):
+    """Generates responses with an `InferenceServer`, reached at `http://host:port` or at `unix:/path/to/socket`.
+    The server builds the prompts and trims them to its context window, so tokens are only counted here to select
+    the context, and are estimated unless a local tokenizer is given in `count_tokens`.
+    """
+
+    MAX_CONCURRENCY = 4
+
+    def __init__(
+        self,
+        url: str,
+        system_prompt: str = "",
+        *,
+        count_tokens: Callable[[str], int] | None = None,
+        max_concurrency: int | None = None,
+        context_window: int | None = None,
+        connect_timeout: float = 5.0,
+    ):
+        super().__init__(system_prompt, count_tokens=count_tokens)
+        self.url = url
+        # pylint: disable=invalid-name
+        self.MAX_CONCURRENCY = max_concurrency or self.MAX_CONCURRENCY
+        self.CONTEXT_WINDOW = context_window or self.CONTEXT_WINDOW
+        self.connect_timeout = connect_timeout
+        # Requests over a Unix socket still need a host in their URL, which is ignored
+        self._base_url = (
+            "http://localhost" if url.startswith("unix:") else url.rstrip("/")
+        )
+        self._session: aiohttp.ClientSession | None = None
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def name(self) -> str:
+        return f"{type(self).__name__}:{self.url}"
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Get the session, creating it in the running event loop the first time."""
+
+        if self._session is None or self._session.closed:
+            if self.url.startswith("unix:"):
+                connector = aiohttp.UnixConnector(path=self.url.removeprefix("unix:"))
+            else:
+                connector = aiohttp.TCPConnector(limit=self.MAX_CONCURRENCY * 2)
+            # Generations can take as long as they need, but connecting to a server that is down should not
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None, sock_connect=self.connect_timeout
+                ),
+            )
+        return self._session
+
+    async def info(self) -> dict:
+        """Describe the backend of the server, and whether it is ready."""
+
+        session = self._get_session()
+        async with session.get(self._base_url + "/v1/info") as response:
+            return await response.json()
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        chunks = self.stream_response(
+            messages=messages,
+            suffix=suffix,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            rewrite=rewrite,
+            config=config,
+        )
+        return "".join([chunk async for chunk in chunks])
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        """Stream a response from the server. Closing the stream early closes the connection,
+        which cancels the generation on the server."""
+
+        body = {
+            "messages": [
+                {"user": message.user.value, "content": message.content}
+                for message in messages
+            ],
+            "suffix": suffix,
+            "channel_id": channel_id,
+            "guild_id": guild_id,
+            "rewrite": rewrite,
+            "config": config.to_dict() if config is not None else None,
+        }
+        self.requests += 1
+        session = self._get_session()
+        try:
+            async with session.post(
+                self._base_url + "/v1/generate", json=body
+            ) as response:
+                if response.status >= 400:
+                    raise await self._error(response)
+                async for line in response.content:
+                    event = json.loads(line)
+                    if "chunk" in event:
+                        yield event["chunk"]
+                    elif "error" in event:
+                        raise RemoteInferenceError(event["error"])
+                    elif event.get("done"):
+                        return
+                raise RemoteInferenceError("The response ended before it was done")
+        except (aiohttp.ClientError, ValueError) as exception:
+            self.failures += 1
+            raise RemoteInferenceError(
+                f"Request to {self.url} failed: {exception!r}"
+            ) from exception
+        except RemoteInferenceError:
+            self.failures += 1
+            raise
+
+    @staticmethod
+    async def _error(response: aiohttp.ClientResponse) -> Exception:
+        try:
+            error = await response.json()
+            exception_type = ERROR_TYPES.get(error["type"], RemoteInferenceError)
+            return exception_type(error["error"])
+        except (aiohttp.ContentTypeError, ValueError, KeyError, TypeError):
+            return RemoteInferenceError(
+                f"HTTP error: {response.status} {response.reason}"
+            )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    def stats(self) -> dict[str, int]:
+        """Counters describing the requests made to the server."""
+
+        return {"requests": self.requests, "failures": self.failures}
@@ -0,0 +1,108 @@
+import time
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaBase, Message
+from llama_discord_bot.metrics import (
+    BACKEND_ERRORS,
+    FIRST_TOKEN_SECONDS,
+    GENERATED_TOKENS,
+    GENERATION_SECONDS,
+    PROMPT_TOKENS,
+    TOKENS_PER_SECOND,
+)
+
+
+class InstrumentedLlama(LlamaBase):
+    """Wraps a backend to record its time to first token, generation speed, prompt sizes and errors."""
+
+    def __init__(self, llama: LlamaBase):
+        super().__init__(llama.system_prompt)
+        # pylint: disable=invalid-name
+        self.MAX_CONCURRENCY = llama.MAX_CONCURRENCY
+        self.llama = llama
+
+    @property
+    def name(self) -> str:
+        return self.llama.name
+
+    def count_tokens(self, text: str) -> int:
+        return self.llama.count_tokens(text)
+
+    def resolve_config(
+        self, config: GenerationConfig | None = None
+    ) -> GenerationConfig:
+        return self.llama.resolve_config(config)
+
+    def select_context(
+        self, messages: list[Message], suffix: str = "", max_tokens: int | None = None
+    ) -> list[Message]:
+        return self.llama.select_context(messages, suffix, max_tokens)
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        chunks = self.stream_response(
+            messages=messages,
+            suffix=suffix,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            rewrite=rewrite,
+            config=config,
+        )
+        return "".join([chunk async for chunk in chunks])
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        backend = self.name
+        PROMPT_TOKENS.observe(
+            self.llama.count_prompt_tokens(messages, suffix), backend=backend
+        )
+        start = time.perf_counter()
+        first_chunk = None
+        chunks = 0
+        try:
+            async with aclosing(
+                self.llama.stream_response(
+                    messages=messages,
+                    suffix=suffix,
+                    channel_id=channel_id,
+                    guild_id=guild_id,
+                    rewrite=rewrite,
+                    config=config,
+                )
+            ) as stream:
+                async for chunk in stream:
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter()
+                        FIRST_TOKEN_SECONDS.observe(
+                            first_chunk - start, backend=backend
+                        )
+                    chunks += 1
+                    GENERATED_TOKENS.inc(backend=backend)
+                    yield chunk
+        except Exception as exception:
+            BACKEND_ERRORS.inc(backend=backend, type=type(exception).__name__)
+            raise
+
+        end = time.perf_counter()
+        GENERATION_SECONDS.observe(end - start, backend=backend)
+        if chunks > 1 and end > first_chunk:
+            TOKENS_PER_SECOND.observe(
+                (chunks - 1) / (end - first_chunk), backend=backend
+            )
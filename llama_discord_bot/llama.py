@@ -1,36 +1,185 @@
-from enum import Enum
+import threading
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import aclosing
 from itertools import groupby
-from llama_cpp import Llama
-import replicate
-from llama_discord_bot.run_async import run_async
+from typing import TYPE_CHECKING
+from llama_discord_bot.generation_config import GenerationConfig, stop_at
+from llama_discord_bot.run_async import run_async, run_async_iter
+from llama_discord_bot.prompt import (
+    STOP_SEQUENCES,
+    ChatUser,
+    Message,
+    PromptBuilder,
+)
 
+# Backends import their libraries when they are created, so only the one that is used is loaded
+if TYPE_CHECKING:
+    from llama_cpp import StoppingCriteriaList
+    from llama_discord_bot.replicate_client import ReplicateClient
 
-class ChatUser(Enum):
-    """The possible users of a chat message."""
 
-    AI = "ai"
-    HUMAN = "human"
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text without a tokenizer.
+    Llama tokenizers average about 4 characters per token in English, so this errs on the safe side.
+    """
 
+    return -(-len(text) // 3)
 
-@dataclass
-class Message:
-    """A message sent by a user or the bot."""
 
-    user: ChatUser
-    content: str
+def llama_cpp_token_counter(model_path: str) -> Callable[[str], int]:
+    """Count tokens with the tokenizer of a llama.cpp model, loading only its vocabulary."""
+
+    from llama_cpp import Llama  # pylint: disable=import-outside-toplevel
+
+    vocabulary = Llama(model_path=model_path, vocab_only=True, verbose=False)
+
+    def count_tokens(text: str) -> int:
+        return len(vocabulary.tokenize(text.encode("utf-8"), add_bos=False))
+
+    return count_tokens
 
 
 class LlamaBase(ABC):
     """Abstract base class for Llama models."""
 
-    def __init__(self, system_prompt: str = ""):
+    # How many generations the backend can run at the same time
+    MAX_CONCURRENCY = 1
+    # How many tokens the model can attend to, and how many of them are kept for the response
+    CONTEXT_WINDOW = 4096
+    RESPONSE_TOKENS = 512
+    # Sampling settings of backends that are not configured otherwise
+    TEMPERATURE = 0.8
+    TOP_P = 0.95
+    # How many token counts are remembered, so messages are not tokenized again on every turn
+    TOKEN_COUNT_CACHE_SIZE = 4096
+
+    def __init__(
+        self,
+        system_prompt: str = "",
+        count_tokens: Callable[[str], int] | None = None,
+        tokenize: Callable[[str], list[int]] | None = None,
+        generation_config: GenerationConfig | None = None,
+    ):
         self.system_prompt = system_prompt
+        self.generation_config = generation_config or GenerationConfig()
+        self.prompt_builder = PromptBuilder(tokenize=tokenize)
+        self._count_tokens = count_tokens or estimate_tokens
+        self._token_counts: OrderedDict[str, int] = OrderedDict()
 
     @abstractmethod
-    def generate_response(self, messages: list[Message], suffix: str = "") -> str:
-        """Generate a response using the model."""
+    def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        """Generate a response using the model. `channel_id` and `guild_id` identify the
+        conversation, so backends can reuse work between turns and share load fairly.
+        `rewrite` is set when the response replaces one the user asked to rewrite.
+        `config` overrides the generation settings of the backend (see `resolve_config`).
+        """
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        """Generate a response using the model, yielding chunks of text as soon as they are available.
+        Backends that cannot stream yield the whole response as a single chunk."""
+
+        yield await self.generate_response(
+            messages=messages,
+            suffix=suffix,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            rewrite=rewrite,
+            config=config,
+        )
+
+    @property
+    def name(self) -> str:
+        """Identifies the backend and its model, for caching and reporting."""
+
+        return type(self).__name__
+
+    def resolve_config(
+        self, config: GenerationConfig | None = None
+    ) -> GenerationConfig:
+        """The settings of a generation: the defaults, overridden by the settings of the backend, and then by
+        `config`. Responses stop at the markers of the prompt template, and at `RESPONSE_TOKENS`, since the
+        context only leaves room for that many tokens."""
+
+        defaults = GenerationConfig(
+            max_tokens=self.RESPONSE_TOKENS,
+            temperature=self.TEMPERATURE,
+            top_p=self.TOP_P,
+            stop=STOP_SEQUENCES,
+        )
+        return defaults.merge(self.generation_config).merge(config)
+
+    def count_tokens(self, text: str) -> int:
+        """Count the tokens of a text, remembering the counts of recently seen texts."""
+
+        count = self._token_counts.get(text)
+        if count is not None:
+            self._token_counts.move_to_end(text)
+            return count
+
+        count = self._count_tokens(text)
+        self._token_counts[text] = count
+        if len(self._token_counts) > self.TOKEN_COUNT_CACHE_SIZE:
+            self._token_counts.popitem(last=False)
+        return count
+
+    def select_context(
+        self, messages: list[Message], suffix: str = "", max_tokens: int | None = None
+    ) -> list[Message]:
+        """Select the latest messages that fit in the context window, leaving room for the system prompt,
+        the suffix and the response. `max_tokens` further limits the tokens used by the prompt.
+        The latest message is always selected, even if it does not fit on its own, and so are system messages.
+        """
+
+        budget = self.CONTEXT_WINDOW - self.RESPONSE_TOKENS
+        if max_tokens is not None:
+            budget = min(budget, max_tokens)
+
+        system_messages = [
+            message for message in messages if message.user == ChatUser.SYSTEM
+        ]
+        messages = [message for message in messages if message.user != ChatUser.SYSTEM]
+
+        # The template with no messages holds the system prompt, the system messages and the suffix
+        empty_prompt = self._generate_prompt(
+            system_messages + [Message(ChatUser.HUMAN, "")], suffix
+        )
+        budget -= self.count_tokens(empty_prompt)
+        # Every message adds (at most) a template part of its own
+        message_overhead = self.count_tokens(
+            self._generate_prompt([Message(ChatUser.HUMAN, "")], "")
+        )
+        if self.system_prompt.strip():
+            message_overhead -= self.count_tokens(
+                "<<SYS>>" + self.system_prompt + "<</SYS>>"
+            )
+
+        selected = 0
+        for message in reversed(messages):
+            budget -= self.count_tokens(message.content.strip()) + message_overhead
+            if budget < 0 and selected > 0:
+                break
+            selected += 1
+        return system_messages + messages[len(messages) - selected :]
 
     def _merge_consecutive_messages_by_role(
         self, messages: list[Message]
@@ -56,93 +205,282 @@ class LlamaBase(ABC):
         It uses the prompting technique from Meta's paper. A good explanation of the technique can be found here:
         https://huggingface.co/blog/llama2#how-to-prompt-llama-2"""
 
-        if not messages:
-            raise ValueError("Cannot generate prompt from empty messages list")
-
-        # Merge consecutive messages from the same author into a single message with concatenated content
-        messages = self._merge_consecutive_messages_by_role(messages)
+        return self.prompt_builder.build(messages, suffix, self.system_prompt)
 
-        # Initialize the prompt as an empty string
-        prompt = ""
-        i = 0
-        while i < len(messages):
-            message = messages[i]
-            bot_message = message.content.strip() if message.user == ChatUser.AI else ""
-            user_message = (
-                message.content.strip() if message.user == ChatUser.HUMAN else ""
-            )
-
-            # If the next message is from the bot, use its content for the bot message
-            if (
-                user_message
-                and (i + 1 < len(messages))
-                and (messages[i + 1].user == ChatUser.AI)
-            ):
-                bot_message = messages[i + 1].content.strip()
+    def count_prompt_tokens(self, messages: list[Message], suffix: str = "") -> int:
+        """Count the tokens of the prompt for a list of messages. Only the parts of the prompt that were not
+        counted before are tokenized."""
 
-            # Add the system prompt only for the first message and if it's not empty
-            system_prompt = (
-                ("<<SYS>>" + self.system_prompt + "<</SYS>>")
-                if (i == 0 and self.system_prompt.strip())
-                else ""
-            )
+        if self.prompt_builder.tokenize is None:
+            return self.count_tokens(self._generate_prompt(messages, suffix))
+        return len(
+            self.prompt_builder.build_tokens(messages, suffix, self.system_prompt)
+        )
 
-            # Add the prompt part to the string
-            prompt += f"""<s>
-            [INST]
-            {system_prompt}
-            {user_message}
-            [/INST]
-            {bot_message}
-            </s>"""
 
-            i += 1  # Increment the index to move to the next message
-            if bot_message and user_message:
-                i += 1  # Increment the index to skip the bot message in the next iteration if we used 2 messages
+class LlamaLocal(LlamaBase):
+    """Uses llama_cpp locally to generate responses. The evaluation state of each channel
+    is cached, so consecutive turns only evaluate the new part of the prompt.
+    Cancelled generations stop at the next token, instead of running until the end.
+    The model file is memory mapped by default, and `use_mlock` keeps it from being swapped out.
+    """
+
+    CONTEXT_WINDOW = 2048
+
+    def __init__(
+        self,
+        model_path: str,
+        system_prompt: str = "",
+        *,
+        state_cache_bytes: int = (2 << 30),
+        state_cache_dir: str | None = None,
+        n_threads: int | None = None,
+        use_mmap: bool = True,
+        use_mlock: bool = False,
+        generation_config: GenerationConfig | None = None,
+    ):
+        # pylint: disable=import-outside-toplevel
+        from llama_cpp import Llama
+        from llama_discord_bot.prompt_cache import PromptStateCache
+
+        super().__init__(
+            system_prompt,
+            count_tokens=self._tokenize_count,
+            tokenize=self._tokenize,
+            generation_config=generation_config,
+        )
+        self.model_path = model_path
+        self.llama_cpp = Llama(
+            model_path=model_path,
+            n_ctx=self.CONTEXT_WINDOW,
+            n_threads=n_threads,
+            use_mmap=use_mmap,
+            use_mlock=use_mlock,
+        )
+        self.prompt_cache = PromptStateCache(
+            capacity_bytes=state_cache_bytes, disk_path=state_cache_dir
+        )
+        self.llama_cpp.set_cache(self.prompt_cache)
+        self.cancelled_generations = 0
+
+    @property
+    def name(self) -> str:
+        return f"{type(self).__name__}:{self.model_path}"
+
+    def _tokenize(self, text: str) -> list[int]:
+        return self.llama_cpp.tokenize(text.encode("utf-8"), add_bos=False)
+
+    def _tokenize_count(self, text: str) -> int:
+        return len(self._tokenize(text))
+
+    def _prepare_completion(
+        self, messages: list[Message], suffix: str, channel_id: int | None
+    ) -> tuple[str, int, int]:
+        """Generate the prompt and scope the state cache to the channel. Returns the prompt,
+        its number of tokens and how many of them are already evaluated."""
+
+        prompt = self._generate_prompt(messages=messages, suffix=suffix)
+        # llama.cpp adds a blank space to the start of the prompt before tokenizing it
+        prompt_tokens = self.llama_cpp.tokenize(b" " + prompt.encode("utf-8"))
+        evaluated_tokens = self.llama_cpp.input_ids[: self.llama_cpp.n_tokens].tolist()
+        loaded_prefix = self.llama_cpp.longest_token_prefix(
+            evaluated_tokens, prompt_tokens[:-1]
+        )
 
-        if suffix:
-            prompt += f"""
-            <s>
-            [INST]
-            {suffix}
-            [/INST]
-            </s>
-            """
+        self.prompt_cache.channel = channel_id
+        self.prompt_cache.last_prefix_length = 0
+        return prompt, len(prompt_tokens), loaded_prefix
 
-        return prompt.strip()
+    def _record_completion(self, prompt_tokens: int, loaded_prefix: int) -> None:
+        """Record how many prompt tokens were reused, either from the current state or from the state cache."""
 
+        reused_tokens = max(loaded_prefix, self.prompt_cache.last_prefix_length)
+        self.prompt_cache.record_completion(
+            prompt_tokens, min(reused_tokens, prompt_tokens - 1)
+        )
 
-class LlamaLocal(LlamaBase):
-    """Uses llama_cpp locally to generate responses."""
+    def _stopping_criteria(self, stopped: threading.Event) -> "StoppingCriteriaList":
+        """Make llama.cpp stop sampling tokens once `stopped` is set."""
+
+        # pylint: disable=import-outside-toplevel
+        from llama_cpp import StoppingCriteriaList
+
+        def stop(input_ids, logits) -> bool:
+            return stopped.is_set()
+
+        return StoppingCriteriaList([stop])
+
+    @staticmethod
+    def _sampling_options(config: GenerationConfig) -> dict:
+        return {
+            "max_tokens": config.max_tokens,
+            "temperature": config.temperature,
+            "top_p": config.top_p,
+            "stop": list(config.stop),
+        }
+
+    @run_async(stop_keyword="stopped")
+    def _generate(
+        self,
+        messages: list[Message],
+        suffix: str,
+        channel_id: int | None,
+        config: GenerationConfig,
+        stopped: threading.Event,
+    ) -> str:
+        prompt, prompt_tokens, loaded_prefix = self._prepare_completion(
+            messages, suffix, channel_id
+        )
+        completion = self.llama_cpp.create_completion(
+            prompt=prompt,
+            stopping_criteria=self._stopping_criteria(stopped),
+            **self._sampling_options(config),
+        )
+        self._record_completion(prompt_tokens, loaded_prefix)
+        if stopped.is_set():
+            self.cancelled_generations += 1
 
-    def __init__(self, model_path: str, system_prompt: str = ""):
-        super().__init__(system_prompt)
-        self.llama_cpp = Llama(model_path=model_path, n_ctx=2048)
+        return completion["choices"][0]["text"]
 
-    @run_async
-    def generate_response(self, messages: list[Message], suffix: str = "") -> str:
+    @run_async_iter(stop_keyword="stopped")
+    def _stream(
+        self,
+        messages: list[Message],
+        suffix: str,
+        channel_id: int | None,
+        config: GenerationConfig,
+        stopped: threading.Event,
+    ) -> Iterator[str]:
+        prompt, prompt_tokens, loaded_prefix = self._prepare_completion(
+            messages, suffix, channel_id
+        )
+        try:
+            for chunk in self.llama_cpp.create_completion(
+                prompt=prompt,
+                stream=True,
+                stopping_criteria=self._stopping_criteria(stopped),
+                **self._sampling_options(config),
+            ):
+                yield chunk["choices"][0]["text"]
+        finally:
+            self._record_completion(prompt_tokens, loaded_prefix)
+            if stopped.is_set():
+                self.cancelled_generations += 1
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
         """Generates a response using a local model. Uses llama.cpp under the hood."""
 
-        completion = self.llama_cpp.create_completion(
-            prompt=self._generate_prompt(messages=messages, suffix=suffix)
+        return await self._generate(
+            messages, suffix, channel_id, self.resolve_config(config)
         )
 
-        return completion["choices"][0]["text"]
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        """Streams a response using a local model, one token at a time."""
+
+        async with aclosing(
+            self._stream(messages, suffix, channel_id, self.resolve_config(config))
+        ) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing the reuse of evaluation states and the cancelled generations."""
+
+        return {
+            **self.prompt_cache.stats(),
+            "cancelled_generations": self.cancelled_generations,
+        }
 
 
 class LlamaReplicate(LlamaBase):
-    """Uses replicate (remote) to generate responses."""
-
-    def __init__(self, replicate_model: str, system_prompt: str = ""):
-        super().__init__(system_prompt)
+    """Uses replicate (remote) to generate responses.
+    Since the model runs remotely, tokens are estimated unless a local tokenizer is given in `count_tokens`.
+    Predictions run through an asynchronous `ReplicateClient`, which can be shared between backends.
+    """
+
+    MAX_CONCURRENCY = 8
+
+    def __init__(
+        self,
+        replicate_model: str,
+        system_prompt: str = "",
+        count_tokens: Callable[[str], int] | None = None,
+        client: "ReplicateClient | None" = None,
+        generation_config: GenerationConfig | None = None,
+    ):
+        # pylint: disable=import-outside-toplevel
+        from llama_discord_bot.replicate_client import ReplicateClient
+
+        super().__init__(
+            system_prompt,
+            count_tokens=count_tokens,
+            generation_config=generation_config,
+        )
         self.replicate_model = replicate_model
-
-    @run_async
-    def generate_response(self, messages: list[Message], suffix: str = "") -> str:
+        self.client = client or ReplicateClient()
+
+    @property
+    def name(self) -> str:
+        return f"{type(self).__name__}:{self.replicate_model}"
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
         """Generate a response using the replicate model."""
 
-        input_data = {"prompt": self._generate_prompt(messages=messages, suffix=suffix)}
-
         # Replicate returns data separated into chunks, so we need to join them
-        output = replicate.run(self.replicate_model, input=input_data)
-        return "".join(output)
+        chunks = self.stream_response(messages=messages, suffix=suffix, config=config)
+        return "".join([chunk async for chunk in chunks])
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        """Streams a response using the replicate model, yielding chunks as replicate outputs them.
+        Closing the stream early cancels the prediction, and so does reaching a stop sequence, which is also
+        checked here, since not every model honors them."""
+
+        config = self.resolve_config(config)
+        input_data = {
+            "prompt": self._generate_prompt(messages=messages, suffix=suffix),
+            "max_new_tokens": config.max_tokens,
+            "temperature": config.temperature,
+            "top_p": config.top_p,
+            "stop_sequences": ",".join(config.stop),
+        }
+        async with aclosing(
+            stop_at(self.client.stream(self.replicate_model, input_data), config.stop)
+        ) as chunks:
+            async for chunk in chunks:
+                yield chunk
@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import ChatUser, LlamaBase, Message
+
+
+class BackendLoadingError(Exception):
+    """Raised when a request arrives before the backend has finished loading."""
+
+
+class BackgroundLoadedLlama(LlamaBase):
+    """Creates a backend in a thread, so the bot can connect to Discord while the model loads.
+    Until the backend is ready, token counts are estimated, and requests either wait for it (with `wait`)
+    or raise `BackendLoadingError`. An optional `warmup_prompt` is evaluated before the backend is ready,
+    so the first user does not pay for the model being paged in.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], LlamaBase],
+        system_prompt: str = "",
+        *,
+        name: str = "BackgroundLoadedLlama",
+        context_window: int = LlamaBase.CONTEXT_WINDOW,
+        max_concurrency: int = 1,
+        wait: bool = False,
+        warmup_prompt: str | None = None,
+        generation_config: GenerationConfig | None = None,
+    ):
+        super().__init__(system_prompt, generation_config=generation_config)
+        # pylint: disable=invalid-name
+        self.MAX_CONCURRENCY = max_concurrency
+        self.CONTEXT_WINDOW = context_window
+        self.factory = factory
+        self._name = name
+        self.wait = wait
+        self.warmup_prompt = warmup_prompt
+        self.llama: LlamaBase | None = None
+        self._task: asyncio.Task | None = None
+        self.load_seconds: float | None = None
+        self.warmup_seconds: float | None = None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def ready(self) -> bool:
+        return self.llama is not None
+
+    def start(self) -> asyncio.Task:
+        """Start loading the backend in the background. Returns the task loading it."""
+
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._load())
+        return self._task
+
+    async def _load(self) -> None:
+        start = time.perf_counter()
+        llama = await asyncio.to_thread(self.factory)
+        self.load_seconds = time.perf_counter() - start
+        print(f"🦙 Model loaded in {self.load_seconds:.2f}s")
+
+        if self.warmup_prompt:
+            start = time.perf_counter()
+            # Evaluating the prompt is what touches every weight, so there is no need to generate a whole response
+            async with aclosing(
+                llama.stream_response([Message(ChatUser.HUMAN, self.warmup_prompt)])
+            ) as chunks:
+                async for _ in chunks:
+                    break
+            self.warmup_seconds = time.perf_counter() - start
+            print(f"🔥 Model warmed up in {self.warmup_seconds:.2f}s")
+        self.llama = llama
+
+    async def _backend(self) -> LlamaBase:
+        if self.llama is not None:
+            return self.llama
+        if self._task is None:
+            raise BackendLoadingError("The backend was not started")
+        if not self.wait and not self._task.done():
+            raise BackendLoadingError("The model is still loading")
+        # A request that gives up waiting does not cancel the loading. If the loading failed, this raises its error
+        await asyncio.shield(self._task)
+        return self.llama
+
+    def count_tokens(self, text: str) -> int:
+        if self.llama is None:
+            return super().count_tokens(text)
+        return self.llama.count_tokens(text)
+
+    def resolve_config(
+        self, config: GenerationConfig | None = None
+    ) -> GenerationConfig:
+        if self.llama is None:
+            return super().resolve_config(config)
+        return self.llama.resolve_config(config)
+
+    def count_prompt_tokens(self, messages: list[Message], suffix: str = "") -> int:
+        if self.llama is None:
+            return super().count_prompt_tokens(messages, suffix)
+        return self.llama.count_prompt_tokens(messages, suffix)
+
+    def select_context(
+        self, messages: list[Message], suffix: str = "", max_tokens: int | None = None
+    ) -> list[Message]:
+        if self.llama is None:
+            return super().select_context(messages, suffix, max_tokens)
+        return self.llama.select_context(messages, suffix, max_tokens)
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        llama = await self._backend()
+        return await llama.generate_response(
+            messages=messages,
+            suffix=suffix,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            rewrite=rewrite,
+            config=config,
+        )
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        llama = await self._backend()
+        async with aclosing(
+            llama.stream_response(
+                messages=messages,
+                suffix=suffix,
+                channel_id=channel_id,
+                guild_id=guild_id,
+                rewrite=rewrite,
+                config=config,
+            )
+        ) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    def stats(self) -> dict[str, int | float]:
+        """How long loading and warming up took, and the stats of the backend once it is ready."""
+
+        stats = {
+            "ready": int(self.ready),
+            "load_seconds": self.load_seconds or 0.0,
+            "warmup_seconds": self.warmup_seconds or 0.0,
+        }
+        if self.llama is not None and hasattr(self.llama, "stats"):
+            stats.update(self.llama.stats())
+        return stats
@@ -0,0 +1,98 @@
+from collections import OrderedDict, deque
+from llama_discord_bot.llama import Message
+
+
+class _ChannelBuffer:
+    """Ring buffer with the latest messages of a single channel, oldest first."""
+
+    def __init__(self, size: int, entries: list[tuple[int, Message]]):
+        self.entries: deque[tuple[int, Message]] = deque(entries, maxlen=size)
+        # True if the buffer holds the whole history of the channel, so a short buffer is still complete
+        self.exhausted = len(entries) < size
+
+
+class ChannelMessageCache:
+    """In-memory cache of the latest messages of each channel.
+    It is kept up to date with gateway events (new, edited and deleted messages), so the channel history
+    only needs to be fetched through the REST API the first time a channel is seen.
+    Channels are evicted in least recently used order once `max_channels` is reached."""
+
+    def __init__(self, max_channels: int = 256, messages_per_channel: int = 50):
+        self.max_channels = max_channels
+        self.messages_per_channel = messages_per_channel
+        self._channels: OrderedDict[int, _ChannelBuffer] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._channels
+
+    def get(self, channel_id: int, count: int) -> list[Message] | None:
+        """Get the last `count` messages of a channel, oldest first. Returns None on a cache miss."""
+
+        buffer = self._channels.get(channel_id)
+        if buffer is None or (len(buffer.entries) < count and not buffer.exhausted):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._channels.move_to_end(channel_id)
+        entries = list(buffer.entries)[-count:] if count > 0 else []
+        return [message for _, message in entries]
+
+    def seed(self, channel_id: int, entries: list[tuple[int, Message]]) -> None:
+        """Fill the cache of a channel with `(message_id, message)` pairs fetched from its history, oldest first."""
+
+        self._channels[channel_id] = _ChannelBuffer(
+            self.messages_per_channel, entries[-self.messages_per_channel :]
+        )
+        self._channels.move_to_end(channel_id)
+        while len(self._channels) > self.max_channels:
+            self._channels.popitem(last=False)
+            self.evictions += 1
+
+    def append(self, channel_id: int, message_id: int, message: Message) -> None:
+        """Add a new message to a channel. Channels that are not cached are ignored, since their history
+        will be fetched (including this message) the next time they are needed."""
+
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        if len(buffer.entries) == buffer.entries.maxlen:
+            buffer.exhausted = False
+        buffer.entries.append((message_id, message))
+        self._channels.move_to_end(channel_id)
+
+    def update(self, channel_id: int, message_id: int, content: str) -> None:
+        """Replace the content of a cached message after it has been edited."""
+
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        for i, (cached_id, message) in enumerate(buffer.entries):
+            if cached_id == message_id:
+                buffer.entries[i] = (cached_id, Message(message.user, content))
+                return
+
+    def remove(self, channel_id: int, message_ids: set[int]) -> None:
+        """Remove deleted messages from a channel."""
+
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        kept = [entry for entry in buffer.entries if entry[0] not in message_ids]
+        if len(kept) != len(buffer.entries):
+            buffer.entries = deque(kept, maxlen=buffer.entries.maxlen)
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing how effective the cache is."""
+
+        lookups = self.hits + self.misses
+        return {
+            "channels": len(self._channels),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
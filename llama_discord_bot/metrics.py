@@ -0,0 +1,273 @@
+import bisect
+import time
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
+from aiohttp import web
+
+# Bucket upper bounds, in seconds, of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{value}"'
+        for name, value in zip(names, [_escape(value) for value in values])
+    )
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: dict[tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects the labels {self.labels}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.TYPE}"
+        yield from self._samples()
+
+
+class Counter(_Metric):
+    """Value that only goes up, like the number of handled events."""
+
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, like latencies, counted in cumulative buckets."""
+
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how many seconds the block takes, even if it raises."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def _samples(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labels + ("le",), key + (_format_value(bound),)
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Metrics:
+    """Registry of metrics, rendered in the Prometheus text format.
+    Besides counters and histograms, collectors expose the `stats()` of the bot's components as gauges.
+    """
+
+    def __init__(self, namespace: str = "llama_discord_bot"):
+        self.namespace = namespace
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: dict[str, Callable[[], dict[str, float]]] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> Counter:
+        return self._register(
+            Counter(f"{self.namespace}_{name}", documentation, labels)
+        )
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(
+            Histogram(f"{self.namespace}_{name}", documentation, labels, buckets)
+        )
+
+    def register_collector(
+        self, name: str, collect: Callable[[], dict[str, float]]
+    ) -> None:
+        """Expose the numeric values returned by `collect` as gauges named after `name` and their keys."""
+
+        self._collectors[name] = collect
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for collector, collect in self._collectors.items():
+            for key, value in collect().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.namespace}_{collector}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves the metrics of a registry over HTTP, at `/metrics`."""
+
+    def __init__(self, registry: Metrics, host: str = "127.0.0.1", port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def _handle(self, _: web.Request) -> web.Response:
+        return web.Response(
+            text=self.registry.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Find out the port if it was picked by the OS
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# Default registry, shared by every component of the bot
+metrics = Metrics()
+
+STAGE_SECONDS = metrics.histogram(
+    "stage_seconds",
+    "Time spent in each stage of handling a Discord event.",
+    ["handler", "stage"],
+)
+EVENTS = metrics.counter(
+    "events_total", "Discord events handled, by outcome.", ["handler", "outcome"]
+)
+ERRORS = metrics.counter(
+    "errors_total",
+    "Errors raised while handling Discord events, by exception type.",
+    ["handler", "type"],
+)
+PROMPT_BUILD_SECONDS = metrics.histogram(
+    "prompt_build_seconds", "Time spent rendering prompts."
+)
+FIRST_TOKEN_SECONDS = metrics.histogram(
+    "first_token_seconds",
+    "Time until the backend generates the first chunk of a response.",
+    ["backend"],
+)
+GENERATION_SECONDS = metrics.histogram(
+    "generation_seconds", "Time spent generating whole responses.", ["backend"]
+)
+TOKENS_PER_SECOND = metrics.histogram(
+    "tokens_per_second",
+    "Generation speed after the first chunk, in chunks (usually tokens) per second.",
+    ["backend"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+PROMPT_TOKENS = metrics.histogram(
+    "prompt_tokens",
+    "Number of tokens of the prompts.",
+    ["backend"],
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+GENERATED_TOKENS = metrics.counter(
+    "generated_tokens_total", "Chunks (usually tokens) generated.", ["backend"]
+)
+SUMMARY_TOKENS_SAVED = metrics.histogram(
+    "summary_tokens_saved",
+    "Prompt tokens saved by replacing older messages with their summary, per request.",
+    buckets=(0, 64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+BACKEND_ERRORS = metrics.counter(
+    "backend_errors_total",
+    "Generations that failed, by exception type.",
+    ["backend", "type"],
+)
+CASCADE_ROUTES = metrics.counter(
+    "cascade_routes_total",
+    "Requests sent to each tier of a model cascade, by the reason they were sent there.",
+    ["tier", "reason"],
+)
+TIER_FIRST_TOKEN_SECONDS = metrics.histogram(
+    "tier_first_token_seconds",
+    "Time until each tier of a model cascade generates the first chunk of a response.",
+    ["tier"],
+)
+RESPONSE_TOKEN_CAPS = metrics.histogram(
+    "response_token_caps",
+    "Length limits of the responses that were shortened because the backend was under load.",
+    buckets=(32, 64, 128, 256, 512, 1024),
+)
+QUOTA_REJECTIONS = metrics.counter(
+    "quota_rejections_total",
+    "Requests rejected for exceeding a quota, by the scope and limit they exceeded.",
+    ["scope", "limit"],
+)
@@ -0,0 +1,168 @@
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from typing import Any
+import discord
+
+
+class _TokenBucket:
+    """Allows `capacity` calls at once, refilled at `capacity / period` calls per second."""
+
+    def __init__(
+        self, capacity: int, period: float, clock: Callable[[], float] = time.monotonic
+    ):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+
+    async def acquire(self) -> float:
+        """Wait for a call to be allowed. Returns how many seconds it waited."""
+
+        waited = 0.0
+        while True:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return waited
+            delay = (1 - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+@dataclass
+class _PendingEdit:
+    message: Any
+    fields: dict[str, Any] = field(default_factory=dict)
+    waiters: list[asyncio.Future] = field(default_factory=list)
+
+
+class OutboundScheduler:
+    """Sends the edits of the bot's messages, merging the content and view changes that are pending for the same
+    message into a single API call. Edits wait `linger` seconds before being sent, so changes made right after
+    each other are merged, and each channel has a token bucket that keeps its edits within Discord's rate limit
+    (`rate_limit` calls every `period` seconds), instead of running into 429 responses.
+    Edits of a message are sent in order, one at a time.
+    """
+
+    def __init__(
+        self,
+        rate_limit: int = 5,
+        period: float = 5.0,
+        linger: float = 0.05,
+        max_buckets: int = 1024,
+    ):
+        self.rate_limit = rate_limit
+        self.period = period
+        self.linger = linger
+        self.max_buckets = max_buckets
+        self._buckets: OrderedDict[int, _TokenBucket] = OrderedDict()
+        self._pending: dict[int, _PendingEdit] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self.edits = 0
+        self.api_calls = 0
+        self.acknowledgements = 0
+        self.failures = 0
+        self.rate_limit_waits = 0
+        self.rate_limit_wait_seconds = 0.0
+
+    def _bucket(self, channel_id: int) -> _TokenBucket:
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = self._buckets[channel_id] = _TokenBucket(
+                self.rate_limit, self.period
+            )
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(channel_id)
+        return bucket
+
+    async def edit(self, message, *, wait: bool = True, **fields):
+        """Edit a message, like `message.edit(**fields)`, merging the change with the pending ones.
+        With `wait`, returns the edited message once the edit is sent, and raises if it fails.
+        Otherwise, returns `message` right away, and failures are only reported."""
+
+        self.edits += 1
+        pending = self._pending.get(message.id)
+        if pending is None:
+            pending = self._pending[message.id] = _PendingEdit(message)
+        pending.message = message
+        pending.fields.update(fields)
+        if message.id not in self._workers:
+            task = asyncio.get_running_loop().create_task(self._send(message.id))
+            self._workers[message.id] = task
+
+        if not wait:
+            return message
+        waiter = asyncio.get_running_loop().create_future()
+        pending.waiters.append(waiter)
+        return await waiter
+
+    async def _send(self, message_id: int) -> None:
+        try:
+            while message_id in self._pending:
+                await asyncio.sleep(self.linger)
+                message = self._pending[message_id].message
+                waited = await self._bucket(message.channel.id).acquire()
+                if waited:
+                    self.rate_limit_waits += 1
+                    self.rate_limit_wait_seconds += waited
+                # Changes made while waiting are part of this edit
+                pending = self._pending.pop(message_id)
+                self.api_calls += 1
+                try:
+                    edited = await pending.message.edit(**pending.fields)
+                except Exception as exception:  # pylint: disable=broad-exception-caught
+                    self.failures += 1
+                    for waiter in pending.waiters:
+                        if not waiter.done():
+                            waiter.set_exception(exception)
+                    if not pending.waiters:
+                        print(
+                            f"Failed to edit a message: {exception.__class__.__name__}: {exception}"
+                        )
+                else:
+                    for waiter in pending.waiters:
+                        if not waiter.done():
+                            waiter.set_result(edited)
+        finally:
+            del self._workers[message_id]
+
+    async def flush(self, message) -> None:
+        """Wait until the pending edits of a message are sent."""
+
+        worker = self._workers.get(getattr(message, "id", None))
+        if worker is not None:
+            await asyncio.shield(worker)
+
+    async def acknowledge(self, interaction: discord.Interaction, **fields) -> None:
+        """Acknowledge a component interaction by editing its message, which takes a single call instead of
+        deferring the interaction and then editing the message. Interaction responses have no channel limit.
+        """
+
+        self.acknowledgements += 1
+        await interaction.response.edit_message(**fields)
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing the edits, and how many API calls merging them saved."""
+
+        return {
+            "edits": self.edits,
+            "api_calls": self.api_calls,
+            "pending": len(self._pending),
+            # Merged edits, and the deferrals that acknowledgements replaced
+            "saved_calls": self.edits
+            - self.api_calls
+            - len(self._pending)
+            + self.acknowledgements,
+            "failures": self.failures,
+            "rate_limit_waits": self.rate_limit_waits,
+            "rate_limit_wait_seconds": self.rate_limit_wait_seconds,
+        }
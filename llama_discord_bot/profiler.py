@@ -0,0 +1,129 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class SlowRequestProfiler:
+    """Opt-in sampling profiler for slow requests. While requests are being profiled, a thread samples the
+    Python stacks of every other thread every `interval` seconds. When a request takes more than `threshold`
+    seconds, the samples taken while it ran are written to `output_dir` as folded stacks (the input of
+    flamegraph.pl and speedscope), or the hottest ones are printed if there is no `output_dir`.
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        interval: float = 0.005,
+        output_dir: str | None = None,
+        max_samples: int = 100_000,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.output_dir = output_dir
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples: list[str] = []
+        # Number of samples dropped from the start of `_samples`, so requests can keep absolute positions
+        self._dropped = 0
+        self._active = 0
+        # Set to stop the sampling thread. Each thread gets its own, since a stopping thread is not waited for
+        self._stop: threading.Event | None = None
+        self.profiled = 0
+        self.slow = 0
+
+    def _sample(self, stop: threading.Event) -> None:
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not stop.wait(self.interval):
+            # pylint: disable=protected-access
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)})"
+                    )
+                    frame = frame.f_back
+                name = names.get(thread_id)
+                if name is None:
+                    names = {
+                        thread.ident: thread.name for thread in threading.enumerate()
+                    }
+                    name = names.get(thread_id, str(thread_id))
+                stacks.append(";".join([name] + stack[::-1]))
+            with self._lock:
+                # Samples taken while stopping belong to no request
+                if stop.is_set():
+                    return
+                if len(self._samples) + len(stacks) <= self.max_samples:
+                    self._samples.extend(stacks)
+
+    def _start(self) -> int:
+        with self._lock:
+            self._active += 1
+            if self._stop is None:
+                self._stop = threading.Event()
+                threading.Thread(
+                    target=self._sample,
+                    args=(self._stop,),
+                    name="profiler",
+                    daemon=True,
+                ).start()
+            return self._dropped + len(self._samples)
+
+    def _finish(self, first: int) -> list[str]:
+        with self._lock:
+            samples = self._samples[first - self._dropped :]
+            self._active -= 1
+            if self._active == 0:
+                self._dropped += len(self._samples)
+                self._samples = []
+                # The thread is not joined, since this runs on the event loop. It exits within an interval
+                self._stop.set()
+                self._stop = None
+        return samples
+
+    @contextmanager
+    def profile(self, name: str):
+        """Profile a request, reporting its samples if it turns out to be slow."""
+
+        first = self._start()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            samples = self._finish(first)
+            self.profiled += 1
+            if duration >= self.threshold:
+                self.slow += 1
+                self._report(name, duration, Counter(samples))
+
+    def _report(self, name: str, duration: float, stacks: Counter) -> None:
+        if self.output_dir is None:
+            print(f"🐢 {name} took {duration:.2f}s. Hottest stacks:")
+            for stack, count in stacks.most_common(5):
+                print(f"  {count} samples: {stack}")
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir,
+            f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{self.slow}.folded",
+        )
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        print(f"🐢 {name} took {duration:.2f}s. Profile written to {path}")
+
+    def stats(self) -> dict[str, int]:
+        """Counters describing the profiled requests."""
+
+        return {"profiled": self.profiled, "slow": self.slow}
@@ -0,0 +1,202 @@
+import functools
+from enum import Enum
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterator
+from dataclasses import dataclass
+from itertools import groupby
+from typing import TypeVar
+from llama_discord_bot.metrics import PROMPT_BUILD_SECONDS
+
+# Parts of a Llama 2 prompt. Their whitespace is part of the prompts the bot has always sent, so it is kept as is
+SEGMENT_TEMPLATE = """<s>
+            [INST]
+            {system_prompt}
+            {user_message}
+            [/INST]
+            {bot_message}
+            </s>"""
+SUFFIX_TEMPLATE = """
+            <s>
+            [INST]
+            {suffix}
+            [/INST]
+            </s>
+            """
+# The markers of the template. A response never contains them, unless the model went on past its turn
+STOP_SEQUENCES = tuple(
+    dict.fromkeys(
+        SEGMENT_TEMPLATE.format(
+            system_prompt="", user_message="", bot_message=""
+        ).split()
+    )
+)
+
+T = TypeVar("T")
+
+
+class ChatUser(Enum):
+    """The possible users of a chat message."""
+
+    AI = "ai"
+    HUMAN = "human"
+    # Context for the model, like a summary of the earlier conversation. It is placed after the system prompt
+    SYSTEM = "system"
+
+
+@dataclass
+class Message:
+    """A message sent by a user or the bot."""
+
+    user: ChatUser
+    content: str
+
+
+class _LRUCache(OrderedDict):
+    """Dictionary that keeps at most `maxsize` items, dropping the least recently used ones."""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_create(self, key: Hashable, create: Callable[[], T]) -> T:
+        if key in self:
+            self.hits += 1
+            self.move_to_end(key)
+            return self[key]
+
+        self.misses += 1
+        value = self[key] = create()
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+        return value
+
+
+class PromptBuilder:
+    """Renders Llama 2 prompts, using the prompting technique from Meta's paper. A good explanation of the
+    technique can be found here: https://huggingface.co/blog/llama2#how-to-prompt-llama-2
+
+    The rendered text of each message pair, of the system prompt and of the suffix is cached (as well as their
+    token IDs, if a `tokenize` function is given), so a conversation that grows by one turn only renders and
+    tokenizes the new turn."""
+
+    def __init__(
+        self,
+        tokenize: Callable[[str], list[int]] | None = None,
+        cache_size: int = 4096,
+    ):
+        self.tokenize = tokenize
+        self._segments = _LRUCache(cache_size)
+        self._tokens = _LRUCache(cache_size)
+
+    def _turns(self, messages: list[Message]) -> Iterator[tuple[str, str]]:
+        """Group messages into (user message, bot message) turns. Consecutive messages from the same author are
+        merged, and a user message is paired with the bot message that follows it, if any.
+        """
+
+        # Merge consecutive messages from the same author, without building new messages
+        merged = [
+            (user, "".join(message.content for message in group))
+            for user, group in groupby(messages, lambda message: message.user)
+        ]
+
+        i = 0
+        while i < len(merged):
+            user, content = merged[i]
+            bot_message = content.strip() if user == ChatUser.AI else ""
+            user_message = content.strip() if user == ChatUser.HUMAN else ""
+
+            # If the next message is from the bot, use its content for the bot message
+            if (
+                user_message
+                and (i + 1 < len(merged))
+                and (merged[i + 1][0] == ChatUser.AI)
+            ):
+                bot_message = merged[i + 1][1].strip()
+
+            yield user_message, bot_message
+
+            i += 1
+            if bot_message and user_message:
+                i += 1  # Skip the bot message, since it was used in this turn
+
+    def _segment_keys(
+        self, messages: list[Message], suffix: str, system_prompt: str
+    ) -> Iterator[tuple[str, ...]]:
+        """Yield the cache keys of the parts of the prompt, in order."""
+
+        conversation = [
+            message for message in messages if message.user != ChatUser.SYSTEM
+        ]
+        if not conversation:
+            raise ValueError("Cannot generate prompt from empty messages list")
+
+        # The system prompt is only added to the first turn, followed by the system messages, if any
+        context = "\n\n".join(
+            message.content.strip()
+            for message in messages
+            if message.user == ChatUser.SYSTEM
+        )
+        if context and system_prompt.strip():
+            system_prompt = system_prompt + "\n\n" + context
+        elif context:
+            system_prompt = context
+        system_block = (
+            ("<<SYS>>" + system_prompt + "<</SYS>>") if system_prompt.strip() else ""
+        )
+        for user_message, bot_message in self._turns(conversation):
+            yield (system_block, user_message, bot_message)
+            system_block = ""
+
+        if suffix:
+            yield (suffix,)
+
+    def _render(self, key: tuple[str, ...]) -> str:
+        def create():
+            if len(key) == 1:
+                return SUFFIX_TEMPLATE.format(suffix=key[0])
+            system_block, user_message, bot_message = key
+            return SEGMENT_TEMPLATE.format(
+                system_prompt=system_block,
+                user_message=user_message,
+                bot_message=bot_message,
+            )
+
+        return self._segments.get_or_create(key, create)
+
+    def build(
+        self, messages: list[Message], suffix: str = "", system_prompt: str = ""
+    ) -> str:
+        """Render the prompt for a list of messages, adding the system prompt and the suffix, if any."""
+
+        with PROMPT_BUILD_SECONDS.time():
+            keys = self._segment_keys(messages, suffix, system_prompt)
+            return "".join([self._render(key) for key in keys]).strip()
+
+    def build_tokens(
+        self, messages: list[Message], suffix: str = "", system_prompt: str = ""
+    ) -> list[int]:
+        """Get the token IDs of the prompt, tokenizing each part separately. Tokens can merge across the
+        boundaries of the parts, so the result can differ slightly from tokenizing the whole prompt.
+        """
+
+        if self.tokenize is None:
+            raise ValueError("A tokenize function is needed to build prompt tokens")
+
+        tokens = []
+        for key in self._segment_keys(messages, suffix, system_prompt):
+            tokenize = functools.partial(self.tokenize, self._render(key).strip())
+            tokens.extend(self._tokens.get_or_create(key, tokenize))
+        return tokens
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing how effective the caches are."""
+
+        return {
+            "segments": len(self._segments),
+            "segment_hits": self._segments.hits,
+            "segment_misses": self._segments.misses,
+            "token_hits": self._tokens.hits,
+            "token_misses": self._tokens.misses,
+        }
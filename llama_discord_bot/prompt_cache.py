@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from collections.abc import Hashable, Sequence
+import diskcache
+from llama_cpp import BaseLlamaCache, Llama, LlamaState
+
+TKey = tuple[Hashable, tuple[int, ...]]
+
+
+class PromptStateCache(BaseLlamaCache):
+    """llama.cpp evaluation state cache keyed by channel and prompt tokens.
+    When a completion starts, the state with the longest token prefix in common with the prompt is restored, so only
+    the new suffix has to be evaluated. States are kept in memory in least recently used order, bounded by
+    `capacity_bytes`, and optionally spilled to disk when evicted instead of being dropped. Set `channel`
+    before each completion, so lookups only consider the states of that channel."""
+
+    def __init__(
+        self,
+        capacity_bytes: int = (2 << 30),
+        disk_path: str | None = None,
+        disk_capacity_bytes: int = (8 << 30),
+    ):
+        super().__init__(capacity_bytes)
+        self.channel: Hashable = None
+        self._states: OrderedDict[TKey, LlamaState] = OrderedDict()
+        self._disk = (
+            diskcache.Cache(
+                disk_path,
+                size_limit=disk_capacity_bytes,
+                eviction_policy="least-recently-used",
+            )
+            if disk_path
+            else None
+        )
+        self.last_prefix_length = 0
+        self.lookups = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.tokens_saved = 0
+        self.tokens_evaluated = 0
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self._states.values())
+
+    def _find_longest_prefix_key(self, key: tuple[int, ...]) -> TKey | None:
+        """Find the key of the state of the current channel with the longest prefix in common with `key`."""
+
+        best_key, best_length = None, 0
+        disk_keys = self._disk.iterkeys() if self._disk is not None else ()
+        for candidate in [*self._states.keys(), *disk_keys]:
+            if candidate[0] != self.channel:
+                continue
+            length = Llama.longest_token_prefix(candidate[1], key)
+            if length > best_length:
+                best_key, best_length = candidate, length
+        self.last_prefix_length = best_length
+        return best_key
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        self.lookups += 1
+        best_key = self._find_longest_prefix_key(tuple(key))
+        if best_key is None:
+            raise KeyError("No cached state shares a prefix with the prompt")
+
+        self.hits += 1
+        if best_key in self._states:
+            self._states.move_to_end(best_key)
+            return self._states[best_key]
+
+        # Promote the state back to memory, since the channel is active again
+        self.disk_hits += 1
+        state = self._disk.pop(best_key)
+        self._store(best_key, state)
+        return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState) -> None:
+        key = tuple(key)
+        # States that are a prefix of the new one are redundant, since the new one can serve all their prompts
+        for existing in list(self._states.keys()):
+            if existing[0] == self.channel and existing[1] == key[: len(existing[1])]:
+                del self._states[existing]
+        self._store((self.channel, key), value)
+
+    def _store(self, key: TKey, state: LlamaState) -> None:
+        """Store a state in memory, evicting (and spilling to disk, if enabled) the least recently used ones."""
+
+        self._states[key] = state
+        self._states.move_to_end(key)
+        while self.cache_size > self.capacity_bytes and self._states:
+            evicted_key, evicted_state = self._states.popitem(last=False)
+            if self._disk is not None:
+                self._disk[evicted_key] = evicted_state
+
+    def record_completion(self, prompt_tokens: int, reused_tokens: int) -> None:
+        """Record how many prompt tokens a completion had and how many of them did not need to be evaluated."""
+
+        self.tokens_saved += reused_tokens
+        self.tokens_evaluated += prompt_tokens - reused_tokens
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing how much prompt evaluation the cache saves."""
+
+        prompt_tokens = self.tokens_saved + self.tokens_evaluated
+        return {
+            "entries": len(self._states),
+            "disk_entries": len(self._disk) if self._disk is not None else 0,
+            "memory_bytes": self.cache_size,
+            "lookups": self.lookups,
+            "prefix_hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "prefix_hit_ratio": self.hits / self.lookups if self.lookups else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "tokens_evaluated": self.tokens_evaluated,
+            "tokens_saved_ratio": (
+                self.tokens_saved / prompt_tokens if prompt_tokens else 0.0
+            ),
+        }
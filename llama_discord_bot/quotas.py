@@ -0,0 +1,166 @@
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+from llama_discord_bot.metrics import QUOTA_REJECTIONS
+
+
+class QuotaExceededError(Exception):
+    """Raised when a request exceeds the quota of its user, guild or channel."""
+
+    def __init__(self, scope: str, limit: str, retry_after: float):
+        super().__init__(
+            f"The {limit} quota of the {scope} is exceeded, retry in {retry_after:.0f}s"
+        )
+        self.scope = scope
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class QuotaLimit:
+    """How many requests, and how many generated tokens, are allowed every `period` seconds. None is unlimited."""
+
+    requests: int | None = None
+    tokens: int | None = None
+    period: float = 60.0
+
+
+class _Bucket:
+    """Token bucket holding up to `capacity`, refilled at `capacity / period` a second.
+    Spending can leave it in debt, since generated tokens are only known afterwards."""
+
+    def __init__(self, capacity: int, period: float, now: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = float(capacity)
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.level
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until `amount` can be taken, after a refill."""
+
+        return max(amount - self.level, 0.0) / self.rate
+
+
+class RequestQuotas:
+    """Token-bucket quotas per user, guild and channel, counting both requests and generated tokens.
+    A request is admitted only if every bucket it falls into has a request left and is not in token debt,
+    so it is checked in memory before any history is fetched or anything is generated. The tokens of the response
+    are charged once it is generated. At most `max_buckets` buckets are kept per scope, dropping the least
+    recently used ones. Users are told about rejections at most once per period of the exceeded quota.
+    """
+
+    SCOPES = ("user", "guild", "channel")
+
+    def __init__(
+        self,
+        user: QuotaLimit | None = None,
+        guild: QuotaLimit | None = None,
+        channel: QuotaLimit | None = None,
+        max_buckets: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limits = {"user": user, "guild": guild, "channel": channel}
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self._buckets: dict[tuple[str, str], OrderedDict[int, _Bucket]] = {
+            (scope, limit): OrderedDict()
+            for scope in self.SCOPES
+            for limit in ("requests", "tokens")
+        }
+        # When each user was last told about exceeding a quota, by scope and limit
+        self._notices: OrderedDict[tuple[int, str, str], float] = OrderedDict()
+        self.admitted = 0
+        self.rejected = 0
+        self.tokens = 0
+        self.silenced = 0
+
+    def _bucket(self, scope: str, limit: str, key: int, now: float) -> _Bucket | None:
+        quota = self.limits[scope]
+        capacity = getattr(quota, limit) if quota is not None else None
+        if capacity is None:
+            return None
+        buckets = self._buckets[scope, limit]
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = _Bucket(capacity, quota.period, now)
+            if len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        buckets.move_to_end(key)
+        bucket.refill(now)
+        return bucket
+
+    def _keys(
+        self, user_id: int, guild_id: int | None, channel_id: int
+    ) -> list[tuple[str, int]]:
+        keys = [("user", user_id), ("channel", channel_id)]
+        if guild_id is not None:
+            keys.append(("guild", guild_id))
+        return keys
+
+    def admit(self, user_id: int, guild_id: int | None, channel_id: int) -> None:
+        """Take a request from the quotas of a user, guild and channel, or raise `QuotaExceededError`."""
+
+        now = self.clock()
+        requests = []
+        for scope, key in self._keys(user_id, guild_id, channel_id):
+            for limit in ("requests", "tokens"):
+                bucket = self._bucket(scope, limit, key, now)
+                if bucket is None:
+                    continue
+                # A request needs a whole request left, and some tokens (its response can go into debt)
+                needed = 1.0 if limit == "requests" else 0.0
+                if bucket.level < needed or bucket.level <= 0:
+                    self.rejected += 1
+                    QUOTA_REJECTIONS.inc(scope=scope, limit=limit)
+                    raise QuotaExceededError(scope, limit, bucket.wait_for(needed))
+                if limit == "requests":
+                    requests.append(bucket)
+        # Nothing is taken unless every quota admits the request
+        for bucket in requests:
+            bucket.level -= 1
+        self.admitted += 1
+
+    def charge(
+        self, user_id: int, guild_id: int | None, channel_id: int, tokens: int
+    ) -> None:
+        """Charge the tokens generated for a request to the quotas of its user, guild and channel."""
+
+        now = self.clock()
+        self.tokens += tokens
+        for scope, key in self._keys(user_id, guild_id, channel_id):
+            bucket = self._bucket(scope, "tokens", key, now)
+            if bucket is not None:
+                bucket.level -= tokens
+
+    def notify(self, user_id: int, exception: QuotaExceededError) -> bool:
+        """Whether to tell a user about a rejection, so someone spamming past a quota is answered once per
+        period of the quota instead of once per message."""
+
+        now = self.clock()
+        key = (user_id, exception.scope, exception.limit)
+        last = self._notices.get(key)
+        if last is not None and now - last < self.limits[exception.scope].period:
+            self.silenced += 1
+            return False
+        self._notices[key] = now
+        self._notices.move_to_end(key)
+        if len(self._notices) > self.max_buckets:
+            self._notices.popitem(last=False)
+        return True
+
+    def stats(self) -> dict[str, int]:
+        """Counters describing the load admitted and rejected by the quotas."""
+
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "silenced": self.silenced,
+            "tokens": self.tokens,
+            "buckets": sum(len(buckets) for buckets in self._buckets.values()),
+        }
@@ -0,0 +1,233 @@
+"""Replays a trace recorded by the bot (see TRACE_PATH) with a fake Discord, against a simulated backend or a real one,
+and reports latencies and throughput like the benchmark. Run it with `python -m llama_discord_bot.replay --help`."""
+
+import argparse
+import asyncio
+import json
+import time
+from contextvars import ContextVar
+from llama_discord_bot.backends import BackendBuilder
+from llama_discord_bot.benchmark import (
+    Request,
+    TimedLlama,
+    format_report,
+    on_bot_message,
+    summarize,
+    track,
+)
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import (
+    FakeChannel,
+    FakeDiscord,
+    FakeGuild,
+    FakeLlama,
+    FakeMessage,
+    FakeUser,
+)
+from llama_discord_bot.llama import LlamaBase
+from llama_discord_bot.traces import CONTINUE, MESSAGE, REWRITE, read_trace
+
+# The traced message the bot is answering, so its replayed response can be clicked later
+_current_source: ContextVar[int | None] = ContextVar("current_source", default=None)
+
+FILLER = "lorem ipsum dolor sit amet "
+
+
+def _content(size: int | None) -> str:
+    """Text of the same size as a traced message."""
+
+    size = max(size or 0, 1)
+    return (FILLER * (size // len(FILLER) + 1))[:size]
+
+
+async def run_replay(
+    path: str,
+    speed: float = 1.0,
+    llama: LlamaBase | None = None,
+    response_tokens: int = 64,
+    token_latency: float = 0.01,
+    first_token_latency: float = 0.0,
+    concurrency: int = 1,
+    queue_size: int = 32,
+) -> dict[str, object]:
+    """Post the messages and button clicks of a trace at the times they were recorded, `speed` times faster,
+    and wait for the bot to handle all of them. Without `llama`, responses are simulated by a `FakeLlama`.
+    Clicks on responses that were not replayed (like the ones of messages rejected in this run) are skipped.
+    """
+
+    events = list(read_trace(path))
+    if llama is None:
+        llama = FakeLlama(
+            DiscordBot.SYSTEM_PROMPT,
+            response_tokens=response_tokens,
+            token_latency=token_latency,
+            first_token_latency=first_token_latency,
+            max_concurrency=concurrency,
+        )
+    llama = TimedLlama(llama)
+    bot = DiscordBot(
+        local=False,
+        discord_api_token=None,
+        llama=llama,
+        inference_queue_size=queue_size,
+    )
+    responses: dict[int, FakeMessage] = {}
+
+    def on_message_sent(message: FakeMessage) -> None:
+        on_bot_message(message)
+        source = _current_source.get()
+        if source is not None and message.view is not None:
+            responses[source] = message
+
+    fake_discord = FakeDiscord(bot, channels=0, on_bot_message=on_message_sent)
+    channels: dict[int, FakeChannel] = {}
+    users: dict[int, FakeUser] = {}
+    requests: list[Request] = []
+    handlers: list[asyncio.Task] = []
+    # Latest handler of each traced message or of a click on its response, by the pseudonym of the message
+    message_handlers: dict[int, asyncio.Task] = {}
+    skipped = 0
+
+    async def handle(request: Request, task: asyncio.Task) -> None:
+        await asyncio.gather(task, return_exceptions=True)
+        request.done = time.monotonic()
+
+    async def click(
+        kind: str,
+        channel: FakeChannel,
+        user: FakeUser,
+        source: int,
+        handler: asyncio.Task | None,
+    ):
+        nonlocal skipped
+        # Replaying faster, a click can come before the response it clicks (or an earlier click on it) is done,
+        # so it waits for it
+        if handler is not None:
+            await asyncio.gather(handler, return_exceptions=True)
+        response = responses.get(source)
+        if response is None:
+            skipped += 1
+            return
+        request = Request(kind, channel.id, time.monotonic())
+        requests.append(request)
+        track(request)
+        _current_source.set(None)
+        await handle(request, fake_discord.click(response, f"{kind}_response", user))
+
+    start = time.monotonic()
+    for event in events:
+        delay = start + (event.time - events[0].time) / speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        channel = channels.get(event.channel)
+        if channel is None:
+            channel = channels[event.channel] = FakeChannel(
+                next(fake_discord.ids),
+                fake_discord,
+                FakeGuild(event.guild) if event.guild is not None else None,
+            )
+            fake_discord.channels.append(channel)
+        user = users.get(event.user)
+        if user is None and event.user is not None:
+            user = users[event.user] = FakeUser(event.user, f"user{len(users)}")
+
+        if event.kind == MESSAGE:
+            request = Request("message", channel.id, time.monotonic())
+            requests.append(request)
+            track(request)
+            _current_source.set(event.message)
+            task = fake_discord.send_message(channel, user, _content(event.size))
+            handler = asyncio.create_task(handle(request, task))
+            message_handlers[event.message] = handler
+            handlers.append(handler)
+        elif event.kind in {CONTINUE, REWRITE}:
+            kind = "continue" if event.kind == CONTINUE else "rewrite"
+            handler = asyncio.create_task(
+                click(
+                    kind,
+                    channel,
+                    user,
+                    event.message,
+                    message_handlers.get(event.message),
+                )
+            )
+            message_handlers[event.message] = handler
+            handlers.append(handler)
+        # Responses are generated again, so only the requests are replayed
+
+    await asyncio.gather(*handlers)
+    await fake_discord.drain()
+    elapsed = time.monotonic() - start
+
+    report = summarize(requests, max(elapsed, 1e-9), llama.tokens)
+    report["trace"] = {
+        "events": len(events),
+        "seconds": events[-1].time - events[0].time if events else 0.0,
+        "speed": speed,
+        "channels": len(channels),
+        "users": len(users),
+        "skipped_clicks": skipped,
+    }
+    report["scheduler"] = bot.scheduler.stats()
+    report["generations"] = bot.generations.stats()
+    return report
+
+
+async def _replay_with_backend(args: dict) -> dict[str, object]:
+    """Replay against the backend given in the arguments, or a simulated one."""
+
+    local_model_path = args.pop("local_model_path")
+    replicate_model = args.pop("replicate_model")
+    inference_servers = args.pop("inference_servers")
+    if not (local_model_path or replicate_model or inference_servers):
+        return await run_replay(**args)
+
+    builder = BackendBuilder(DiscordBot.SYSTEM_PROMPT)
+    llama = builder.build(
+        bool(local_model_path),
+        local_model_path=local_model_path,
+        replicate_model=replicate_model,
+        inference_servers=inference_servers,
+    )
+    try:
+        # Loading the model is not part of the replay
+        await asyncio.gather(*[loader.start() for loader in builder.loaders(llama)])
+        return await run_replay(llama=llama, **args)
+    finally:
+        await builder.close()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="Trace file")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="How many times faster to replay"
+    )
+    parser.add_argument("--response-tokens", type=int, default=64)
+    parser.add_argument(
+        "--token-latency", type=float, default=0.01, help="Seconds per token"
+    )
+    parser.add_argument("--first-token-latency", type=float, default=0.0)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Concurrent generations of the simulated backend",
+    )
+    parser.add_argument("--queue-size", type=int, default=32)
+    parser.add_argument("--local-model-path", help="Replay against a local model")
+    parser.add_argument("--replicate-model", help="Replay against a replicate model")
+    parser.add_argument(
+        "--inference-servers", help="Replay against comma-separated inference servers"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = vars(parser.parse_args(argv))
+    as_json = args.pop("json")
+
+    report = asyncio.run(_replay_with_backend(args))
+    print(json.dumps(report, indent=2) if as_json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import asyncio
+import os
+from collections.abc import AsyncIterator
+import aiohttp
+
+
+class ReplicateError(Exception):
+    """Raised when a replicate request or prediction fails."""
+
+
+class ReplicateClient:
+    """Asynchronous client for the replicate HTTP API.
+    Requests share a keep-alive session, and failed requests are retried with exponential backoff: reads on
+    rate limits and server errors, writes only on rate limits, so a prediction is never created twice.
+    Predictions are polled, yielding their output as it grows, and cancelled remotely when abandoned.
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    FINISHED_STATUSES = frozenset({"succeeded", "failed", "canceled"})
+
+    def __init__(
+        self,
+        api_token: str | None = None,
+        base_url: str | None = None,
+        poll_interval: float = 0.5,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        max_connections: int = 16,
+        timeout: float = 30.0,
+    ):
+        self.api_token = api_token or os.environ.get("REPLICATE_API_TOKEN")
+        self.base_url = base_url or os.environ.get(
+            "REPLICATE_API_BASE_URL", "https://api.replicate.com"
+        )
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._session: aiohttp.ClientSession | None = None
+        # Cancellations of abandoned predictions, which run in the background
+        self._cancellations: set[asyncio.Task] = set()
+        self.predictions = 0
+        self.retries = 0
+        self.failures = 0
+        self.cancellations = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Get the shared session, creating it in the running event loop the first time."""
+
+        if self._session is None or self._session.closed:
+            headers = {"User-Agent": "llama-discord-bot"}
+            if self.api_token:
+                headers["Authorization"] = f"Token {self.api_token}"
+            self._session = aiohttp.ClientSession(
+                headers=headers,
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def _request(self, method: str, path: str, body: dict | None = None) -> dict:
+        retry_statuses = self.RETRY_STATUSES if method == "GET" else {429}
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                async with self._get_session().request(
+                    method, self.base_url + path, json=body
+                ) as response:
+                    if response.status < 400:
+                        return await response.json()
+                    if (
+                        response.status not in retry_statuses
+                        or attempt == self.max_retries
+                    ):
+                        raise ReplicateError(await self._error_detail(response))
+                    retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exception:
+                # A write may have reached the server before the connection broke, so only reads are retried
+                if method != "GET" or attempt == self.max_retries:
+                    raise ReplicateError(
+                        f"{method} {path} failed: {exception!r}"
+                    ) from exception
+
+            self.retries += 1
+            delay = self.backoff * 2**attempt
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    async def _error_detail(response: aiohttp.ClientResponse) -> str:
+        try:
+            return (await response.json())["detail"]
+        except (aiohttp.ContentTypeError, ValueError, KeyError, TypeError):
+            return f"HTTP error: {response.status} {response.reason}"
+
+    async def create_prediction(self, model: str, input_data: dict) -> dict:
+        """Start a prediction. `model` is either `owner/name:version` or `owner/name`, for official models."""
+
+        self.predictions += 1
+        if ":" in model:
+            version = model.split(":", 1)[1]
+            body = {"version": version, "input": input_data}
+            return await self._request("POST", "/v1/predictions", body)
+        return await self._request(
+            "POST", f"/v1/models/{model}/predictions", {"input": input_data}
+        )
+
+    async def get_prediction(self, prediction_id: str) -> dict:
+        return await self._request("GET", f"/v1/predictions/{prediction_id}")
+
+    async def cancel_prediction(self, prediction_id: str) -> dict:
+        self.cancellations += 1
+        return await self._request("POST", f"/v1/predictions/{prediction_id}/cancel")
+
+    async def _cancel_in_background(self, prediction_id: str) -> None:
+        try:
+            await self.cancel_prediction(prediction_id)
+        except ReplicateError as exception:
+            print(f"Could not cancel prediction {prediction_id}: {exception}")
+
+    async def stream(self, model: str, input_data: dict) -> AsyncIterator[str]:
+        """Run a prediction, yielding its output chunks as they are generated.
+        If the stream is closed or cancelled before the prediction finishes, the prediction is cancelled.
+        """
+
+        prediction = await self.create_prediction(model, input_data)
+        sent = 0
+        try:
+            while True:
+                output = prediction.get("output") or []
+                if isinstance(output, str):
+                    output = [output]
+                for chunk in output[sent:]:
+                    yield chunk
+                sent = len(output)
+
+                if prediction["status"] in self.FINISHED_STATUSES:
+                    break
+                await asyncio.sleep(self.poll_interval)
+                prediction = await self.get_prediction(prediction["id"])
+        finally:
+            if prediction["status"] not in self.FINISHED_STATUSES:
+                # Cancelling in the background does not delay the cancellation of the caller
+                task = asyncio.get_running_loop().create_task(
+                    self._cancel_in_background(prediction["id"])
+                )
+                self._cancellations.add(task)
+                task.add_done_callback(self._cancellations.discard)
+
+        if prediction["status"] != "succeeded":
+            self.failures += 1
+            raise ReplicateError(
+                f"Prediction {prediction['id']} {prediction['status']}: "
+                f"{prediction.get('error')}"
+            )
+
+    async def close(self) -> None:
+        """Wait for pending cancellations and close the session."""
+
+        if self._cancellations:
+            await asyncio.gather(*self._cancellations)
+        if self._session is not None:
+            await self._session.close()
+
+    def stats(self) -> dict[str, int]:
+        """Counters describing the requests made to replicate."""
+
+        return {
+            "predictions": self.predictions,
+            "retries": self.retries,
+            "failures": self.failures,
+            "cancellations": self.cancellations,
+        }
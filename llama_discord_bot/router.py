@@ -0,0 +1,294 @@
+import asyncio
+import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaBase, Message
+from llama_discord_bot.loader import BackendLoadingError
+
+
+class NoBackendAvailableError(Exception):
+    """Raised when every backend of a router is failing."""
+
+
+class CircuitBreaker:
+    """Stops sending requests to a backend after `failure_threshold` consecutive failures.
+    Once `reset_timeout` seconds have passed, requests are let through again, and the first
+    result decides whether the breaker closes or stays open for another `reset_timeout`.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or (
+            self.opened_at is None and self.failures >= self.failure_threshold
+        ):
+            self.opened_at = self.clock()
+            self.trips += 1
+
+
+class _Replica:
+    """A backend of a router, and what the router has observed of it."""
+
+    def __init__(self, llama: LlamaBase, overflow: bool, breaker: CircuitBreaker):
+        self.llama = llama
+        self.overflow = overflow
+        self.breaker = breaker
+        self.in_flight = 0
+        # Exponentially weighted moving average of the seconds until the first chunk
+        self.latency: float | None = None
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def ready(self) -> bool:
+        # Backends that load in the background are skipped until they are ready
+        return getattr(self.llama, "ready", True)
+
+    @property
+    def saturated(self) -> bool:
+        return self.in_flight >= self.llama.MAX_CONCURRENCY
+
+    def observe_latency(self, seconds: float, alpha: float) -> None:
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = alpha * seconds + (1 - alpha) * self.latency
+
+    def expected_wait(self) -> float:
+        """Latency the next request can expect, given the requests already running.
+        Backends that have not been measured yet are tried first."""
+
+        return (self.latency or 0.0) * (self.in_flight + 1) / self.llama.MAX_CONCURRENCY
+
+
+class LlamaRouter(LlamaBase):
+    """Spreads generations over several backends, like local model instances and replicate.
+    Each request goes to the backend with the lowest expected wait, based on its running requests and on
+    the moving average of its time to first chunk. `overflow` backends are only used while the others are
+    saturated or failing. A backend never runs more than its `MAX_CONCURRENCY` generations: when every ready
+    backend is saturated, requests wait for one of them. Backends that keep failing are skipped by a circuit
+    breaker, and a request whose backend fails before producing any text is transparently retried on another one.
+    """
+
+    def __init__(
+        self,
+        backends: list[LlamaBase],
+        system_prompt: str = "",
+        *,
+        overflow: list[LlamaBase] | None = None,
+        alpha: float = 0.3,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(system_prompt)
+        overflow = overflow or []
+        assert backends, "A router needs at least one backend"
+        self.replicas = [
+            _Replica(
+                llama,
+                llama in overflow,
+                CircuitBreaker(failure_threshold, reset_timeout, clock),
+            )
+            for llama in backends + overflow
+        ]
+        self.alpha = alpha
+        self.clock = clock
+        # pylint: disable=invalid-name
+        self.MAX_CONCURRENCY = sum(
+            llama.MAX_CONCURRENCY for llama in backends + overflow
+        )
+        self.CONTEXT_WINDOW = min(llama.CONTEXT_WINDOW for llama in backends + overflow)
+        self.failovers = 0
+        # Requests waiting for a saturated backend to finish a generation
+        self._capacity_waiters: list[asyncio.Future] = []
+
+    @property
+    def name(self) -> str:
+        return "+".join(replica.llama.name for replica in self.replicas)
+
+    def count_tokens(self, text: str) -> int:
+        # Every backend uses the same prompt format, so the first one measures them all
+        return self.replicas[0].llama.count_tokens(text)
+
+    def resolve_config(
+        self, config: GenerationConfig | None = None
+    ) -> GenerationConfig:
+        return self.replicas[0].llama.resolve_config(config)
+
+    def _choose(self, tried: set[_Replica]) -> _Replica | None:
+        candidates = [
+            replica
+            for replica in self.replicas
+            if replica not in tried and replica.breaker.allow()
+        ]
+        # Prefer backends that are ready with free capacity, keeping overflow backends last. Backends that are
+        # still loading are only tried when none is ready, so the request learns that they are loading
+        for available in [
+            lambda replica: replica.ready
+            and not replica.saturated
+            and not replica.overflow,
+            lambda replica: replica.ready and not replica.saturated,
+            lambda replica: not replica.ready and not self._busy(tried),
+        ]:
+            preferred = [replica for replica in candidates if available(replica)]
+            if preferred:
+                return min(preferred, key=lambda replica: replica.expected_wait())
+        return None
+
+    def _busy(self, tried: set[_Replica]) -> bool:
+        """Whether a backend that was not tried yet is ready, but saturated."""
+
+        return any(
+            replica.ready and replica.saturated
+            for replica in self.replicas
+            if replica not in tried and replica.breaker.allow()
+        )
+
+    async def _wait_for_capacity(self) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._capacity_waiters.append(future)
+        try:
+            await future
+        finally:
+            if future in self._capacity_waiters:
+                self._capacity_waiters.remove(future)
+
+    def _release(self, replica: _Replica) -> None:
+        replica.in_flight -= 1
+        # Every waiter chooses again, since the one that was freed may not be the best for all of them
+        waiters, self._capacity_waiters = self._capacity_waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        chunks = self.stream_response(
+            messages=messages,
+            suffix=suffix,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            rewrite=rewrite,
+            config=config,
+        )
+        return "".join([chunk async for chunk in chunks])
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        tried: set[_Replica] = set()
+        error: Exception | None = None
+        while True:
+            replica = self._choose(tried)
+            if replica is None and self._busy(tried):
+                # Running another generation on a saturated backend would go over what it supports
+                await self._wait_for_capacity()
+                continue
+            if replica is None:
+                if error is not None:
+                    raise error
+                raise NoBackendAvailableError("Every backend is failing")
+            tried.add(replica)
+            replica.requests += 1
+            replica.in_flight += 1
+            start = self.clock()
+            started = False
+            try:
+                async with aclosing(
+                    replica.llama.stream_response(
+                        messages=messages,
+                        suffix=suffix,
+                        channel_id=channel_id,
+                        guild_id=guild_id,
+                        rewrite=rewrite,
+                        config=config,
+                    )
+                ) as chunks:
+                    async for chunk in chunks:
+                        if not started:
+                            started = True
+                            replica.observe_latency(self.clock() - start, self.alpha)
+                        yield chunk
+            except BackendLoadingError as exception:
+                # Not a failure of the backend, it is just not ready yet
+                error = exception
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                replica.failures += 1
+                replica.breaker.record_failure()
+                # Text was already sent to the user, so another backend cannot take over
+                if started:
+                    raise
+                error = exception
+                self.failovers += 1
+                print(
+                    f"🔀 {replica.llama.name} failed ({exception.__class__.__name__}: {exception}), failing over"
+                )
+            else:
+                replica.breaker.record_success()
+                return
+            finally:
+                self._release(replica)
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters of the router and of each of its backends, numbered in the order they were given."""
+
+        stats = {"failovers": self.failovers}
+        for i, replica in enumerate(self.replicas):
+            stats.update(
+                {
+                    f"backend{i}_in_flight": replica.in_flight,
+                    f"backend{i}_latency_seconds": replica.latency or 0.0,
+                    f"backend{i}_requests": replica.requests,
+                    f"backend{i}_failures": replica.failures,
+                    f"backend{i}_circuit_open": int(replica.breaker.state == "open"),
+                    f"backend{i}_circuit_trips": replica.breaker.trips,
+                }
+            )
+            if hasattr(replica.llama, "stats"):
+                for key, value in replica.llama.stats().items():
+                    stats[f"backend{i}_{key}"] = value
+        return stats
@@ -1,17 +1,95 @@
 import asyncio
+import threading
 from typing import TypeVar
-from collections.abc import Callable, Awaitable
+from collections.abc import Callable, Awaitable, Iterator, AsyncIterator
 import functools
 
 
 T = TypeVar("T")
 
 
-def run_async(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
-    """Decorator to run a synchronous function in a separate thread, making it awaitable."""
+def run_async(
+    func: Callable[..., T] | None = None, *, stop_keyword: str | None = None
+) -> Callable[..., Awaitable[T]]:
+    """Decorator to run a synchronous function in a separate thread, making it awaitable.
+    If `stop_keyword` is given, the function gets a `threading.Event` as that keyword argument, which is set
+    when the caller is cancelled. The cancellation then waits for the function to return, so whatever it
+    uses is free once the cancellation is over."""
+
+    if func is None:
+        return functools.partial(run_async, stop_keyword=stop_keyword)
+
+    if stop_keyword is None:
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+        return wrapper
+
+    @functools.wraps(func)
+    async def stoppable_wrapper(*args, **kwargs):
+        stopped = kwargs[stop_keyword] = threading.Event()
+        call = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+        try:
+            return await asyncio.shield(call)
+        except asyncio.CancelledError:
+            stopped.set()
+            await asyncio.wait([call])
+            raise
+
+    return stoppable_wrapper
+
+
+def run_async_iter(
+    func: Callable[..., Iterator[T]] | None = None, *, stop_keyword: str | None = None
+) -> Callable[..., AsyncIterator[T]]:
+    """Decorator to run a synchronous generator in a separate thread, making it an async iterator.
+    Items are handed over to the event loop as soon as they are produced. If the consumer stops iterating,
+    the generator is closed after the item it is currently producing. If `stop_keyword` is given,
+    the event that signals it is also passed to the generator as that keyword argument,
+    so it can stop while producing an item."""
+
+    if func is None:
+        return functools.partial(run_async_iter, stop_keyword=stop_keyword)
 
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        return await asyncio.to_thread(func, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stopped = threading.Event()
+        done = object()
+        if stop_keyword is not None:
+            kwargs[stop_keyword] = stopped
+
+        def produce():
+            iterator = None
+            try:
+                iterator = func(*args, **kwargs)
+                for item in iterator:
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+                    if stopped.is_set():
+                        break
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                loop.call_soon_threadsafe(queue.put_nowait, (done, exception))
+                return
+            finally:
+                if hasattr(iterator, "close"):
+                    iterator.close()
+            loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+
+        producer = asyncio.ensure_future(asyncio.to_thread(produce))
+        try:
+            while True:
+                item, exception = await queue.get()
+                if item is done:
+                    if exception is not None:
+                        raise exception
+                    break
+                yield item
+        finally:
+            stopped.set()
+            # Wait for the thread to finish, so whatever it uses is free once the iteration is over
+            await asyncio.shield(producer)
 
     return wrapper
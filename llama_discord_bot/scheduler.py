@@ -0,0 +1,236 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing, asynccontextmanager
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaBase, Message
+
+
+class SchedulerBusyError(Exception):
+    """Raised when a request cannot be queued because the scheduler queue is full."""
+
+
+class InferenceScheduler:
+    """Limits how many generations run at the same time on a backend.
+    Requests that cannot run right away wait in a bounded queue, and are served in round-robin order across guilds,
+    and across the channels of each guild, so a single busy channel cannot starve the others.
+    When the queue is full, new requests are rejected with `SchedulerBusyError` instead of waiting.
+    """
+
+    def __init__(self, max_concurrency: int = 1, max_queue: int = 32):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.queued = 0
+        # Waiters, grouped by guild and channel. The first guild (and channel) is the next one to be served
+        self._waiters: OrderedDict[
+            int | None, OrderedDict[int | None, deque[asyncio.Future]]
+        ] = OrderedDict()
+        self._wait_times: deque[float] = deque(maxlen=1024)
+        self.admitted = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        # Called whenever a request has to wait, so optional work can make room for it
+        self._contention_callbacks: list[Callable[[], None]] = []
+
+    @property
+    def idle(self) -> bool:
+        """Whether nothing is running or waiting."""
+
+        return self.running == 0 and self.queued == 0
+
+    @property
+    def available(self) -> bool:
+        """Whether a new request would start right away."""
+
+        return self.running < self.max_concurrency and self.queued == 0
+
+    @property
+    def load(self) -> float:
+        """How full the queue would be with one more request, from 0 (it would start right away) to 1."""
+
+        waiting = self.queued + (0 if self.available else 1)
+        if self.max_queue == 0:
+            return float(waiting > 0)
+        return min(waiting / self.max_queue, 1.0)
+
+    def on_contention(self, callback: Callable[[], None]) -> None:
+        """Call `callback` whenever a request has to wait for a slot."""
+
+        self._contention_callbacks.append(callback)
+
+    @asynccontextmanager
+    async def slot(self, channel_id: int | None = None, guild_id: int | None = None):
+        """Wait for a free slot for a channel, holding it until the context exits."""
+
+        await self._acquire(channel_id, guild_id)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, channel_id: int | None, guild_id: int | None) -> None:
+        start = time.monotonic()
+        if self.running < self.max_concurrency and self.queued == 0:
+            self.running += 1
+            self._admit(start)
+            return
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerBusyError("The inference queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        channels = self._waiters.setdefault(guild_id, OrderedDict())
+        channels.setdefault(channel_id, deque()).append(future)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        for callback in self._contention_callbacks:
+            callback()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over right before the cancellation, so give it to the next waiter
+                self._release()
+            else:
+                self._remove_waiter(future, channel_id, guild_id)
+            raise
+        self._admit(start)
+
+    def _admit(self, start: float) -> None:
+        self.admitted += 1
+        self._wait_times.append(time.monotonic() - start)
+
+    def _release(self) -> None:
+        self.running -= 1
+        while self.running < self.max_concurrency and self.queued > 0:
+            self.queued -= 1
+            self.running += 1
+            self._next_waiter().set_result(None)
+
+    def _next_waiter(self) -> asyncio.Future:
+        """Pop the next waiter, rotating guilds and channels so they are served in round-robin order."""
+
+        guild_id, channels = next(iter(self._waiters.items()))
+        channel_id, waiters = next(iter(channels.items()))
+        future = waiters.popleft()
+
+        if waiters:
+            channels.move_to_end(channel_id)
+        else:
+            del channels[channel_id]
+        if channels:
+            self._waiters.move_to_end(guild_id)
+        else:
+            del self._waiters[guild_id]
+        return future
+
+    def _remove_waiter(
+        self, future: asyncio.Future, channel_id: int | None, guild_id: int | None
+    ) -> None:
+        channels = self._waiters[guild_id]
+        channels[channel_id].remove(future)
+        self.queued -= 1
+        if not channels[channel_id]:
+            del channels[channel_id]
+        if not channels:
+            del self._waiters[guild_id]
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing the load of the scheduler."""
+
+        wait_times = sorted(self._wait_times)
+        return {
+            "running": self.running,
+            "queue_depth": self.queued,
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_seconds_mean": (
+                sum(wait_times) / len(wait_times) if wait_times else 0.0
+            ),
+            "wait_seconds_p95": (
+                wait_times[int(len(wait_times) * 0.95)] if wait_times else 0.0
+            ),
+            "wait_seconds_max": wait_times[-1] if wait_times else 0.0,
+        }
+
+
+class ScheduledLlama(LlamaBase):
+    """Wraps a backend so its generations go through an `InferenceScheduler`.
+    The number of concurrent generations defaults to what the backend supports."""
+
+    def __init__(
+        self, llama: LlamaBase, max_concurrency: int | None = None, max_queue: int = 32
+    ):
+        super().__init__(llama.system_prompt)
+        self.llama = llama
+        self.scheduler = InferenceScheduler(
+            max_concurrency=max_concurrency or llama.MAX_CONCURRENCY,
+            max_queue=max_queue,
+        )
+
+    @property
+    def name(self) -> str:
+        return self.llama.name
+
+    def count_tokens(self, text: str) -> int:
+        return self.llama.count_tokens(text)
+
+    def resolve_config(
+        self, config: GenerationConfig | None = None
+    ) -> GenerationConfig:
+        return self.llama.resolve_config(config)
+
+    def select_context(
+        self, messages: list[Message], suffix: str = "", max_tokens: int | None = None
+    ) -> list[Message]:
+        return self.llama.select_context(messages, suffix, max_tokens)
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        async with self.scheduler.slot(channel_id=channel_id, guild_id=guild_id):
+            return await self.llama.generate_response(
+                messages=messages,
+                suffix=suffix,
+                channel_id=channel_id,
+                guild_id=guild_id,
+                rewrite=rewrite,
+                config=config,
+            )
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        async with self.scheduler.slot(channel_id=channel_id, guild_id=guild_id):
+            # The inner stream is closed explicitly, so the backend is free once the slot is released
+            async with aclosing(
+                self.llama.stream_response(
+                    messages=messages,
+                    suffix=suffix,
+                    channel_id=channel_id,
+                    guild_id=guild_id,
+                    rewrite=rewrite,
+                    config=config,
+                )
+            ) as chunks:
+                async for chunk in chunks:
+                    yield chunk
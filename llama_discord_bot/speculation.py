@@ -0,0 +1,243 @@
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaBase, Message
+from llama_discord_bot.scheduler import InferenceScheduler
+
+
+@dataclass(eq=False)
+class _Speculation:
+    channel_id: int
+    # The messages the continuation was generated for. It is only valid while they do not change
+    messages: list[Message]
+    parts: list[str] = field(default_factory=list)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    task: asyncio.Task | None = None
+    done: bool = False
+    # Claimed speculations are serving a click, so they are real requests and are not preempted
+    claimed: bool = False
+
+
+class ContinuationSpeculator:
+    """Generates the continuation of a response right after it is sent, while the backend has a free slot,
+    so clicking 'Continue response' can be answered right away. Continuations are kept by response message
+    ID, at most `max_entries` of them, and are only served if the conversation has not changed since.
+    Speculative generations stop as soon as a real request has to wait for the backend, a new message
+    arrives in their channel, or they use up the budget of `token_budget` tokens every `budget_period` seconds.
+    """
+
+    def __init__(
+        self,
+        llama: LlamaBase,
+        scheduler: InferenceScheduler,
+        suffix: str,
+        max_entries: int = 64,
+        token_budget: int = 2048,
+        budget_period: float = 60.0,
+    ):
+        self.llama = llama
+        self.scheduler = scheduler
+        self.suffix = suffix
+        self.max_entries = max_entries
+        self.token_budget = token_budget
+        self.budget_period = budget_period
+        self._speculations: OrderedDict[int, _Speculation] = OrderedDict()
+        self._budget_start = time.monotonic()
+        self._spent = 0
+        self.started = 0
+        self.served = 0
+        self.discarded = 0
+        self.preempted = 0
+        self.wasted_tokens = 0
+        scheduler.on_contention(self._preempt)
+
+    def _budget_left(self) -> int:
+        now = time.monotonic()
+        if now - self._budget_start >= self.budget_period:
+            self._budget_start = now
+            self._spent = 0
+        return self.token_budget - self._spent
+
+    @property
+    def _running(self) -> int:
+        return sum(
+            1
+            for speculation in self._speculations.values()
+            if not speculation.done and not speculation.claimed
+        )
+
+    def can_start(self) -> bool:
+        """Whether a speculation would start now: the backend is free, no other one is running,
+        and there is budget left."""
+
+        return (
+            self.scheduler.available and self._running == 0 and self._budget_left() > 0
+        )
+
+    def start(
+        self,
+        response_id: int,
+        messages: list[Message],
+        channel_id: int,
+        guild_id: int | None = None,
+        config: GenerationConfig | None = None,
+    ) -> bool:
+        """Start generating the continuation of a response, if possible, with the generation settings
+        a click would use. Returns whether it started."""
+
+        existing = self._speculations.get(response_id)
+        if not self.can_start() or (existing is not None and existing.claimed):
+            return False
+        self._discard(response_id)
+        speculation = _Speculation(channel_id, messages)
+        speculation.task = asyncio.get_running_loop().create_task(
+            self._generate(speculation, guild_id, config)
+        )
+        self._speculations[response_id] = speculation
+        unclaimed = [
+            kept_id for kept_id, kept in self._speculations.items() if not kept.claimed
+        ]
+        for kept_id in unclaimed[: max(len(self._speculations) - self.max_entries, 0)]:
+            self._discard(kept_id)
+        self.started += 1
+        return True
+
+    async def _generate(
+        self,
+        speculation: _Speculation,
+        guild_id: int | None,
+        config: GenerationConfig | None,
+    ) -> None:
+        chunks = self.llama.stream_response(
+            messages=speculation.messages,
+            suffix=self.suffix,
+            channel_id=speculation.channel_id,
+            guild_id=guild_id,
+            config=config,
+        )
+        try:
+            async with aclosing(chunks):
+                async for chunk in chunks:
+                    speculation.parts.append(chunk)
+                    speculation.changed.set()
+                    if not speculation.claimed:
+                        self._spent += 1
+                        if self._budget_left() <= 0:
+                            # Running out of budget leaves an incomplete continuation, which is useless
+                            self._drop(speculation)
+                            return
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            if speculation.claimed:
+                raise
+            self._drop(speculation)
+            print(
+                f"Failed to generate a continuation: {exception.__class__.__name__}: {exception}"
+            )
+        finally:
+            speculation.done = True
+            speculation.changed.set()
+
+    def _drop(self, speculation: _Speculation) -> None:
+        for response_id, kept in list(self._speculations.items()):
+            if kept is speculation:
+                del self._speculations[response_id]
+        self.discarded += 1
+        self.wasted_tokens += len(speculation.parts)
+
+    def _discard(self, response_id: int) -> None:
+        speculation = self._speculations.get(response_id)
+        # Claimed speculations belong to the click serving them, which removes them once it is done
+        if speculation is None or speculation.claimed:
+            return
+        del self._speculations[response_id]
+        if not speculation.done:
+            speculation.task.cancel()
+        self.discarded += 1
+        self.wasted_tokens += len(speculation.parts)
+
+    def _preempt(self) -> None:
+        """Stop the speculations that are running, since a real request is waiting."""
+
+        for response_id, speculation in list(self._speculations.items()):
+            if not speculation.done and not speculation.claimed:
+                self.preempted += 1
+                self._discard(response_id)
+
+    def discard(self, response_id: int) -> None:
+        """Throw away the continuation of a response, like after the response is rewritten."""
+
+        self._discard(response_id)
+
+    def invalidate(self, channel_id: int) -> None:
+        """Throw away the continuations of a channel, since a new message makes them out of date."""
+
+        for response_id, speculation in list(self._speculations.items()):
+            if speculation.channel_id == channel_id:
+                self._discard(response_id)
+
+    def take(
+        self, response_id: int, messages: list[Message]
+    ) -> AsyncIterator[str] | None:
+        """Claim the continuation of a response, if there is one for these messages. Returns its chunks,
+        which follow the generation if it is still running, or None if there is no valid continuation.
+        """
+
+        speculation = self._speculations.get(response_id)
+        if speculation is None or speculation.claimed:
+            return None
+        if speculation.messages != messages:
+            self._discard(response_id)
+            return None
+        speculation.claimed = True
+        self.served += 1
+        return self._follow(response_id, speculation)
+
+    async def _follow(
+        self, response_id: int, speculation: _Speculation
+    ) -> AsyncIterator[str]:
+        shown = 0
+        try:
+            while True:
+                speculation.changed.clear()
+                while shown < len(speculation.parts):
+                    yield speculation.parts[shown]
+                    shown += 1
+                if speculation.done:
+                    break
+                await speculation.changed.wait()
+            # Failures of a claimed generation are raised to the click that claimed it
+            await speculation.task
+        finally:
+            if self._speculations.get(response_id) is speculation:
+                del self._speculations[response_id]
+            if not speculation.done:
+                speculation.task.cancel()
+
+    async def close(self) -> None:
+        """Cancel the speculations that are running."""
+
+        tasks = [
+            speculation.task
+            for speculation in self._speculations.values()
+            if not speculation.done
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing how many continuations were generated ahead of time, and how many were used."""
+
+        return {
+            "entries": len(self._speculations),
+            "started": self.started,
+            "served": self.served,
+            "discarded": self.discarded,
+            "preempted": self.preempted,
+            "wasted_tokens": self.wasted_tokens,
+            "budget_left": max(self._budget_left(), 0),
+        }
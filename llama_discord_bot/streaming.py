@@ -0,0 +1,69 @@
+import time
+from contextlib import aclosing
+from collections.abc import AsyncIterator, Awaitable, Callable
+from typing import Any
+
+TSend = Callable[[str], Awaitable[Any]]
+TEdit = Callable[[Any, str], Awaitable[Any]]
+
+# Longest content Discord accepts in a message
+MAX_MESSAGE_LENGTH = 2000
+# Posted when a response has no visible text, since Discord does not allow sending empty messages
+EMPTY_RESPONSE = "*(empty response)*"
+
+
+async def stream_to_message(
+    chunks: AsyncIterator[str],
+    send: TSend,
+    edit: TEdit,
+    min_edit_interval: float = 1.0,
+    max_length: int = MAX_MESSAGE_LENGTH,
+) -> tuple[Any, str]:
+    """Post a streamed response as soon as its first visible chunk arrives, and progressively edit it
+    as more chunks come in. Edits are throttled to at most one every `min_edit_interval` seconds so they stay
+    within Discord's rate limits, and a last edit makes sure the final content is shown.
+    Responses are cut at `max_length` characters, closing the stream there, so the user can continue them.
+    A response without visible text is posted as `EMPTY_RESPONSE`.
+    Returns the (last edited) message and its full content."""
+
+    parts: list[str] = []
+    length = 0
+    shown = 0
+    visible = False
+    message = None
+    last_edit = 0.0
+
+    # Close the stream even if sending fails, so the generation does not keep running
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            full = length + len(chunk) > max_length
+            if full:
+                chunk = chunk[: max_length - length]
+                if not chunk:
+                    break
+            parts.append(chunk)
+            length += len(chunk)
+            # Discord does not allow sending empty messages
+            visible = visible or bool(chunk.strip())
+            if full:
+                break
+            if not visible:
+                continue
+
+            if message is None:
+                message = await send("".join(parts))
+            elif time.monotonic() - last_edit >= min_edit_interval:
+                message = await edit(message, "".join(parts)) or message
+            else:
+                continue
+            shown = len(parts)
+            last_edit = time.monotonic()
+
+    content = "".join(parts)
+    if message is None:
+        content = content if visible else EMPTY_RESPONSE
+        message = await send(content)
+    elif shown != len(parts):
+        message = await edit(message, content) or message
+
+    return message, content
@@ -0,0 +1,198 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import ChatUser, LlamaBase, Message
+from llama_discord_bot.metrics import SUMMARY_TOKENS_SAVED
+from llama_discord_bot.scheduler import InferenceScheduler
+
+SUMMARY_PROMPT = """Write a short summary of the conversation below, keeping the names, facts, decisions and open questions that could matter later. Reply with the summary only.
+
+{conversation}"""
+SUMMARY_CONTEXT = "Summary of the earlier conversation: {summary}"
+
+
+@dataclass
+class _Summary:
+    text: str
+    # The last messages the summary covers, to find where it ends in the history of the channel
+    tail: list[Message]
+
+
+class ConversationSummarizer:
+    """Keeps a rolling summary of the older messages of each channel, so prompts stay about the same length
+    while the conversation grows. The latest `keep_messages` messages are sent as they are, and the ones
+    before them are replaced by a summary, given to the model as a system message.
+    Once `min_messages` older messages are not covered by the summary, it is refreshed in the background,
+    from the previous summary and those messages, as soon as the scheduler has a free slot. A refresh only
+    covers the oldest messages that fit in `context_window`, leaving the rest to the next refreshes.
+    """
+
+    def __init__(
+        self,
+        llama: LlamaBase,
+        scheduler: InferenceScheduler,
+        keep_messages: int = 8,
+        min_messages: int = 4,
+        max_summary_tokens: int = 256,
+        max_channels: int = 1024,
+        idle_poll_interval: float = 0.25,
+        context_window: int | None = None,
+    ):
+        self.llama = llama
+        self.scheduler = scheduler
+        self.keep_messages = keep_messages
+        self.min_messages = min_messages
+        self.max_summary_tokens = max_summary_tokens
+        self.context_window = context_window or llama.CONTEXT_WINDOW
+        self.max_channels = max_channels
+        self.idle_poll_interval = idle_poll_interval
+        self._summaries: OrderedDict[int, _Summary] = OrderedDict()
+        self._tasks: dict[int, asyncio.Task] = {}
+        self.refreshes = 0
+        self.failures = 0
+        self.summarized_requests = 0
+        self.tokens_saved = 0
+
+    @staticmethod
+    def _find_end(messages: list[Message], tail: list[Message]) -> int | None:
+        """Index right after the last occurrence of `tail` in `messages`, or None if it is not there."""
+
+        for end in range(len(messages), len(tail) - 1, -1):
+            if messages[end - len(tail) : end] == tail:
+                return end
+        return None
+
+    def apply(self, channel_id: int, messages: list[Message]) -> list[Message]:
+        """Replace the messages of a channel covered by its summary with the summary, and schedule a refresh
+        of the summary if enough messages are not covered by it."""
+
+        summary = self._summaries.get(channel_id)
+        start = 0
+        if summary is not None:
+            self._summaries.move_to_end(channel_id)
+            end = self._find_end(messages, summary.tail)
+            if end is None:
+                # The history changed (or moved on) too much, so the summary starts over
+                del self._summaries[channel_id]
+                summary = None
+            else:
+                start = end
+
+        uncovered = messages[start : max(len(messages) - self.keep_messages, start)]
+        if len(uncovered) >= self.min_messages:
+            self._schedule_refresh(channel_id, summary, uncovered)
+
+        if summary is None:
+            return messages
+        summarized = [
+            Message(ChatUser.SYSTEM, SUMMARY_CONTEXT.format(summary=summary.text))
+        ] + messages[start:]
+        saved = self.llama.count_prompt_tokens(
+            messages
+        ) - self.llama.count_prompt_tokens(summarized)
+        self.summarized_requests += 1
+        self.tokens_saved += saved
+        SUMMARY_TOKENS_SAVED.observe(max(saved, 0))
+        return summarized
+
+    def _schedule_refresh(
+        self, channel_id: int, summary: _Summary | None, messages: list[Message]
+    ) -> None:
+        if channel_id in self._tasks:
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._refresh(channel_id, summary, messages)
+        )
+        self._tasks[channel_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(channel_id, None))
+
+    @staticmethod
+    def _summary_prompt(summary: _Summary | None, lines: list[str]) -> Message:
+        conversation = "\n".join(lines)
+        if summary is not None:
+            conversation = f"Summary so far: {summary.text}\n\n{conversation}"
+        return Message(ChatUser.HUMAN, SUMMARY_PROMPT.format(conversation=conversation))
+
+    def _fit(self, summary: _Summary | None, messages: list[Message]) -> list[str]:
+        """Lines of the oldest messages that fit in the context window, next to the previous summary and
+        room for the new one. A first message too long to fit on its own is cut."""
+
+        budget = (
+            self.context_window
+            - self.max_summary_tokens
+            - self.llama.count_prompt_tokens([self._summary_prompt(summary, [])])
+        )
+        lines = []
+        for message in messages:
+            line = f"{'Assistant' if message.user == ChatUser.AI else 'User'}: {message.content.strip()}"
+            tokens = self.llama.count_tokens(line + "\n")
+            if tokens > budget:
+                if lines:
+                    break
+                while line and tokens > max(budget, 0):
+                    line = line[: len(line) * max(budget, 0) // (tokens + 1)]
+                    tokens = self.llama.count_tokens(line + "\n")
+                return [line]
+            budget -= tokens
+            lines.append(line)
+        return lines
+
+    async def _refresh(
+        self, channel_id: int, summary: _Summary | None, messages: list[Message]
+    ) -> None:
+        # Summaries are not urgent, so they wait until they would not delay any response
+        while not self.scheduler.available:
+            await asyncio.sleep(self.idle_poll_interval)
+
+        lines = self._fit(summary, messages)
+        # The messages that did not fit are left uncovered, so the next request schedules another refresh
+        messages = messages[: len(lines)]
+        try:
+            text = await self.llama.generate_response(
+                [self._summary_prompt(summary, lines)],
+                config=GenerationConfig(max_tokens=self.max_summary_tokens),
+            )
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            self.failures += 1
+            print(
+                f"Failed to summarize a conversation: {exception.__class__.__name__}: {exception}"
+            )
+            return
+
+        # Summaries are bounded by `max_summary_tokens`, so prompts stay about the same length however long
+        # the conversation is
+        text = text.strip()
+        if self._summaries.get(channel_id) is not summary:
+            # Another refresh replaced the summary in the meantime
+            return
+        self._summaries[channel_id] = _Summary(text, messages[-2:])
+        self._summaries.move_to_end(channel_id)
+        while len(self._summaries) > self.max_channels:
+            self._summaries.popitem(last=False)
+        self.refreshes += 1
+
+    async def close(self) -> None:
+        """Cancel the refreshes that are waiting or running."""
+
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing the summaries and how many prompt tokens they saved."""
+
+        return {
+            "channels": len(self._summaries),
+            "refreshing": len(self._tasks),
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "summarized_requests": self.summarized_requests,
+            "tokens_saved": self.tokens_saved,
+            "tokens_saved_per_request": (
+                self.tokens_saved / self.summarized_requests
+                if self.summarized_requests
+                else 0.0
+            ),
+        }
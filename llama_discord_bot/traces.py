@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import time
+from collections.abc import Iterator
+from dataclasses import astuple, dataclass
+
+# Kinds of trace events
+MESSAGE = "m"
+RESPONSE = "r"
+CONTINUE = "c"
+REWRITE = "w"
+
+
+@dataclass
+class TraceEvent:
+    """An event of a trace. IDs are pseudonyms, and only the sizes of messages are kept, not their content.
+    `message` is the ID of the message for messages, and the ID of the message being answered for responses
+    and button clicks, which are attributed to the user that clicked."""
+
+    time: float
+    kind: str
+    channel: int
+    guild: int | None = None
+    user: int | None = None
+    message: int | None = None
+    size: int | None = None
+
+
+class TraceRecorder:
+    """Appends the events the bot handles to a trace file, one JSON array per line, in the field order of
+    `TraceEvent`. IDs are replaced by keyed hashes, so traces can be shared without revealing who said what,
+    while events of the same channel, user or message can still be told apart. Writes are buffered, and
+    flushed at most every `flush_interval` seconds.
+    """
+
+    def __init__(
+        self, path: str, salt: bytes | None = None, flush_interval: float = 1.0
+    ):
+        self.path = path
+        # Without a fixed salt, the pseudonyms of each run are unrelated
+        self.salt = salt or os.urandom(16)
+        self.flush_interval = flush_interval
+        # pylint: disable-next=consider-using-with
+        self._file = open(path, "a", encoding="utf-8")
+        self._flushed = time.monotonic()
+        self.events = 0
+
+    def _pseudonym(self, value: int | None) -> int | None:
+        if value is None:
+            return None
+        digest = hashlib.blake2b(
+            value.to_bytes(8, "big"), key=self.salt, digest_size=6
+        ).digest()
+        return int.from_bytes(digest, "big")
+
+    def _write(
+        self,
+        kind: str,
+        channel_id: int,
+        guild_id: int | None,
+        user_id: int | None,
+        message_id: int | None,
+        size: int | None,
+    ) -> None:
+        event = TraceEvent(
+            round(time.time(), 3),
+            kind,
+            self._pseudonym(channel_id),
+            self._pseudonym(guild_id),
+            self._pseudonym(user_id),
+            self._pseudonym(message_id),
+            size,
+        )
+        self._file.write(json.dumps(astuple(event), separators=(",", ":")) + "\n")
+        self.events += 1
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self._file.flush()
+            self._flushed = time.monotonic()
+
+    def message(
+        self,
+        channel_id: int,
+        guild_id: int | None,
+        user_id: int,
+        message_id: int,
+        size: int,
+    ) -> None:
+        """Record a message sent to the bot."""
+
+        self._write(MESSAGE, channel_id, guild_id, user_id, message_id, size)
+
+    def response(
+        self, channel_id: int, guild_id: int | None, message_id: int, size: int
+    ) -> None:
+        """Record the size of the response to a message."""
+
+        self._write(RESPONSE, channel_id, guild_id, None, message_id, size)
+
+    def click(
+        self,
+        kind: str,
+        channel_id: int,
+        guild_id: int | None,
+        user_id: int,
+        message_id: int,
+    ) -> None:
+        """Record a click of 'Continue response' (`CONTINUE`) or 'Rewrite response' (`REWRITE`) on the response
+        to a message."""
+
+        self._write(kind, channel_id, guild_id, user_id, message_id, None)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def stats(self) -> dict[str, int]:
+        return {"events": self.events}
+
+
+def read_trace(path: str) -> Iterator[TraceEvent]:
+    """Read the events of a trace file, skipping a last line left incomplete by a crash."""
+
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                yield TraceEvent(*json.loads(line))
+            except (ValueError, TypeError):
+                continue
@@ -1,6 +1,7 @@
 from typing import Callable
 from enum import Enum
 import discord
+from llama_discord_bot.outbound import OutboundScheduler
 
 TCallback = Callable[[discord.Interaction], None]
 
@@ -14,7 +15,9 @@ class ButtonState(Enum):
 
 
 class BotResponseView(discord.ui.View):
-    """A view for the bot response message. Contains buttons to continue or rewrite the response."""
+    """A view for the bot response message. Contains buttons to continue or rewrite the response.
+    With an `outbound` scheduler, the button changes are merged with the other edits of the message.
+    """
 
     # Button labels and styles
     BUTTONS = {
@@ -30,10 +33,16 @@ class BotResponseView(discord.ui.View):
         },
     }
 
-    def __init__(self, on_continue_response: TCallback, on_rewrite_response: TCallback):
+    def __init__(
+        self,
+        on_continue_response: TCallback,
+        on_rewrite_response: TCallback,
+        outbound: OutboundScheduler | None = None,
+    ):
         super().__init__()
         self._on_continue_response = on_continue_response
         self._on_rewrite_response = on_rewrite_response
+        self._outbound = outbound
 
     async def _transition_button_state(
         self,
@@ -54,7 +63,13 @@ class BotResponseView(discord.ui.View):
             button.label = self.BUTTONS[button.custom_id]["label"]
 
         # This is necessary to 'refresh' the view so the button state changes are reflected
-        await interaction.message.edit(view=self)
+        if self._outbound is None:
+            await interaction.message.edit(view=self)
+        elif state == ButtonState.LOADING and not interaction.response.is_done():
+            # Acknowledge the click and show the loading state with a single call
+            await self._outbound.acknowledge(interaction, view=self)
+        else:
+            await self._outbound.edit(interaction.message, view=self)
 
     @discord.ui.button(
         label=BUTTONS["continue_response"]["label"],
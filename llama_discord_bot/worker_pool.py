@@ -0,0 +1,403 @@
+import asyncio
+import multiprocessing
+import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing
+from multiprocessing.connection import Connection
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import ChatUser, LlamaBase, Message
+from llama_discord_bot.loader import BackendLoadingError
+
+
+class WorkerError(Exception):
+    """Raised when a worker process fails to generate a response."""
+
+
+def _worker_main(
+    backend_factory: Callable[[], LlamaBase],
+    connection: Connection,
+    warmup_prompt: str | None,
+):
+    """Entry point of a worker process. Loads (and warms up) the backend and serves requests one at a time."""
+
+    llama = backend_factory()
+    if warmup_prompt:
+        asyncio.run(_warmup(llama, warmup_prompt))
+    connection.send(("ready", None))
+    asyncio.run(_serve(llama, connection))
+
+
+async def _warmup(llama: LlamaBase, prompt: str):
+    # Evaluating the prompt is what touches every weight, so there is no need to generate a whole response
+    async with aclosing(
+        llama.stream_response([Message(ChatUser.HUMAN, prompt)])
+    ) as chunks:
+        async for _ in chunks:
+            break
+
+
+async def _serve(llama: LlamaBase, connection: Connection):
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            connection.send(("pong", None))
+            continue
+        if request == "cancel":
+            # The request being cancelled already finished
+            continue
+
+        try:
+            async with aclosing(llama.stream_response(**request)) as chunks:
+                async for chunk in chunks:
+                    connection.send(("chunk", chunk))
+                    # Stop generating if the parent abandoned the request
+                    if connection.poll() and connection.recv() == "cancel":
+                        break
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            connection.send(("error", f"{exception.__class__.__name__}: {exception}"))
+        else:
+            connection.send(("done", None))
+
+
+class _Worker:
+    """Parent side of a worker process."""
+
+    def __init__(
+        self,
+        context,
+        backend_factory: Callable[[], LlamaBase],
+        warmup_prompt: str | None = None,
+    ):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(backend_factory, child_connection, warmup_prompt),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        self.responses: asyncio.Queue | None = None
+        self.pong: asyncio.Event | None = None
+        self.ready = False
+        self.exited = False
+        self.last_channel: int | None = None
+        self.requests = 0
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Start reading the responses of the worker from the event loop."""
+
+        self.responses = asyncio.Queue()
+        self.pong = asyncio.Event()
+        loop.add_reader(self.connection.fileno(), self._on_readable)
+
+    def _on_readable(self) -> None:
+        try:
+            kind, payload = self.connection.recv()
+        except (EOFError, OSError):
+            # The process died, so stop reading and fail whatever request is running
+            self.exited = True
+            asyncio.get_running_loop().remove_reader(self.connection.fileno())
+            self.responses.put_nowait(("error", "The worker process exited"))
+            return
+        if kind == "ready":
+            self.ready = True
+        elif kind == "pong":
+            self.pong.set()
+        else:
+            self.responses.put_nowait((kind, payload))
+
+    @property
+    def alive(self) -> bool:
+        return not self.exited and self.process.is_alive()
+
+    def stop(self) -> asyncio.Future:
+        """Kill the process. It is joined in a thread, so a process slow to exit does not block the event loop.
+        Returns the future of the join."""
+
+        loop = asyncio.get_running_loop()
+        try:
+            loop.remove_reader(self.connection.fileno())
+        except (OSError, ValueError):
+            pass
+        self.process.kill()
+        self.connection.close()
+        return loop.run_in_executor(None, self.process.join)
+
+
+class LlamaWorkerPool(LlamaBase):
+    """Runs a backend in several worker processes, so generations run in parallel and do not compete with the
+    bot for the GIL. Each worker builds its own backend with `backend_factory`, which must be picklable.
+    For llama.cpp models, workers map the same model file, so its pages are shared through the page cache.
+    Requests are sent to idle workers over pipes, preferring the worker that last served the same channel,
+    so it can reuse its evaluation state. Workers are restarted when they die or stop answering pings.
+    Like `BackgroundLoadedLlama`, the pool is a loader: `start` loads the tokenizer given by `tokenizer` in a
+    thread and waits for a worker to be ready (workers evaluate `warmup_prompt` first). Until then, token counts
+    are estimated, and requests wait for a worker (with `wait`) or raise `BackendLoadingError`.
+    """
+
+    def __init__(
+        self,
+        backend_factory: Callable[[], LlamaBase],
+        workers: int,
+        system_prompt: str = "",
+        name: str | None = None,
+        count_tokens: Callable[[str], int] | None = None,
+        context_window: int = LlamaBase.CONTEXT_WINDOW,
+        health_check_interval: float = 10.0,
+        health_check_timeout: float = 5.0,
+        generation_config: GenerationConfig | None = None,
+        tokenizer: Callable[[], Callable[[str], int]] | None = None,
+        warmup_prompt: str | None = None,
+        wait: bool = True,
+        poll_interval: float = 0.05,
+    ):
+        super().__init__(
+            system_prompt,
+            count_tokens=count_tokens,
+            generation_config=generation_config,
+        )
+        # pylint: disable=invalid-name
+        self.MAX_CONCURRENCY = workers
+        self.CONTEXT_WINDOW = context_window
+        self.backend_factory = backend_factory
+        self._name = name
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.tokenizer = tokenizer
+        self.warmup_prompt = warmup_prompt
+        self.wait = wait
+        self.poll_interval = poll_interval
+        # Spawned processes do not inherit the threads (and locks) of the bot
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [
+            _Worker(self._context, backend_factory, warmup_prompt)
+            for _ in range(workers)
+        ]
+        self._task: asyncio.Task | None = None
+        self.load_seconds: float | None = None
+        self._idle: list[_Worker] = []
+        self._condition: asyncio.Condition | None = None
+        self._health_check_task: asyncio.Task | None = None
+        self.restarts = 0
+        self.affinity_hits = 0
+        self.cancelled = 0
+
+    @property
+    def name(self) -> str:
+        """The name of the backend run by the workers, if given."""
+
+        return self._name or type(self).__name__
+
+    @property
+    def ready(self) -> bool:
+        """Whether a worker is ready to generate."""
+
+        return any(worker.ready and worker.alive for worker in self._workers)
+
+    def start(self) -> asyncio.Task:
+        """Start the workers, and load the tokenizer. Returns the task that finishes once a worker is ready."""
+
+        self._ensure_started()
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._load())
+        return self._task
+
+    async def _load(self) -> None:
+        start = time.perf_counter()
+        if self.tokenizer is not None:
+            self._count_tokens = await asyncio.to_thread(self.tokenizer)
+            # Forget the counts that were estimated until now
+            self._token_counts.clear()
+        while not self.ready:
+            await asyncio.sleep(self.poll_interval)
+        self.load_seconds = time.perf_counter() - start
+        print(f"🦙 Model loaded in a worker process in {self.load_seconds:.2f}s")
+
+    def _ensure_started(self) -> None:
+        """Attach the workers to the running event loop the first time they are used."""
+
+        if self._condition is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._condition = asyncio.Condition()
+        for worker in self._workers:
+            worker.attach(loop)
+        self._idle = list(self._workers)
+        self._health_check_task = loop.create_task(self._health_check_loop())
+
+    async def _acquire_worker(self, channel_id: int | None) -> _Worker:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._idle)
+            worker = next(
+                (
+                    worker
+                    for worker in self._idle
+                    if channel_id is not None and worker.last_channel == channel_id
+                ),
+                None,
+            )
+            if worker is not None:
+                self.affinity_hits += 1
+            else:
+                # Workers that are still loading (or restarting) only take requests when no other is idle
+                worker = next(
+                    (worker for worker in self._idle if worker.ready), self._idle[0]
+                )
+            self._idle.remove(worker)
+        worker.last_channel = channel_id
+        worker.requests += 1
+        return worker
+
+    async def _release_worker(self, worker: _Worker) -> None:
+        async with self._condition:
+            if worker in self._workers:
+                self._idle.append(worker)
+                self._condition.notify()
+
+    def _restart_worker(self, worker: _Worker) -> _Worker:
+        worker.stop()
+        replacement = _Worker(self._context, self.backend_factory, self.warmup_prompt)
+        replacement.attach(asyncio.get_running_loop())
+        self._workers[self._workers.index(worker)] = replacement
+        self.restarts += 1
+        return replacement
+
+    async def _drain(self, worker: _Worker) -> None:
+        """Cancel an abandoned request, and wait for it to stop before giving the worker to someone else."""
+
+        if worker.alive:
+            self.cancelled += 1
+            try:
+                worker.connection.send("cancel")
+            except OSError:
+                pass
+        while True:
+            kind, _ = await worker.responses.get()
+            if kind == "error" and not worker.alive:
+                await self._release_worker(self._restart_worker(worker))
+                return
+            if kind in {"done", "error"}:
+                await self._release_worker(worker)
+                return
+
+    async def _health_check_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for worker in list(self._workers):
+                if not worker.alive:
+                    await self._replace(worker)
+                elif worker.ready and worker in self._idle:
+                    worker.pong.clear()
+                    worker.connection.send(None)
+                    try:
+                        await asyncio.wait_for(
+                            worker.pong.wait(), self.health_check_timeout
+                        )
+                    except asyncio.TimeoutError:
+                        await self._replace(worker)
+
+    async def _replace(self, worker: _Worker) -> None:
+        """Restart a dead or hung worker. Busy workers are replaced when their request fails."""
+
+        async with self._condition:
+            if worker not in self._idle:
+                return
+            self._idle.remove(worker)
+        await self._release_worker(self._restart_worker(worker))
+
+    async def generate_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> str:
+        """Generate a response in one of the worker processes."""
+
+        chunks = self.stream_response(
+            messages=messages,
+            suffix=suffix,
+            channel_id=channel_id,
+            guild_id=guild_id,
+            rewrite=rewrite,
+            config=config,
+        )
+        return "".join([chunk async for chunk in chunks])
+
+    async def stream_response(
+        self,
+        messages: list[Message],
+        suffix: str = "",
+        *,
+        channel_id: int | None = None,
+        guild_id: int | None = None,
+        rewrite: bool = False,
+        config: GenerationConfig | None = None,
+    ) -> AsyncIterator[str]:
+        """Stream a response generated in one of the worker processes."""
+
+        self._ensure_started()
+        if not self.wait and not self.ready:
+            raise BackendLoadingError("The model is still loading")
+        worker = await self._acquire_worker(channel_id)
+        if not worker.alive:
+            worker = self._restart_worker(worker)
+        finished = False
+        try:
+            worker.connection.send(
+                {
+                    "messages": messages,
+                    "suffix": suffix,
+                    "channel_id": channel_id,
+                    "guild_id": guild_id,
+                    "rewrite": rewrite,
+                    "config": config,
+                }
+            )
+            while True:
+                kind, payload = await worker.responses.get()
+                if kind == "chunk":
+                    yield payload
+                    continue
+                finished = True
+                if kind == "error":
+                    if not worker.alive:
+                        worker = self._restart_worker(worker)
+                    raise WorkerError(payload)
+                return
+        finally:
+            if finished:
+                await self._release_worker(worker)
+            else:
+                asyncio.get_running_loop().create_task(self._drain(worker))
+
+    async def close(self) -> None:
+        """Stop the health checks and the worker processes, waiting for them to exit."""
+
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+        if self._task is not None:
+            self._task.cancel()
+        workers, self._workers, self._idle = self._workers, [], []
+        await asyncio.gather(*[worker.stop() for worker in workers])
+
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing the state of the workers."""
+
+        return {
+            "workers": len(self._workers),
+            "alive": sum(worker.alive for worker in self._workers),
+            "ready": sum(worker.ready for worker in self._workers),
+            "load_seconds": self.load_seconds or 0.0,
+            "idle": len(self._idle),
+            "restarts": self.restarts,
+            "affinity_hits": self.affinity_hits,
+            "cancelled": self.cancelled,
+            "requests": sum(worker.requests for worker in self._workers),
+        }
@@ -1,6 +1,107 @@
+import asyncio
+import json
 import os
+import sys
 from dotenv import load_dotenv
-from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.backends import BackendBuilder
+from llama_discord_bot.discord_bot import DiscordBot, ShardedDiscordBot
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.inference_server import InferenceServer
+from llama_discord_bot.quotas import QuotaLimit
+
+
+def get_int_env(name: str, default: int | None = None) -> int | None:
+    """Reads an integer environment variable, falling back to `default` if it is not set."""
+
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def get_bool_env(name: str, default: bool = False) -> bool:
+    """Reads a boolean environment variable, like 'true' or '0', falling back to `default` if it is not set."""
+
+    value = os.environ.get(name)
+    return value.lower() in {"1", "true", "yes"} if value else default
+
+
+def get_quota_env(scope: str) -> QuotaLimit | None:
+    """Reads the requests and tokens a minute allowed for a scope, like 'USER', if either is set."""
+
+    requests = get_int_env(f"QUOTA_{scope}_REQUESTS")
+    tokens = get_int_env(f"QUOTA_{scope}_TOKENS")
+    if requests is None and tokens is None:
+        return None
+    return QuotaLimit(requests=requests, tokens=tokens)
+
+
+def get_generation_env() -> GenerationConfig | None:
+    """Reads the default generation settings of the backend, if any is set."""
+
+    stop = os.environ.get("GENERATION_STOP")
+    config = GenerationConfig.from_dict(
+        {
+            "max_tokens": get_int_env("GENERATION_MAX_TOKENS"),
+            "temperature": os.environ.get("GENERATION_TEMPERATURE") or None,
+            "top_p": os.environ.get("GENERATION_TOP_P") or None,
+            "stop": [sequence for sequence in stop.split(",") if sequence]
+            if stop
+            else None,
+        }
+    )
+    return config if config.to_dict() else None
+
+
+def get_guild_generation_env() -> dict[int, GenerationConfig]:
+    """Reads the generation settings of each guild, given as JSON by guild ID."""
+
+    value = os.environ.get("GUILD_GENERATION_CONFIGS")
+    return {
+        int(guild_id): GenerationConfig.from_dict(config)
+        for guild_id, config in (json.loads(value) if value else {}).items()
+    }
+
+
+def get_backend_env(modes: set[str]) -> dict:
+    """Reads the configuration of the backend, for `BackendBuilder.build`."""
+
+    mode = os.environ["MODE"].lower()
+    assert (
+        mode in modes
+    ), f"Invalid mode: {mode}. Must be one of {', '.join(sorted(modes)).upper()}."
+    if mode == "remote":
+        assert os.environ.get(
+            "INFERENCE_SERVERS"
+        ), "INFERENCE_SERVERS must be set when running through inference servers"
+
+    return {
+        "local": mode == "local",
+        "replicate_model": os.environ.get("REPLICATE_MODEL"),
+        "local_model_path": os.environ.get("LOCAL_MODEL_PATH"),
+        "local_state_cache_dir": os.environ.get("LOCAL_STATE_CACHE_DIR") or None,
+        "local_workers": get_int_env("LOCAL_WORKERS", 1),
+        "local_use_mmap": get_bool_env("LOCAL_USE_MMAP", True),
+        "local_use_mlock": get_bool_env("LOCAL_USE_MLOCK"),
+        "local_warmup_prompt": os.environ.get("LOCAL_WARMUP_PROMPT") or None,
+        "wait_for_model": get_bool_env("WAIT_FOR_MODEL"),
+        "tokenizer_model_path": os.environ.get("TOKENIZER_MODEL_PATH") or None,
+        "inference_servers": (
+            os.environ.get("INFERENCE_SERVERS") if mode == "remote" else None
+        ),
+        "inference_server_concurrency": get_int_env("INFERENCE_SERVER_CONCURRENCY"),
+        "small_local_model_path": os.environ.get("SMALL_LOCAL_MODEL_PATH") or None,
+        "small_replicate_model": os.environ.get("SMALL_REPLICATE_MODEL") or None,
+        "cascade_max_easy_tokens": get_int_env("CASCADE_MAX_EASY_TOKENS", 48),
+        "cascade_max_easy_turns": get_int_env("CASCADE_MAX_EASY_TURNS", 8),
+        "cascade_keywords": (
+            tuple(
+                keyword.strip()
+                for keyword in os.environ["CASCADE_KEYWORDS"].split(",")
+                if keyword.strip()
+            )
+            if os.environ.get("CASCADE_KEYWORDS")
+            else None
+        ),
+    }
 
 
 def bootstrap():
@@ -8,23 +109,111 @@ def bootstrap():
 
     load_dotenv()
 
-    mode = os.environ["MODE"].lower()
-    assert mode in {
-        "local",
-        "replicate",
-    }, f"Invalid mode: {mode}. Must be 'LOCAL' or 'REPLICATE'."
-
-    replicate_model = os.environ.get("REPLICATE_MODEL")
-    local_model_path = os.environ.get("LOCAL_MODEL_PATH")
+    backend_env = get_backend_env({"local", "replicate", "remote"})
+    generation_config = get_generation_env()
+    min_response_tokens = get_int_env("MIN_RESPONSE_TOKENS")
     discord_api_token = os.environ.get("DISCORD_API_TOKEN")
+    shard_count = os.environ.get("SHARD_COUNT")
+    shard_ids = os.environ.get("SHARD_IDS")
+    context_tokens = get_int_env("CONTEXT_TOKENS")
+    summary_keep_messages = get_int_env("SUMMARY_KEEP_MESSAGES")
+    speculation_token_budget = get_int_env("SPECULATION_TOKEN_BUDGET")
+    conversation_store_path = os.environ.get("CONVERSATION_STORE_PATH") or None
+    conversation_store_retention_days = get_int_env(
+        "CONVERSATION_STORE_RETENTION_DAYS", 30
+    )
+    inference_concurrency = get_int_env("INFERENCE_CONCURRENCY")
+    inference_queue_size = get_int_env("INFERENCE_QUEUE_SIZE", 32)
+    completion_cache_dir = os.environ.get("COMPLETION_CACHE_DIR") or None
+    completion_cache_size_mb = get_int_env("COMPLETION_CACHE_SIZE_MB", 256)
+    completion_cache_ttl = get_int_env("COMPLETION_CACHE_TTL", 86400)
+    metrics_host = os.environ.get("METRICS_HOST") or "127.0.0.1"
+    metrics_port = get_int_env("METRICS_PORT")
+    profile_slow_requests = os.environ.get("PROFILE_SLOW_REQUESTS")
+    profile_dir = os.environ.get("PROFILE_DIR") or None
+    respond_to = os.environ.get("RESPOND_TO") or "all"
+    respond_channels = os.environ.get("RESPOND_CHANNELS") or ""
+    debounce_seconds = os.environ.get("DEBOUNCE_SECONDS")
+    trace_path = os.environ.get("TRACE_PATH") or None
+    trace_salt = os.environ.get("TRACE_SALT")
 
-    DiscordBot(
-        local=mode == "local",
+    client_options = {}
+    if shard_count or shard_ids:
+        # 'auto' lets Discord recommend the number of shards
+        client_options["shard_count"] = (
+            int(shard_count) if shard_count and shard_count != "auto" else None
+        )
+        if shard_ids:
+            client_options["shard_ids"] = [
+                int(shard_id) for shard_id in shard_ids.split(",")
+            ]
+
+    bot = (ShardedDiscordBot if client_options else DiscordBot)(
         discord_api_token=discord_api_token,
-        replicate_model=replicate_model,
-        local_model_path=local_model_path,
+        **backend_env,
+        context_tokens=context_tokens,
+        summary_keep_messages=summary_keep_messages,
+        speculation_token_budget=speculation_token_budget,
+        user_quota=get_quota_env("USER"),
+        guild_quota=get_quota_env("GUILD"),
+        channel_quota=get_quota_env("CHANNEL"),
+        conversation_store_path=conversation_store_path,
+        conversation_store_max_age=conversation_store_retention_days * 86400,
+        inference_concurrency=inference_concurrency,
+        inference_queue_size=inference_queue_size,
+        generation_config=generation_config,
+        guild_generation_configs=get_guild_generation_env(),
+        min_response_tokens=min_response_tokens,
+        completion_cache_dir=completion_cache_dir,
+        completion_cache_size=completion_cache_size_mb << 20,
+        completion_cache_ttl=completion_cache_ttl,
+        metrics_host=metrics_host,
+        metrics_port=metrics_port,
+        profile_threshold=float(profile_slow_requests)
+        if profile_slow_requests
+        else None,
+        profile_dir=profile_dir,
+        respond_to=frozenset(
+            trigger.strip().lower() for trigger in respond_to.split(",")
+        ),
+        respond_channels=frozenset(
+            int(channel_id) for channel_id in respond_channels.split(",") if channel_id
+        ),
+        debounce_seconds=float(debounce_seconds) if debounce_seconds else 0.0,
+        trace_path=trace_path,
+        trace_salt=trace_salt.encode() if trace_salt else None,
+        **client_options,
+    )
+    bot.run(discord_api_token)
+
+
+async def serve():
+    """Runs an inference server, which bots in the REMOTE mode generate responses with."""
+
+    load_dotenv()
+
+    builder = BackendBuilder(DiscordBot.SYSTEM_PROMPT, get_generation_env())
+    llama = builder.build(**get_backend_env({"local", "replicate"}))
+    server = InferenceServer(
+        llama,
+        host=os.environ.get("INFERENCE_SERVER_HOST") or "127.0.0.1",
+        port=get_int_env("INFERENCE_SERVER_PORT", 8100),
+        path=os.environ.get("INFERENCE_SERVER_SOCKET") or None,
+        max_concurrency=get_int_env("INFERENCE_CONCURRENCY"),
+        max_queue=get_int_env("INFERENCE_QUEUE_SIZE", 32),
+        loaders=builder.loaders(llama),
     )
+    await server.start()
+    print(f"🛰️  Serving inference at {server.url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        await builder.close()
 
 
 if __name__ == "__main__":
-    bootstrap()
+    if sys.argv[1:] == ["serve"]:
+        asyncio.run(serve())
+    else:
+        bootstrap()
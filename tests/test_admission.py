@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+from llama_discord_bot.admission import (
+    CHANNEL,
+    DM,
+    MENTION,
+    REPLY,
+    AdmissionFilter,
+    MessageDebouncer,
+)
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+
+
+def bot_responses(channel, discord_):
+    return [
+        message
+        for message in channel.messages
+        if message.author is discord_.bot_user and message.view is not None
+    ]
+
+
+class TestAdmissionFilter:
+    def test_only_addressed_messages_are_answered(self):
+        llama = FakeLlama(response_tokens=1, token_latency=0)
+
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=llama,
+                respond_to=frozenset({MENTION, DM, REPLY, CHANNEL}),
+                respond_channels=frozenset(),
+            )
+            discord_ = FakeDiscord(bot, channels=2)
+            channel, direct = discord_.channels
+            direct.guild = None
+            user = FakeUser(100, "user")
+
+            await discord_.send_message(channel, user, "Just chatting")
+            await discord_.send_message(
+                channel, user, "Hey bot", mentions=[discord_.bot_user]
+            )
+            await discord_.drain()
+            response = bot_responses(channel, discord_)[0]
+            await discord_.send_message(channel, user, "Thanks", reply_to=response)
+            await discord_.drain()
+            await discord_.send_message(direct, user, "Hello")
+            await discord_.drain()
+            return bot.admission.stats(), len(bot_responses(channel, discord_))
+
+        stats, responses = asyncio.run(run())
+
+        assert responses == 2
+        assert llama.generations == 3
+        assert stats["dropped"] == 1
+        assert stats[f"admitted_{MENTION}"] == 1
+        assert stats[f"admitted_{REPLY}"] == 1
+        assert stats[f"admitted_{DM}"] == 1
+
+    def test_allowlisted_channels(self):
+        admission = AdmissionFilter(frozenset({CHANNEL}), channels={10})
+
+        async def run():
+            bot = DiscordBot(local=False, discord_api_token=None, llama=FakeLlama())
+            discord_ = FakeDiscord(bot, channels=2)
+            discord_.channels[0].id = 10
+            user = FakeUser(100, "user")
+            return [
+                admission.admit(
+                    channel._create_message(user, "Hello"), discord_.bot_user
+                )
+                for channel in discord_.channels
+            ]
+
+        assert asyncio.run(run()) == [True, False]
+
+    def test_unknown_triggers_are_rejected(self):
+        with pytest.raises(AssertionError):
+            AdmissionFilter(frozenset({"mentions"}))
+
+
+class TestMessageDebouncer:
+    def test_bursts_are_answered_once(self):
+        llama = FakeLlama(response_tokens=1, token_latency=0)
+
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=llama,
+                debounce_seconds=0.05,
+            )
+            discord_ = FakeDiscord(bot, channels=2)
+            user = FakeUser(100, "user")
+            for content in ["Hi", "I have a question", "about Python"]:
+                discord_.send_message(discord_.channels[0], user, content)
+                await asyncio.sleep(0.01)
+            discord_.send_message(discord_.channels[1], user, "Hello")
+            await discord_.drain()
+            return bot.debouncer.stats(), discord_
+
+        stats, discord_ = asyncio.run(run())
+
+        assert llama.generations == 2
+        assert stats == {"coalesced": 2, "pending_channels": 0}
+        # The response follows the whole burst
+        assert discord_.channels[0].messages[-1].content == "token0"
+        assert [message.content for message in discord_.channels[0].messages[:3]] == [
+            "Hi",
+            "I have a question",
+            "about Python",
+        ]
+
+    def test_cancelled_waits_are_forgotten(self):
+        debouncer = MessageDebouncer(10)
+
+        async def run():
+            task = asyncio.create_task(debouncer.settle(1, 1))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+
+        assert debouncer.stats()["pending_channels"] == 0
@@ -0,0 +1,127 @@
+import asyncio
+from llama_discord_bot.benchmark import percentile, run_benchmark
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.loader import BackendLoadingError
+
+
+class SpacedLlama(FakeLlama):
+    """Streams responses with surrounding whitespace, like models usually do, and can stop working."""
+
+    def __init__(self):
+        super().__init__(token_latency=0)
+        self.loading = False
+
+    async def stream_response(self, messages, suffix="", **kwargs):
+        if self.loading:
+            raise BackendLoadingError("Loading")
+        self.generations += 1
+        for chunk in [" Hello", " there", "\n"]:
+            yield chunk
+
+
+class TestFakeDiscord:
+    def test_message_and_buttons(self):
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=FakeLlama(response_tokens=3, token_latency=0),
+            )
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            await discord.send_message(channel, user, "Hello")
+            response = channel.messages[-1]
+            await discord.click(response, "continue_response", user)
+            continuation = channel.messages[-1]
+            await discord.click(response, "rewrite_response", user)
+            await discord.drain()
+            return channel, response, continuation
+
+        channel, response, continuation = asyncio.run(run())
+
+        assert response.author.bot
+        assert response.content == "token0 token1 token2"
+        assert continuation is not response
+        assert continuation.content == "token0 token1 token2"
+        assert len(channel.messages) == 3
+        # The buttons were reset after rewriting
+        assert not response.view.rewrite_response.disabled
+
+    def test_trimmed_responses_can_be_continued(self):
+        llama = SpacedLlama()
+
+        async def run():
+            bot = DiscordBot(local=False, discord_api_token=None, llama=llama)
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            await discord.send_message(channel, user, "Hello")
+            response = channel.messages[-1]
+            await discord.click(response, "rewrite_response", user)
+            # The continuation does not wait for the edits of the rewrite to arrive
+            await discord.click(response, "continue_response", user)
+            await discord.drain()
+            return channel, response
+
+        channel, response = asyncio.run(run())
+
+        # Discord trims the content of the response, which is still the last message of the channel
+        assert response.content == "Hello there"
+        assert channel.messages[-1] is not response
+        assert channel.messages[-1].content == "Hello there"
+        assert llama.generations == 3
+
+    def test_click_errors_reset_the_buttons(self):
+        llama = SpacedLlama()
+
+        async def run():
+            bot = DiscordBot(local=False, discord_api_token=None, llama=llama)
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            await discord.send_message(channel, user, "Hello")
+            response = channel.messages[-1]
+            llama.loading = True
+            await discord.click(response, "rewrite_response", user)
+            await discord.drain()
+            return channel, response
+
+        channel, response = asyncio.run(run())
+
+        assert channel.messages[-1].embed.description == DiscordBot.WARMING_UP
+        assert not response.view.rewrite_response.disabled
+
+
+class TestBenchmark:
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        assert percentile(values, 0.5) == 51
+        assert percentile(values, 0.99) == 100
+        assert percentile([], 0.5) == 0.0
+
+    def test_run_benchmark(self):
+        report = asyncio.run(
+            run_benchmark(
+                channels=3,
+                guilds=2,
+                rate=5,
+                duration=1,
+                response_tokens=5,
+                token_latency=0.001,
+                concurrency=2,
+                rewrite_probability=0.2,
+            )
+        )
+
+        assert report["requests"] > 0
+        assert sum(report["outcomes"].values()) == report["requests"]
+        assert report["outcomes"]["completed"] > 0
+        latencies = report["end_to_end_seconds"]
+        assert 0 < latencies["p50"] <= latencies["p95"] <= latencies["p99"]
+        assert report["scheduler"]["admitted"] > 0
@@ -0,0 +1,165 @@
+import asyncio
+import pytest
+from llama_discord_bot.backends import BackendBuilder
+from llama_discord_bot.cascade import LARGE, SMALL, LlamaCascade, PromptClassifier
+from llama_discord_bot.fakes import FakeLlama
+from llama_discord_bot.llama import ChatUser, Message
+from llama_discord_bot.loader import BackgroundLoadedLlama
+from llama_discord_bot.scheduler import ScheduledLlama
+
+HELLO = [Message(ChatUser.HUMAN, "Hello!")]
+
+
+class FailingLlama(FakeLlama):
+    def __init__(self, tokens_before_failing: int = 0, **kwargs):
+        super().__init__(token_latency=0, **kwargs)
+        self.tokens_before_failing = tokens_before_failing
+
+    async def stream_response(self, messages, suffix="", **kwargs):
+        self.generations += 1
+        for i in range(self.tokens_before_failing):
+            yield f"partial{i} "
+        raise RuntimeError("Backend down")
+
+
+def cascade(small=None, large=None, **kwargs):
+    return LlamaCascade(
+        small or FakeLlama(response_tokens=1, token_latency=0),
+        large or FakeLlama(response_tokens=2, token_latency=0),
+        **kwargs,
+    )
+
+
+class TestPromptClassifier:
+    @pytest.mark.parametrize(
+        "content, expected",
+        [
+            ("Hi, how are you?", (SMALL, "easy")),
+            ("Can you explain what a monad is?", (LARGE, "keyword")),
+            ("Look at this:\n```print(1)```", (LARGE, "keyword")),
+            ("a very long message " * 20, (LARGE, "length")),
+        ],
+    )
+    def test_classifies_the_latest_message(self, content, expected):
+        messages = [Message(ChatUser.HUMAN, content)]
+
+        assert PromptClassifier().classify(messages, len) == expected
+
+    def test_deep_conversations_are_hard(self):
+        messages = [
+            Message(ChatUser.HUMAN if i % 2 == 0 else ChatUser.AI, "Ok")
+            for i in range(9)
+        ]
+
+        assert PromptClassifier(max_easy_turns=8).classify(messages, len) == (
+            LARGE,
+            "depth",
+        )
+        assert PromptClassifier(max_easy_turns=8).classify(messages[1:], len) == (
+            SMALL,
+            "easy",
+        )
+
+    def test_keywords_can_be_replaced(self):
+        messages = [Message(ChatUser.HUMAN, "Explain this poem")]
+
+        assert PromptClassifier(keywords=("poem",)).classify(messages, len)[1] == (
+            "keyword"
+        )
+        assert PromptClassifier(keywords=()).classify(messages, len)[0] == SMALL
+
+
+class TestLlamaCascade:
+    def test_routes_by_difficulty_and_escalates_rewrites(self):
+        llama = cascade()
+
+        async def run():
+            return [
+                await llama.generate_response(HELLO),
+                await llama.generate_response(
+                    [Message(ChatUser.HUMAN, "Why is the sky blue?")]
+                ),
+                await llama.generate_response(HELLO, rewrite=True),
+            ]
+
+        assert asyncio.run(run()) == ["token0 ", "token0 token1 ", "token0 token1 "]
+        stats = llama.stats()
+        assert stats["small_routes_easy"] == 1
+        assert stats["large_routes_keyword"] == 1
+        assert stats["large_routes_rewrite"] == 1
+        assert stats["small_requests"] == 1
+        assert stats["large_requests"] == 2
+        assert stats["large_first_token_seconds"] >= 0
+
+    def test_failing_small_model_escalates(self):
+        small = FailingLlama()
+        llama = cascade(small=small)
+
+        assert asyncio.run(llama.generate_response(HELLO)) == "token0 token1 "
+        assert llama.stats()["escalations"] == 1
+        assert llama.stats()["large_routes_escalation"] == 1
+
+    def test_failure_after_text_is_raised(self):
+        llama = cascade(small=FailingLlama(tokens_before_failing=1))
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(llama.generate_response(HELLO))
+
+    def test_loading_tier_is_skipped(self):
+        large = BackgroundLoadedLlama(FakeLlama, name="Large", context_window=2048)
+        llama = cascade(large=large)
+
+        assert llama.route(HELLO, rewrite=True) == (SMALL, "loading")
+        assert BackendBuilder.loaders(llama) == [large]
+
+    def test_saturated_tier_is_skipped(self):
+        running = 0
+        max_running = 0
+
+        def on_event(event):
+            nonlocal running, max_running
+            running += event == "start"
+            running -= event in ("finish", "cancel")
+            max_running = max(max_running, running)
+
+        large = FakeLlama(response_tokens=2, token_latency=0.01, on_event=on_event)
+        llama = ScheduledLlama(cascade(large=large))
+        hard = [Message(ChatUser.HUMAN, "Explain this code")]
+
+        async def run():
+            return await asyncio.gather(
+                llama.generate_response(hard), llama.generate_response(hard)
+            )
+
+        responses = asyncio.run(run())
+
+        # Both requests get past the scheduler of the cascade, and the small model takes the second one
+        # instead of queueing it behind the first
+        assert responses == ["token0 token1 ", "token0 "]
+        assert max_running == 1
+        assert large.generations == 1
+        assert llama.llama.stats()["small_routes_saturated"] == 1
+
+    def test_busy_cascade_queues_in_front(self):
+        small = FakeLlama(response_tokens=2, token_latency=0.01)
+        large = FakeLlama(response_tokens=2, token_latency=0.01)
+        llama = ScheduledLlama(cascade(small=small, large=large))
+        hard = [Message(ChatUser.HUMAN, "Explain this code")]
+
+        async def run():
+            requests = [
+                asyncio.ensure_future(llama.generate_response(hard)) for _ in range(3)
+            ]
+            await asyncio.sleep(0.005)
+            stats = llama.llama.stats()
+            load = llama.scheduler.load
+            await asyncio.gather(*requests)
+            return stats, load
+
+        stats, load = asyncio.run(run())
+
+        # The third request waits for a slot of the cascade, where the outer scheduler sees it
+        assert stats["small_in_flight"] == stats["large_in_flight"] == 1
+        assert stats["small_waiting"] == stats["large_waiting"] == 0
+        assert load > 0
+        assert small.generations + large.generations == 3
@@ -0,0 +1,87 @@
+import asyncio
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaBase, Message, ChatUser
+from llama_discord_bot.completion_cache import CachedLlama, CompletionCache
+from llama_discord_bot.scheduler import ScheduledLlama
+
+
+class CountingLlama(LlamaBase):
+    def __init__(self, generation_config=None):
+        super().__init__(generation_config=generation_config)
+        self.generations = 0
+
+    async def generate_response(self, messages, suffix="", **kwargs):
+        self.generations += 1
+        return f"response {self.generations}"
+
+
+MESSAGES = [Message(ChatUser.HUMAN, "Hello, how are you?")]
+
+
+async def stream(llama, **kwargs):
+    return "".join([chunk async for chunk in llama.stream_response(MESSAGES, **kwargs)])
+
+
+class TestCachedLlama:
+    def test_repeated_prompts_are_cached(self, tmp_path):
+        backend = CountingLlama()
+        llama = CachedLlama(backend, CompletionCache(str(tmp_path)))
+
+        async def run():
+            return [
+                await llama.generate_response(MESSAGES),
+                await stream(llama),
+                await llama.generate_response(MESSAGES, suffix="Continue."),
+            ]
+
+        responses = asyncio.run(run())
+
+        assert responses == ["response 1", "response 1", "response 2"]
+        assert backend.generations == 2
+        assert llama.cache.stats()["hits"] == 1
+        assert llama.cache.stats()["misses"] == 2
+
+    def test_rewrites_bypass_the_cache(self, tmp_path):
+        backend = CountingLlama()
+        llama = CachedLlama(backend, CompletionCache(str(tmp_path)))
+
+        async def run():
+            return [
+                await stream(llama),
+                await stream(llama, rewrite=True),
+                await stream(llama),
+            ]
+
+        assert asyncio.run(run()) == ["response 1", "response 2", "response 1"]
+
+    def test_entries_expire(self, tmp_path):
+        backend = CountingLlama()
+        llama = CachedLlama(backend, CompletionCache(str(tmp_path), ttl=0))
+
+        async def run():
+            await llama.generate_response(MESSAGES)
+            await llama.generate_response(MESSAGES)
+
+        asyncio.run(run())
+
+        assert backend.generations == 2
+
+    def test_backend_settings_are_part_of_the_key(self, tmp_path):
+        # Like a restart with a different GENERATION_TEMPERATURE, over the same cache directory
+        cold = CountingLlama(GenerationConfig(temperature=0.2))
+        hot = CountingLlama(GenerationConfig(temperature=1.2))
+
+        async def run():
+            return [
+                await CachedLlama(
+                    ScheduledLlama(backend), CompletionCache(str(tmp_path))
+                ).generate_response(MESSAGES)
+                for backend in [cold, hot, cold]
+            ]
+
+        responses = asyncio.run(run())
+
+        assert responses == ["response 1", "response 1", "response 1"]
+        assert cold.generations == 1
+        assert hot.generations == 1
+        assert CompletionCache(str(tmp_path)).stats()["entries"] == 2
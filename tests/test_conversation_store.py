@@ -0,0 +1,119 @@
+import asyncio
+from llama_discord_bot.conversation_store import ConversationStore
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.llama import ChatUser, Message
+
+
+def make_entries(count, start=0):
+    return [
+        (i, Message(ChatUser.HUMAN, f"message {i}"))
+        for i in range(start, start + count)
+    ]
+
+
+class TestConversationStore:
+    def test_survives_reopening(self, tmp_path):
+        path = str(tmp_path / "conversations.db")
+
+        async def write():
+            store = ConversationStore(path, messages_per_channel=10)
+            store.seed(1, make_entries(3))
+            store.append(1, 3, Message(ChatUser.AI, "response"))
+            store.update(1, 3, "edited response")
+            store.remove(1, {0})
+            # Channels that were never seeded are not stored
+            store.append(2, 4, Message(ChatUser.HUMAN, "ignored"))
+            await store.close()
+            return store.stats()
+
+        async def read():
+            store = ConversationStore(path, messages_per_channel=10)
+            entries = await store.load(1)
+            missing = await store.load(2)
+            await store.close()
+            return entries, missing
+
+        stats = asyncio.run(write())
+        entries, missing = asyncio.run(read())
+
+        assert stats["writes"] == 4
+        assert entries == [
+            (1, Message(ChatUser.HUMAN, "message 1")),
+            (2, Message(ChatUser.HUMAN, "message 2")),
+            (3, Message(ChatUser.AI, "edited response")),
+        ]
+        assert missing is None
+
+    def test_keeps_the_latest_messages(self, tmp_path):
+        async def run():
+            store = ConversationStore(str(tmp_path / "db"), messages_per_channel=3)
+            store.seed(1, make_entries(3))
+            store.append(1, 3, Message(ChatUser.HUMAN, "message 3"))
+            latest = await store.load(1)
+            # A deleted message leaves a gap that only the channel history can fill
+            store.remove(1, {3})
+            incomplete = await store.load(1)
+            await store.close()
+            return latest, incomplete
+
+        latest, incomplete = asyncio.run(run())
+
+        assert [message_id for message_id, _ in latest] == [1, 2, 3]
+        assert incomplete is None
+
+    def test_compaction(self, tmp_path):
+        async def run():
+            store = ConversationStore(str(tmp_path / "db"), max_channels=2)
+            for channel_id in range(3):
+                store.seed(channel_id, make_entries(2))
+                await store.flush()
+            dropped = await store.compact()
+            kept = [channel_id in store for channel_id in range(3)]
+
+            store.max_age = 0
+            expired = await store.compact()
+            await store.close()
+            return dropped, kept, expired
+
+        dropped, kept, expired = asyncio.run(run())
+
+        assert dropped == 1
+        assert kept == [False, True, True]
+        assert expired == 2
+
+
+class TestRestoredHistory:
+    def test_history_is_not_fetched_after_a_restart(self, tmp_path):
+        path = str(tmp_path / "conversations.db")
+        history_fetches = []
+
+        async def run_bot(content):
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=FakeLlama(response_tokens=1, token_latency=0),
+                conversation_store_path=path,
+            )
+            await bot.setup_hook()
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            # Channel ids are the same in every run, like the ones of a real Discord server
+            history = channel.history
+
+            def counting_history(*args, **kwargs):
+                history_fetches.append(content)
+                return history(*args, **kwargs)
+
+            channel.history = counting_history
+            await discord.send_message(channel, FakeUser(100, "user"), content)
+            await discord.drain()
+            await bot.conversation_store.close()
+            return bot
+
+        asyncio.run(run_bot("Hello"))
+        bot = asyncio.run(run_bot("Hello again"))
+
+        assert history_fetches == ["Hello"]
+        assert bot.conversation_store.stats()["hits"] >= 1
+        assert "history_restored_seconds" in bot.startup_timings
@@ -0,0 +1,142 @@
+import asyncio
+import pytest
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.generation_config import GenerationConfig, stop_at
+from llama_discord_bot.metrics import RESPONSE_TOKEN_CAPS
+from llama_discord_bot.prompt import STOP_SEQUENCES
+
+
+class RecordingLlama(FakeLlama):
+    """Remembers the generation settings of each request."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.configs = []
+
+    async def stream_response(self, messages, suffix="", **kwargs):
+        self.configs.append(self.resolve_config(kwargs.get("config")))
+        async for chunk in super().stream_response(messages, suffix, **kwargs):
+            yield chunk
+
+
+async def stream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def collect(chunks, stop):
+    async def run():
+        return [chunk async for chunk in stop_at(stream(chunks), stop)]
+
+    return asyncio.run(run())
+
+
+class TestGenerationConfig:
+    def test_later_layers_override_settings(self):
+        backend = GenerationConfig(max_tokens=256, temperature=0.7, stop=("User:",))
+        guild = GenerationConfig(max_tokens=1024, temperature=0.2, stop=("Bot:",))
+
+        config = backend.merge(guild)
+
+        # The length can only be lowered, and stop sequences add up
+        assert config == GenerationConfig(
+            max_tokens=256, temperature=0.2, stop=("User:", "Bot:")
+        )
+        assert backend.merge(None) is backend
+
+    def test_round_trips_through_dicts(self):
+        config = GenerationConfig(max_tokens=64, top_p=0.5, stop=("a", "b"))
+
+        assert config.to_dict() == {"max_tokens": 64, "top_p": 0.5, "stop": ["a", "b"]}
+        assert GenerationConfig.from_dict(config.to_dict()) == config
+        with pytest.raises(ValueError, match="temprature"):
+            GenerationConfig.from_dict({"temprature": 0.5})
+
+    def test_backends_stop_at_the_template_markers(self):
+        llama = FakeLlama(generation_config=GenerationConfig(temperature=0.1))
+
+        config = llama.resolve_config(GenerationConfig(max_tokens=32))
+
+        assert config.max_tokens == 32
+        assert config.temperature == 0.1
+        assert config.top_p == llama.TOP_P
+        assert set(STOP_SEQUENCES) == {"<s>", "[INST]", "[/INST]", "</s>"}
+        assert config.stop == STOP_SEQUENCES
+
+
+class TestStopAt:
+    def test_stops_across_chunks(self):
+        chunks = collect(["Hello", " there [", "INST] How", " are you"], ("[INST]",))
+
+        assert "".join(chunks) == "Hello there "
+
+    def test_held_back_text_is_released(self):
+        chunks = collect(["a [", "b] c", " [I"], ("[INST]",))
+
+        assert chunks == ["a ", "[b] c", " ", "[I"]
+
+
+class TestBotGenerationConfig:
+    def test_guild_settings_and_caps_under_load(self):
+        llama = RecordingLlama(response_tokens=5, token_latency=0.01)
+
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=llama,
+                inference_queue_size=4,
+                guild_generation_configs={1: GenerationConfig(temperature=0.1)},
+                min_response_tokens=64,
+            )
+            discord_ = FakeDiscord(bot, channels=2)
+            user = FakeUser(100, "user")
+            first = discord_.send_message(discord_.channels[0], user, "Hello")
+            await asyncio.sleep(0.01)
+            # The backend is busy with the first message, so the second one waits
+            second = discord_.send_message(discord_.channels[1], user, "Hi")
+            await asyncio.gather(first, second)
+            await discord_.drain()
+
+        asyncio.run(run())
+
+        assert [config.temperature for config in llama.configs] == [0.1, 0.1]
+        assert llama.configs[0].max_tokens == llama.RESPONSE_TOKENS
+        assert 64 < llama.configs[1].max_tokens < llama.RESPONSE_TOKENS
+
+    def test_caps_shrink_the_configured_limit(self):
+        llama = RecordingLlama(response_tokens=5, token_latency=0.01)
+
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=llama,
+                inference_queue_size=4,
+                guild_generation_configs={1: GenerationConfig(max_tokens=128)},
+                min_response_tokens=64,
+            )
+            discord_ = FakeDiscord(bot, channels=2)
+            user = FakeUser(100, "user")
+            caps = RESPONSE_TOKEN_CAPS.count()
+            first = discord_.send_message(discord_.channels[0], user, "Hello")
+            await asyncio.sleep(0.01)
+            second = discord_.send_message(discord_.channels[1], user, "Hi")
+            await asyncio.gather(first, second)
+            await discord_.drain()
+            # A limit below the minimum is not raised, nor recorded as a cap
+            bot.guild_generation_configs[1] = GenerationConfig(max_tokens=32)
+            first = discord_.send_message(discord_.channels[0], user, "Hello")
+            await asyncio.sleep(0.01)
+            second = discord_.send_message(discord_.channels[1], user, "Hi")
+            await asyncio.gather(first, second)
+            await discord_.drain()
+            return RESPONSE_TOKEN_CAPS.count() - caps
+
+        caps = asyncio.run(run())
+
+        assert [config.max_tokens for config in llama.configs][::2] == [128, 32]
+        assert 64 < llama.configs[1].max_tokens < 128
+        assert llama.configs[3].max_tokens == 32
+        assert caps == 1
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+import time
+import pytest
+from llama_discord_bot.generations import GenerationTracker
+from llama_discord_bot.run_async import run_async
+
+
+async def generate(tracker, events, name, channel_id):
+    async with tracker.generation(channel_id):
+        events.append(f"{name} started")
+        await asyncio.sleep(0.05)
+        events.append(f"{name} finished")
+    events.append(f"{name} returned")
+
+
+class TestGenerationTracker:
+    def test_new_generation_supersedes_previous_one(self):
+        async def run():
+            tracker = GenerationTracker()
+            events = []
+            first = asyncio.create_task(generate(tracker, events, "first", 1))
+            await asyncio.sleep(0.01)
+            other = asyncio.create_task(generate(tracker, events, "other", 2))
+            second = asyncio.create_task(generate(tracker, events, "second", 1))
+            await asyncio.gather(first, other, second)
+            return events, tracker.stats()
+
+        events, stats = asyncio.run(run())
+
+        assert "first finished" not in events
+        assert "first returned" in events
+        assert "other finished" in events
+        assert "second finished" in events
+        assert stats == {"running": 0, "started": 3, "completed": 2, "superseded": 1}
+
+    def test_other_cancellations_propagate(self):
+        async def run():
+            tracker = GenerationTracker()
+            task = asyncio.create_task(generate(tracker, [], "first", 1))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            await task
+
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(run())
+
+
+class TestRunAsyncStop:
+    def test_cancellation_stops_the_function(self):
+        finished = threading.Event()
+
+        @run_async(stop_keyword="stopped")
+        def work(stopped):
+            while not stopped.is_set():
+                time.sleep(0.001)
+            finished.set()
+
+        async def run():
+            task = asyncio.create_task(work())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # The cancellation waits for the function to return
+            return finished.is_set()
+
+        assert asyncio.run(run())
@@ -0,0 +1,209 @@
+import asyncio
+import discord
+import pytest
+from llama_discord_bot.discord_bot import DiscordBot, ShardedDiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.inference_server import (
+    InferenceServer,
+    RemoteInferenceError,
+    RemoteLlama,
+)
+from llama_discord_bot.llama import ChatUser, Message
+from llama_discord_bot.loader import BackendLoadingError, BackgroundLoadedLlama
+from llama_discord_bot.scheduler import SchedulerBusyError
+
+MESSAGES = [Message(ChatUser.HUMAN, "Hello")]
+
+
+class RecordingLlama(FakeLlama):
+    """Remembers how many messages each prompt had."""
+
+    def __init__(self, **kwargs):
+        super().__init__(response_tokens=1, token_latency=0, **kwargs)
+        self.prompt_messages = []
+
+    def _generate_prompt(self, messages, suffix):
+        self.prompt_messages.append(len(messages))
+        return super()._generate_prompt(messages, suffix)
+
+
+class FailingLlama(FakeLlama):
+    async def stream_response(self, messages, suffix="", **kwargs):
+        yield "partial "
+        raise RuntimeError("Out of memory")
+
+
+async def serve(llama, **kwargs):
+    server = InferenceServer(llama, port=0, **kwargs)
+    await server.start()
+    return server
+
+
+class TestInferenceServer:
+    def test_streams_over_tcp(self):
+        async def run():
+            server = await serve(FakeLlama(response_tokens=3, token_latency=0))
+            remote = RemoteLlama(server.url)
+            try:
+                chunks = [
+                    chunk
+                    async for chunk in remote.stream_response(MESSAGES, channel_id=1)
+                ]
+                return chunks, await remote.info()
+            finally:
+                await remote.close()
+                await server.stop()
+
+        chunks, info = asyncio.run(run())
+
+        assert chunks == ["token0 ", "token1 ", "token2 "]
+        assert info["name"] == "FakeLlama"
+        assert info["ready"]
+
+    def test_streams_over_a_unix_socket(self, tmp_path):
+        async def run():
+            server = await serve(
+                FakeLlama(response_tokens=2, token_latency=0),
+                path=str(tmp_path / "inference.sock"),
+            )
+            remote = RemoteLlama(server.url)
+            try:
+                return await remote.generate_response(MESSAGES)
+            finally:
+                await remote.close()
+                await server.stop()
+
+        assert asyncio.run(run()) == "token0 token1 "
+
+    def test_generation_config_is_sent_to_the_server(self):
+        async def run():
+            server = await serve(FakeLlama(response_tokens=5, token_latency=0))
+            remote = RemoteLlama(server.url)
+            try:
+                return await remote.generate_response(
+                    MESSAGES, config=GenerationConfig(max_tokens=2)
+                )
+            finally:
+                await remote.close()
+                await server.stop()
+
+        assert asyncio.run(run()) == "token0 token1 "
+
+    def test_closing_the_stream_cancels_the_generation(self):
+        events = []
+
+        async def run():
+            server = await serve(
+                FakeLlama(
+                    response_tokens=100, token_latency=0.01, on_event=events.append
+                )
+            )
+            remote = RemoteLlama(server.url)
+            try:
+                chunks = remote.stream_response(MESSAGES)
+                await anext(chunks)
+                await chunks.aclose()
+                await asyncio.sleep(0.1)
+                return server.stats()
+            finally:
+                await remote.close()
+                await server.stop()
+
+        stats = asyncio.run(run())
+
+        assert events[-1] == "cancel"
+        assert stats["cancellations"] == 1
+        assert stats["scheduler_running"] == 0
+
+    def test_errors_are_raised_by_the_client(self):
+        async def run():
+            busy = await serve(FakeLlama(), max_concurrency=1, max_queue=0)
+            loading = await serve(
+                BackgroundLoadedLlama(FakeLlama, name="Fake", context_window=2048)
+            )
+            failing = await serve(FailingLlama())
+            results = []
+            try:
+                async with busy.llama.scheduler.slot():
+                    for server in [busy, loading, failing]:
+                        remote = RemoteLlama(server.url)
+                        try:
+                            await remote.generate_response(MESSAGES)
+                        except (
+                            SchedulerBusyError,
+                            BackendLoadingError,
+                            RemoteInferenceError,
+                        ) as exception:
+                            results.append(type(exception))
+                        await remote.close()
+            finally:
+                for server in [busy, loading, failing]:
+                    await server.stop()
+            return results
+
+        assert asyncio.run(run()) == [
+            SchedulerBusyError,
+            BackendLoadingError,
+            RemoteInferenceError,
+        ]
+
+    def test_unreachable_server(self):
+        async def run():
+            remote = RemoteLlama("http://127.0.0.1:1")
+            try:
+                await remote.generate_response(MESSAGES)
+            finally:
+                await remote.close()
+
+        with pytest.raises(RemoteInferenceError):
+            asyncio.run(run())
+
+    def test_prompts_are_trimmed_to_the_server_context(self):
+        llama = RecordingLlama(context_window=1024)
+        messages = [
+            Message(ChatUser.HUMAN, f"a long message number {i} " * 20)
+            for i in range(50)
+        ]
+
+        async def run():
+            server = await serve(llama)
+            remote = RemoteLlama(server.url, context_window=100_000)
+            try:
+                await remote.generate_response(messages)
+            finally:
+                await remote.close()
+                await server.stop()
+
+        asyncio.run(run())
+
+        assert 0 < llama.prompt_messages[0] < len(messages)
+
+
+class TestRemoteBot:
+    @pytest.mark.parametrize("bot_class", [DiscordBot, ShardedDiscordBot])
+    def test_answers_through_the_inference_server(self, bot_class):
+        async def run():
+            server = await serve(FakeLlama(response_tokens=3, token_latency=0))
+            bot = bot_class(
+                local=False,
+                discord_api_token=None,
+                inference_servers=server.url,
+                shard_count=2 if bot_class is ShardedDiscordBot else None,
+            )
+            try:
+                discord_ = FakeDiscord(bot)
+                channel = discord_.channels[0]
+                await discord_.send_message(channel, FakeUser(100, "user"), "Hello")
+                await discord_.drain()
+                return bot, channel.messages[-1].content
+            finally:
+                await bot.backends.close()
+                await server.stop()
+
+        bot, content = asyncio.run(run())
+
+        assert content == "token0 token1 token2"
+        assert isinstance(bot, discord.AutoShardedClient) == (
+            bot_class is ShardedDiscordBot
+        )
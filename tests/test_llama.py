@@ -200,3 +200,53 @@ class TestLlamaBaseMergeConsecutiveMessagesByRole:
         expected_messages = [*test_messages]
 
         assert merged_messages == expected_messages
+
+
+class TestLlamaBaseSelectContext:
+    def setup_method(self):
+        self.counted = []
+
+        def count_tokens(text):
+            self.counted.append(text)
+            return len(text.split())
+
+        # pylint: disable=abstract-class-instantiated
+        self.llama = LlamaBase(count_tokens=count_tokens)
+        self.llama.CONTEXT_WINDOW = 100
+        self.llama.RESPONSE_TOKENS = 20
+
+    def test_selects_latest_messages_that_fit(self):
+        test_messages = [
+            Message(ChatUser.HUMAN, "word " * 40),
+            Message(ChatUser.AI, "word " * 30),
+            Message(ChatUser.HUMAN, "word " * 30),
+        ]
+
+        selected = self.llama.select_context(test_messages)
+
+        assert selected == test_messages[1:]
+
+    def test_max_tokens_limits_the_budget(self):
+        test_messages = [
+            Message(ChatUser.HUMAN, "word " * 10),
+            Message(ChatUser.AI, "word " * 10),
+        ]
+
+        assert self.llama.select_context(test_messages) == test_messages
+        assert self.llama.select_context(test_messages, max_tokens=15) == [
+            test_messages[-1]
+        ]
+
+    def test_latest_message_is_always_selected(self):
+        test_messages = [Message(ChatUser.HUMAN, "word " * 500)]
+
+        assert self.llama.select_context(test_messages) == test_messages
+
+    def test_token_counts_are_cached(self):
+        test_messages = [Message(ChatUser.HUMAN, "Hello, how are you?")]
+
+        self.llama.select_context(test_messages)
+        counted = len(self.counted)
+        self.llama.select_context(test_messages)
+
+        assert len(self.counted) == counted
@@ -0,0 +1,136 @@
+import asyncio
+import subprocess
+import sys
+import threading
+import pytest
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.llama import ChatUser, Message
+from llama_discord_bot.loader import BackendLoadingError, BackgroundLoadedLlama
+
+MESSAGES = [Message(ChatUser.HUMAN, "Hello")]
+
+
+def blocking_factory(loaded: threading.Event, **kwargs):
+    """Create a fake backend once `loaded` is set, like a model that takes a while to load."""
+
+    def factory():
+        loaded.wait(5)
+        return FakeLlama(response_tokens=2, token_latency=0, **kwargs)
+
+    return factory
+
+
+class TestBackgroundLoadedLlama:
+    def test_requests_before_ready_are_rejected(self):
+        async def run():
+            loaded = threading.Event()
+            llama = BackgroundLoadedLlama(blocking_factory(loaded))
+            task = llama.start()
+            with pytest.raises(BackendLoadingError):
+                await llama.generate_response(MESSAGES)
+            # Token counts are estimated in the meantime
+            assert llama.count_tokens("Hello") > 0
+            loaded.set()
+            await task
+            return llama, await llama.generate_response(MESSAGES)
+
+        llama, response = asyncio.run(run())
+
+        assert llama.ready
+        assert response == "token0 token1 "
+        assert llama.stats()["load_seconds"] > 0
+        assert llama.stats()["ready"] == 1
+
+    def test_requests_wait_for_the_model(self):
+        async def run():
+            loaded = threading.Event()
+            llama = BackgroundLoadedLlama(blocking_factory(loaded), wait=True)
+            llama.start()
+            request = asyncio.create_task(llama.generate_response(MESSAGES))
+            await asyncio.sleep(0.05)
+            assert not request.done()
+            loaded.set()
+            return await request
+
+        assert asyncio.run(run()) == "token0 token1 "
+
+    def test_warmup_runs_before_ready(self):
+        events = []
+
+        async def run():
+            loaded = threading.Event()
+            loaded.set()
+            llama = BackgroundLoadedLlama(
+                blocking_factory(loaded, on_event=events.append),
+                warmup_prompt="Hi",
+            )
+            await llama.start()
+            return llama
+
+        llama = asyncio.run(run())
+
+        # The warm-up stops after the first token
+        assert events == ["start", "token", "cancel"]
+        assert llama.llama.generations == 1
+        assert llama.stats()["warmup_seconds"] > 0
+
+    def test_loading_errors_reach_waiting_requests(self):
+        def factory():
+            raise FileNotFoundError("model.bin")
+
+        async def run():
+            llama = BackgroundLoadedLlama(factory, wait=True)
+            llama.start()
+            with pytest.raises(FileNotFoundError):
+                await llama.generate_response(MESSAGES)
+
+        asyncio.run(run())
+
+    def test_not_started(self):
+        llama = BackgroundLoadedLlama(FakeLlama)
+
+        with pytest.raises(BackendLoadingError):
+            asyncio.run(llama.generate_response(MESSAGES))
+
+
+class TestFastStartup:
+    def test_backends_are_imported_lazily(self):
+        modules = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, llama_discord_bot.discord_bot; print(' '.join(sys.modules))",
+            ],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.split()
+
+        assert "llama_cpp" not in modules
+        assert "diskcache" not in modules
+        assert "llama_discord_bot.replicate_client" not in modules
+
+    def test_bot_replies_while_warming_up(self):
+        async def run():
+            loaded = threading.Event()
+            llama = BackgroundLoadedLlama(blocking_factory(loaded))
+            bot = DiscordBot(local=False, discord_api_token=None, llama=llama)
+            await bot.setup_hook()
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            await discord.send_message(channel, user, "Hello")
+            warming_up = channel.messages[-1]
+            loaded.set()
+            await llama.start()
+            await discord.send_message(channel, user, "Hello again")
+            await discord.drain()
+            return bot, warming_up, channel.messages[-1]
+
+        bot, warming_up, response = asyncio.run(run())
+
+        assert warming_up.embed.description == DiscordBot.WARMING_UP
+        assert response.content == "token0 token1"
+        assert "model_ready_seconds" in bot.startup_timings
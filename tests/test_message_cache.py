@@ -0,0 +1,65 @@
+from llama_discord_bot.llama import Message, ChatUser
+from llama_discord_bot.message_cache import ChannelMessageCache
+
+
+def make_entries(count, start=0):
+    return [
+        (i, Message(ChatUser.HUMAN, f"message {i}"))
+        for i in range(start, start + count)
+    ]
+
+
+class TestChannelMessageCache:
+    def test_cold_miss_then_hit(self):
+        cache = ChannelMessageCache(messages_per_channel=10)
+
+        assert cache.get(1, 5) is None
+        cache.seed(1, make_entries(10))
+
+        assert cache.get(1, 3) == [
+            Message(ChatUser.HUMAN, "message 7"),
+            Message(ChatUser.HUMAN, "message 8"),
+            Message(ChatUser.HUMAN, "message 9"),
+        ]
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_short_history_is_complete(self):
+        cache = ChannelMessageCache(messages_per_channel=10)
+        cache.seed(1, make_entries(2))
+
+        assert len(cache.get(1, 5)) == 2
+
+    def test_append_update_and_remove(self):
+        cache = ChannelMessageCache(messages_per_channel=3)
+        cache.seed(1, make_entries(3))
+
+        cache.append(1, 3, Message(ChatUser.AI, "response"))
+        cache.update(1, 3, "edited response")
+        assert cache.get(1, 3) == [
+            Message(ChatUser.HUMAN, "message 1"),
+            Message(ChatUser.HUMAN, "message 2"),
+            Message(ChatUser.AI, "edited response"),
+        ]
+
+        # After a deletion, the buffer no longer holds enough messages, so it must be refetched
+        cache.remove(1, {2})
+        assert cache.get(1, 3) is None
+        assert len(cache.get(1, 2)) == 2
+
+    def test_append_to_unknown_channel_is_ignored(self):
+        cache = ChannelMessageCache()
+        cache.append(1, 0, Message(ChatUser.HUMAN, "hello"))
+
+        assert 1 not in cache
+
+    def test_lru_eviction(self):
+        cache = ChannelMessageCache(max_channels=2)
+        cache.seed(1, make_entries(1))
+        cache.seed(2, make_entries(1))
+        cache.get(1, 1)
+        cache.seed(3, make_entries(1))
+
+        assert 1 in cache
+        assert 2 not in cache
+        assert cache.stats()["evictions"] == 1
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+import aiohttp
+from llama_discord_bot.fakes import FakeLlama
+from llama_discord_bot.instrumentation import InstrumentedLlama
+from llama_discord_bot.llama import Message, ChatUser
+from llama_discord_bot.metrics import (
+    FIRST_TOKEN_SECONDS,
+    GENERATED_TOKENS,
+    Metrics,
+    MetricsServer,
+)
+from llama_discord_bot.profiler import SlowRequestProfiler
+
+
+class TestMetrics:
+    def test_render(self):
+        registry = Metrics(namespace="test")
+        events = registry.counter("events_total", "Events.", ["outcome"])
+        latency = registry.histogram("latency_seconds", "Latency.", buckets=[0.1, 1])
+        registry.register_collector("cache", lambda: {"hits": 3, "name": "lru"})
+
+        events.inc(outcome="ok")
+        events.inc(outcome="ok")
+        latency.observe(0.05)
+        latency.observe(0.5)
+        text = registry.render()
+
+        assert "# TYPE test_events_total counter" in text
+        assert 'test_events_total{outcome="ok"} 2.0' in text
+        assert 'test_latency_seconds_bucket{le="0.1"} 1' in text
+        assert 'test_latency_seconds_bucket{le="1.0"} 2' in text
+        assert 'test_latency_seconds_bucket{le="+Inf"} 2' in text
+        assert "test_latency_seconds_count 2" in text
+        assert "test_cache_hits 3.0" in text
+        assert "test_cache_name" not in text
+
+    def test_server(self):
+        registry = Metrics(namespace="test")
+        registry.counter("events_total", "Events.").inc()
+
+        async def run():
+            server = MetricsServer(registry, port=0)
+            await server.start()
+            try:
+                async with aiohttp.ClientSession() as session:
+                    url = f"http://{server.host}:{server.port}/metrics"
+                    async with session.get(url) as response:
+                        return response.status, await response.text()
+            finally:
+                await server.stop()
+
+        status, text = asyncio.run(run())
+
+        assert status == 200
+        assert "test_events_total 1.0" in text
+
+    def test_instrumented_llama(self):
+        llama = InstrumentedLlama(
+            FakeLlama(response_tokens=4, token_latency=0.001, max_concurrency=3)
+        )
+        tokens = GENERATED_TOKENS.value(backend=llama.name)
+        first_tokens = FIRST_TOKEN_SECONDS.count(backend=llama.name)
+
+        response = asyncio.run(
+            llama.generate_response([Message(ChatUser.HUMAN, "Hello")])
+        )
+
+        assert response == "token0 token1 token2 token3 "
+        assert llama.MAX_CONCURRENCY == 3
+        assert GENERATED_TOKENS.value(backend=llama.name) == tokens + 4
+        assert FIRST_TOKEN_SECONDS.count(backend=llama.name) == first_tokens + 1
+
+
+class TestSlowRequestProfiler:
+    def test_slow_requests_are_written(self, tmp_path):
+        profiler = SlowRequestProfiler(
+            threshold=0.05, interval=0.001, output_dir=tmp_path
+        )
+
+        with profiler.profile("fast"):
+            pass
+        with profiler.profile("slow"):
+            time.sleep(0.1)
+
+        files = list(tmp_path.iterdir())
+        assert profiler.stats() == {"profiled": 2, "slow": 1}
+        assert len(files) == 1
+        assert files[0].name.startswith("slow-")
+        assert "test_slow_requests_are_written" in files[0].read_text()
+
+    def test_sampling_threads_exit_without_being_joined(self):
+        profiler = SlowRequestProfiler(threshold=60, interval=0.001)
+
+        # Each request starts a thread, and stops it without waiting for it
+        for _ in range(3):
+            with profiler.profile("request"):
+                time.sleep(0.005)
+
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline and any(
+            thread.name == "profiler" for thread in threading.enumerate()
+        ):
+            time.sleep(0.01)
+        assert not any(thread.name == "profiler" for thread in threading.enumerate())
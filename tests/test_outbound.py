@@ -0,0 +1,110 @@
+import asyncio
+import time
+from types import SimpleNamespace
+import pytest
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.outbound import OutboundScheduler
+
+
+class RecordingMessage:
+    """Message that records the edits sent to Discord."""
+
+    def __init__(self, message_id, channel_id=1, fail=False):
+        self.id = message_id
+        self.channel = SimpleNamespace(id=channel_id)
+        self.fail = fail
+        self.calls = []
+
+    async def edit(self, **fields):
+        if self.fail:
+            raise RuntimeError("Unknown message")
+        self.calls.append(fields)
+        await asyncio.sleep(0.01)
+        return self
+
+
+class TestOutboundScheduler:
+    def test_pending_edits_are_merged(self):
+        outbound = OutboundScheduler(linger=0.01)
+        message = RecordingMessage(1)
+
+        async def run():
+            await outbound.edit(message, content="Hello", wait=False)
+            await outbound.edit(message, content="Hello, world", wait=False)
+            return await outbound.edit(message, view="view")
+
+        edited = asyncio.run(run())
+
+        assert edited is message
+        assert message.calls == [{"content": "Hello, world", "view": "view"}]
+        assert outbound.stats()["saved_calls"] == 2
+
+    def test_edits_are_sent_in_order(self):
+        outbound = OutboundScheduler(linger=0)
+        message = RecordingMessage(1)
+
+        async def run():
+            await outbound.edit(message, content="a", wait=False)
+            await asyncio.sleep(0.005)
+            # The first edit is being sent, so these are merged into a second one
+            await outbound.edit(message, content="b", wait=False)
+            await outbound.edit(message, content="c", wait=False)
+            await outbound.flush(message)
+
+        asyncio.run(run())
+
+        assert message.calls == [{"content": "a"}, {"content": "c"}]
+
+    def test_channel_rate_limit(self):
+        outbound = OutboundScheduler(rate_limit=2, period=0.2, linger=0)
+        messages = [RecordingMessage(i) for i in range(4)]
+
+        async def run():
+            start = time.monotonic()
+            await asyncio.gather(
+                *[outbound.edit(message, content="x") for message in messages]
+            )
+            return time.monotonic() - start
+
+        elapsed = asyncio.run(run())
+
+        # Two edits go right away, and the other two wait for the bucket to refill
+        assert elapsed >= 0.19
+        assert outbound.stats()["rate_limit_waits"] == 2
+        assert outbound.stats()["api_calls"] == 4
+
+    def test_failures_reach_waiting_callers(self):
+        outbound = OutboundScheduler(linger=0)
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(outbound.edit(RecordingMessage(1, fail=True), content="x"))
+        assert outbound.stats()["failures"] == 1
+
+
+class TestCoalescedButtons:
+    def test_rewrite_takes_two_calls(self):
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=FakeLlama(response_tokens=3, token_latency=0),
+            )
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            await discord.send_message(channel, user, "Hello")
+            response = channel.messages[-1]
+            edits = response.edits
+            await discord.click(response, "rewrite_response", user)
+            await discord.drain()
+            return bot, response, response.edits - edits
+
+        bot, response, edits = asyncio.run(run())
+
+        # The loading state acknowledges the click, and the new content is sent with the reset buttons
+        assert edits == 2
+        assert response.content == "token0 token1 token2"
+        assert not response.view.rewrite_response.disabled
+        assert bot.outbound.stats()["saved_calls"] >= 1
@@ -0,0 +1,44 @@
+from llama_discord_bot.prompt import PromptBuilder, Message, ChatUser
+
+
+class TestPromptBuilder:
+    def setup_method(self):
+        self.tokenized = []
+
+        def tokenize(text):
+            self.tokenized.append(text)
+            return [len(word) for word in text.split()]
+
+        self.builder = PromptBuilder(tokenize=tokenize)
+        self.messages = [
+            Message(ChatUser.HUMAN, "Hello, how are you?"),
+            Message(ChatUser.AI, "I'm fine, thanks!"),
+            Message(ChatUser.HUMAN, "That's good to hear!"),
+        ]
+
+    def test_exact_output(self):
+        prompt = self.builder.build(self.messages[:2], "Continue.", "Be nice.")
+
+        assert prompt == (
+            "<s>\n            [INST]\n            <<SYS>>Be nice.<</SYS>>\n"
+            "            Hello, how are you?\n            [/INST]\n"
+            "            I'm fine, thanks!\n            </s>\n"
+            "            <s>\n            [INST]\n            Continue.\n"
+            "            [/INST]\n            </s>"
+        )
+
+    def test_new_turn_only_renders_new_segments(self):
+        self.builder.build(self.messages[:2])
+        self.builder.build(self.messages)
+
+        stats = self.builder.stats()
+        assert stats["segment_hits"] == 1
+        assert stats["segment_misses"] == 2
+
+    def test_tokens_are_cached_per_segment(self):
+        first = self.builder.build_tokens(self.messages[:2])
+        tokenized = len(self.tokenized)
+        second = self.builder.build_tokens(self.messages)
+
+        assert second[: len(first)] == first
+        assert len(self.tokenized) == tokenized + 1
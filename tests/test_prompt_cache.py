@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from llama_cpp import LlamaState
+from llama_discord_bot.prompt_cache import PromptStateCache
+
+
+def make_state(tokens, size=100):
+    return LlamaState(
+        input_ids=np.array(tokens, dtype=np.intc),
+        scores=np.zeros((len(tokens), 1), dtype=np.single),
+        n_tokens=len(tokens),
+        llama_state=bytes(size),
+        llama_state_size=size,
+    )
+
+
+class TestPromptStateCache:
+    def test_longest_prefix_lookup(self):
+        cache = PromptStateCache()
+        cache.channel = 1
+        cache[[1, 2, 3, 4]] = make_state([1, 2, 3, 4])
+
+        state = cache[[1, 2, 3, 9, 9]]
+
+        assert state.n_tokens == 4
+        assert cache.last_prefix_length == 3
+        assert cache.stats()["prefix_hits"] == 1
+
+    def test_lookups_are_scoped_by_channel(self):
+        cache = PromptStateCache()
+        cache.channel = 1
+        cache[[1, 2, 3]] = make_state([1, 2, 3])
+
+        cache.channel = 2
+        with pytest.raises(KeyError):
+            cache[[1, 2, 3]]  # pylint: disable=pointless-statement
+
+    def test_prefix_states_are_replaced(self):
+        cache = PromptStateCache()
+        cache.channel = 1
+        cache[[1, 2]] = make_state([1, 2])
+        cache[[1, 2, 3]] = make_state([1, 2, 3])
+
+        assert cache.stats()["entries"] == 1
+
+    def test_eviction_spills_to_disk(self, tmp_path):
+        cache = PromptStateCache(capacity_bytes=150, disk_path=str(tmp_path))
+        cache.channel = 1
+        cache[[1, 2]] = make_state([1, 2])
+        cache.channel = 2
+        cache[[3, 4]] = make_state([3, 4])
+
+        assert cache.stats()["entries"] == 1
+        assert cache.stats()["disk_entries"] == 1
+
+        cache.channel = 1
+        assert cache[[1, 2, 5]].n_tokens == 2
+        assert cache.stats()["disk_hits"] == 1
+
+    def test_tokens_saved(self):
+        cache = PromptStateCache()
+        cache.record_completion(prompt_tokens=100, reused_tokens=90)
+
+        assert cache.stats()["tokens_saved"] == 90
+        assert cache.stats()["tokens_evaluated"] == 10
+        assert cache.stats()["tokens_saved_ratio"] == pytest.approx(0.9)
@@ -0,0 +1,145 @@
+import asyncio
+import pytest
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.quotas import QuotaExceededError, QuotaLimit, RequestQuotas
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestRequestQuotas:
+    def test_request_quota_refills(self):
+        clock = FakeClock()
+        quotas = RequestQuotas(user=QuotaLimit(requests=2, period=10), clock=clock)
+
+        quotas.admit(1, None, 10)
+        quotas.admit(1, None, 10)
+        with pytest.raises(QuotaExceededError) as error:
+            quotas.admit(1, None, 10)
+        # Other users have their own quota
+        quotas.admit(2, None, 10)
+
+        assert error.value.scope == "user"
+        assert error.value.retry_after == pytest.approx(5)
+        clock.now = 5
+        quotas.admit(1, None, 10)
+        assert quotas.stats()["admitted"] == 4
+        assert quotas.stats()["rejected"] == 1
+
+    def test_token_quota_goes_into_debt(self):
+        clock = FakeClock()
+        quotas = RequestQuotas(guild=QuotaLimit(tokens=100, period=10), clock=clock)
+
+        quotas.admit(1, 5, 10)
+        quotas.charge(1, 5, 10, 150)
+        with pytest.raises(QuotaExceededError) as error:
+            quotas.admit(2, 5, 11)
+        # Direct messages have no guild quota
+        quotas.admit(2, None, 11)
+
+        assert error.value.limit == "tokens"
+        assert error.value.retry_after == pytest.approx(5)
+        clock.now = 6
+        quotas.admit(2, 5, 11)
+
+    def test_rejected_requests_take_nothing(self):
+        quotas = RequestQuotas(
+            user=QuotaLimit(requests=5), channel=QuotaLimit(requests=1)
+        )
+
+        quotas.admit(1, None, 10)
+        for _ in range(3):
+            with pytest.raises(QuotaExceededError):
+                quotas.admit(1, None, 10)
+
+        # The user quota was only taken by the admitted request
+        quotas.admit(1, None, 11)
+        quotas.admit(1, None, 12)
+
+    def test_buckets_are_bounded(self):
+        quotas = RequestQuotas(user=QuotaLimit(requests=1), max_buckets=10)
+
+        for user_id in range(100):
+            quotas.admit(user_id, None, 10)
+
+        assert quotas.stats()["buckets"] == 10
+
+    def test_rejections_are_notified_once_per_period(self):
+        clock = FakeClock()
+        quotas = RequestQuotas(user=QuotaLimit(requests=1, period=60), clock=clock)
+        exception = QuotaExceededError("user", "requests", 60)
+
+        notified = [quotas.notify(1, exception), quotas.notify(1, exception)]
+        # Other users are told about their own rejections
+        notified.append(quotas.notify(2, exception))
+        clock.now = 60
+        notified.append(quotas.notify(1, exception))
+
+        assert notified == [True, False, True, True]
+        assert quotas.stats()["silenced"] == 1
+
+
+class TestQuotasInTheBot:
+    def test_over_quota_messages_are_not_generated(self):
+        llama = FakeLlama(response_tokens=2, token_latency=0)
+
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=llama,
+                user_quota=QuotaLimit(requests=1),
+            )
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            await discord.send_message(channel, user, "Hello")
+            await discord.send_message(channel, user, "Hello again")
+            response = channel.messages[1]
+            await discord.click(response, "rewrite_response", user)
+            await discord.drain()
+            return bot, channel
+
+        bot, channel = asyncio.run(run())
+
+        assert llama.generations == 1
+        assert channel.messages[-1].embed.description.startswith(
+            "You're sending requests too fast"
+        )
+        stats = bot.quotas.stats()
+        assert stats["admitted"] == 1
+        assert stats["rejected"] == 2
+        # The tokens of the response were charged
+        assert stats["tokens"] == llama.count_tokens("token0 token1 ")
+
+    def test_spam_past_the_quota_is_answered_once(self):
+        llama = FakeLlama(response_tokens=2, token_latency=0)
+
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=llama,
+                user_quota=QuotaLimit(requests=1),
+            )
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            for i in range(5):
+                await discord.send_message(channel, user, f"Spam {i}")
+            await discord.drain()
+            return channel
+
+        channel = asyncio.run(run())
+
+        notices = [message for message in channel.messages if message.embed]
+        assert len(notices) == 1
+        assert len(channel.messages) == 5 + 1 + 1
@@ -0,0 +1,162 @@
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from llama_discord_bot.generation_config import GenerationConfig
+from llama_discord_bot.llama import LlamaReplicate, Message, ChatUser
+from llama_discord_bot.replicate_client import ReplicateClient, ReplicateError
+
+
+class MockReplicate:
+    """Local stand-in for the replicate API. Each poll of a prediction generates one more output chunk."""
+
+    def __init__(self, chunks, fail_polls=0, fail_creates=0, status="succeeded"):
+        self.chunks = chunks
+        self.fail_polls = fail_polls
+        self.fail_creates = fail_creates
+        self.status = status
+        self.predictions = {}
+        self.requests = []
+        self.authorization = None
+        self.app = web.Application()
+        self.app.router.add_post("/v1/predictions", self.create)
+        self.app.router.add_get("/v1/predictions/{id}", self.get)
+        self.app.router.add_post("/v1/predictions/{id}/cancel", self.cancel)
+
+    async def create(self, request):
+        self.requests.append("create")
+        self.authorization = request.headers.get("Authorization")
+        if self.fail_creates:
+            self.fail_creates -= 1
+            return web.json_response({"detail": "Rate limited"}, status=429)
+        body = await request.json()
+        prediction = {
+            "id": str(len(self.predictions)),
+            "version": body["version"],
+            "input": body["input"],
+            "status": "starting",
+            "output": [],
+            "error": None,
+        }
+        self.predictions[prediction["id"]] = prediction
+        return web.json_response(prediction, status=201)
+
+    async def get(self, request):
+        self.requests.append("get")
+        if self.fail_polls:
+            self.fail_polls -= 1
+            return web.Response(status=503)
+        prediction = self.predictions[request.match_info["id"]]
+        if prediction["status"] in {"starting", "processing"}:
+            if len(prediction["output"]) < len(self.chunks):
+                prediction["status"] = "processing"
+                prediction["output"].append(self.chunks[len(prediction["output"])])
+            else:
+                prediction["status"] = self.status
+                if self.status == "failed":
+                    prediction["error"] = "Out of memory"
+        return web.json_response(prediction)
+
+    async def cancel(self, request):
+        self.requests.append("cancel")
+        prediction = self.predictions[request.match_info["id"]]
+        prediction["status"] = "canceled"
+        return web.json_response(prediction)
+
+
+async def serve(mock, test):
+    server = TestServer(mock.app)
+    await server.start_server()
+    client = ReplicateClient(
+        api_token="token",
+        base_url=str(server.make_url("")).rstrip("/"),
+        poll_interval=0.001,
+        backoff=0.001,
+    )
+    try:
+        return await test(client)
+    finally:
+        await client.close()
+        await server.close()
+
+
+async def collect(client, model="owner/model:version"):
+    return [chunk async for chunk in client.stream(model, {"prompt": "Hi"})]
+
+
+class TestReplicateClient:
+    def test_stream_yields_output_as_it_grows(self):
+        mock = MockReplicate(["Hello", ",", " world"])
+
+        chunks = asyncio.run(serve(mock, collect))
+
+        assert chunks == ["Hello", ",", " world"]
+        assert mock.authorization == "Token token"
+        assert mock.predictions["0"]["version"] == "version"
+
+    def test_failed_requests_are_retried(self):
+        mock = MockReplicate(["Hello"], fail_polls=2, fail_creates=1)
+
+        async def test(client):
+            return await collect(client), client.stats()
+
+        chunks, stats = asyncio.run(serve(mock, test))
+
+        assert chunks == ["Hello"]
+        assert stats["retries"] == 3
+        assert mock.requests.count("create") == 2
+
+    def test_abandoned_prediction_is_cancelled(self):
+        mock = MockReplicate(["Hello", ",", " world"])
+
+        async def test(client):
+            chunks = client.stream("owner/model:version", {"prompt": "Hi"})
+            assert await anext(chunks) == "Hello"
+            await chunks.aclose()
+
+        asyncio.run(serve(mock, test))
+
+        assert mock.requests[-1] == "cancel"
+        assert mock.predictions["0"]["status"] == "canceled"
+
+    def test_failed_prediction_raises(self):
+        mock = MockReplicate(["Hello"], status="failed")
+
+        with pytest.raises(ReplicateError, match="Out of memory"):
+            asyncio.run(serve(mock, collect))
+
+
+class TestLlamaReplicate:
+    def test_generate_response(self):
+        mock = MockReplicate(["Hello", " there"])
+
+        async def test(client):
+            llama = LlamaReplicate("owner/model:version", client=client)
+            return await llama.generate_response(
+                [Message(ChatUser.HUMAN, "Hello, how are you?")]
+            )
+
+        assert asyncio.run(serve(mock, test)) == "Hello there"
+        assert "Hello, how are you?" in mock.predictions["0"]["input"]["prompt"]
+
+    def test_generation_settings_and_stop_sequences(self):
+        mock = MockReplicate(["Fine", ", thanks [", "INST] And you?"])
+
+        async def test(client):
+            llama = LlamaReplicate(
+                "owner/model:version",
+                client=client,
+                generation_config=GenerationConfig(temperature=0.5),
+            )
+            return await llama.generate_response(
+                [Message(ChatUser.HUMAN, "Hello, how are you?")],
+                config=GenerationConfig(max_tokens=100),
+            )
+
+        assert asyncio.run(serve(mock, test)) == "Fine, thanks "
+        prediction_input = mock.predictions["0"]["input"]
+        assert prediction_input["max_new_tokens"] == 100
+        assert prediction_input["temperature"] == 0.5
+        assert "[INST]" in prediction_input["stop_sequences"].split(",")
+        # Reaching a stop sequence cancels the prediction
+        assert mock.requests[-1] == "cancel"
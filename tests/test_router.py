@@ -0,0 +1,153 @@
+import asyncio
+import pytest
+from llama_discord_bot.fakes import FakeLlama
+from llama_discord_bot.llama import ChatUser, Message
+from llama_discord_bot.loader import BackgroundLoadedLlama
+from llama_discord_bot.router import (
+    CircuitBreaker,
+    LlamaRouter,
+    NoBackendAvailableError,
+)
+from llama_discord_bot.scheduler import ScheduledLlama
+
+MESSAGES = [Message(ChatUser.HUMAN, "Hello")]
+
+
+class FailingLlama(FakeLlama):
+    """Fails every generation, optionally after streaming some text."""
+
+    def __init__(self, tokens_before_failing: int = 0, **kwargs):
+        super().__init__(token_latency=0, **kwargs)
+        self.tokens_before_failing = tokens_before_failing
+
+    async def stream_response(self, messages, suffix="", **kwargs):
+        self.generations += 1
+        for i in range(self.tokens_before_failing):
+            yield f"partial{i} "
+        raise RuntimeError("Backend down")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestCircuitBreaker:
+    def test_opens_and_half_opens(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+
+        breaker.record_failure()
+        assert breaker.state == "closed"
+        breaker.record_failure()
+        assert breaker.state == "open"
+        assert not breaker.allow()
+
+        clock.now = 10
+        assert breaker.state == "half_open"
+        # A failed trial opens the breaker again
+        breaker.record_failure()
+        assert breaker.state == "open"
+        assert breaker.trips == 2
+
+        clock.now = 20
+        breaker.record_success()
+        assert breaker.state == "closed"
+
+
+class TestLlamaRouter:
+    def test_routes_to_the_fastest_backend(self):
+        fast = FakeLlama(response_tokens=1, token_latency=0.001)
+        slow = FakeLlama(response_tokens=1, token_latency=0.05)
+        router = LlamaRouter([slow, fast])
+
+        async def run():
+            for _ in range(5):
+                await router.generate_response(MESSAGES)
+
+        asyncio.run(run())
+
+        # Both are measured once, then the fast one takes every request
+        assert slow.generations == 1
+        assert fast.generations == 4
+        assert router.stats()["backend1_latency_seconds"] > 0
+
+    def test_overflow_is_used_when_saturated(self):
+        local = FakeLlama(response_tokens=2, token_latency=0.02)
+        overflow = FakeLlama(response_tokens=2, token_latency=0.02)
+        router = LlamaRouter([local], overflow=[overflow])
+
+        async def run():
+            await router.generate_response(MESSAGES)
+            await asyncio.gather(
+                router.generate_response(MESSAGES), router.generate_response(MESSAGES)
+            )
+
+        asyncio.run(run())
+
+        assert local.generations == 2
+        assert overflow.generations == 1
+        assert router.MAX_CONCURRENCY == 2
+
+    def test_fails_over_before_the_first_chunk(self):
+        failing = FailingLlama()
+        healthy = FakeLlama(response_tokens=2, token_latency=0)
+        router = LlamaRouter([failing, healthy], failure_threshold=2)
+
+        async def run():
+            return [await router.generate_response(MESSAGES) for _ in range(3)]
+
+        responses = asyncio.run(run())
+        stats = router.stats()
+
+        assert responses == ["token0 token1 "] * 3
+        # The circuit breaker stops trying the failing backend after two failures
+        assert failing.generations == 2
+        assert stats["failovers"] == 2
+        assert stats["backend0_circuit_open"] == 1
+
+    def test_errors_after_the_first_chunk_are_raised(self):
+        router = LlamaRouter(
+            [FailingLlama(tokens_before_failing=1), FakeLlama(token_latency=0)]
+        )
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(router.generate_response(MESSAGES))
+
+    def test_every_backend_failing(self):
+        router = LlamaRouter([FailingLlama()], failure_threshold=1)
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(router.generate_response(MESSAGES))
+        with pytest.raises(NoBackendAvailableError):
+            asyncio.run(router.generate_response(MESSAGES))
+
+    def test_saturated_backend_is_waited_for_while_another_loads(self):
+        running = 0
+        max_running = 0
+
+        def on_event(event):
+            nonlocal running, max_running
+            running += event == "start"
+            running -= event in ("finish", "cancel")
+            max_running = max(max_running, running)
+
+        ready = FakeLlama(response_tokens=2, token_latency=0.01, on_event=on_event)
+        loading = BackgroundLoadedLlama(FakeLlama, name="Loading")
+        llama = ScheduledLlama(LlamaRouter([ready, loading]))
+
+        async def run():
+            return await asyncio.gather(
+                llama.generate_response(MESSAGES), llama.generate_response(MESSAGES)
+            )
+
+        responses = asyncio.run(run())
+
+        # The scheduler lets both requests in, but the ready backend runs them one at a time
+        assert llama.scheduler.max_concurrency == 2
+        assert responses == ["token0 token1 "] * 2
+        assert max_running == 1
+        assert ready.generations == 2
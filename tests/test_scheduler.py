@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from llama_discord_bot.scheduler import InferenceScheduler, SchedulerBusyError
+
+
+async def hold_slot(scheduler, order, name, channel_id, guild_id=None, started=None):
+    async with scheduler.slot(channel_id=channel_id, guild_id=guild_id):
+        order.append(name)
+        if started is not None:
+            started.set()
+        await asyncio.sleep(0.01)
+
+
+class TestInferenceScheduler:
+    def test_round_robin_across_channels(self):
+        async def run():
+            scheduler = InferenceScheduler(max_concurrency=1)
+            order = []
+            started = asyncio.Event()
+            first = asyncio.create_task(
+                hold_slot(scheduler, order, "first", 0, started=started)
+            )
+            await started.wait()
+
+            # Channel 1 queues three requests before channel 2 queues one
+            tasks = [
+                asyncio.create_task(hold_slot(scheduler, order, f"a{i}", 1))
+                for i in range(3)
+            ]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(hold_slot(scheduler, order, "b0", 2)))
+            await asyncio.gather(first, *tasks)
+            return order, scheduler.stats()
+
+        order, stats = asyncio.run(run())
+
+        assert order == ["first", "a0", "b0", "a1", "a2"]
+        assert stats["admitted"] == 5
+        assert stats["max_queue_depth"] == 4
+
+    def test_round_robin_across_guilds(self):
+        async def run():
+            scheduler = InferenceScheduler(max_concurrency=1)
+            order = []
+            started = asyncio.Event()
+            first = asyncio.create_task(
+                hold_slot(scheduler, order, "first", 0, started=started)
+            )
+            await started.wait()
+
+            # Guild 1 has two busy channels, guild 2 has one
+            tasks = [
+                asyncio.create_task(hold_slot(scheduler, order, name, channel, guild))
+                for name, channel, guild in [
+                    ("g1c1", 1, 1),
+                    ("g1c2", 2, 1),
+                    ("g2c3", 3, 2),
+                ]
+            ]
+            await asyncio.gather(first, *tasks)
+            return order
+
+        assert asyncio.run(run()) == ["first", "g1c1", "g2c3", "g1c2"]
+
+    def test_full_queue_is_rejected(self):
+        async def run():
+            scheduler = InferenceScheduler(max_concurrency=1, max_queue=1)
+            order = []
+            started = asyncio.Event()
+            first = asyncio.create_task(
+                hold_slot(scheduler, order, "first", 0, started=started)
+            )
+            await started.wait()
+            queued = asyncio.create_task(hold_slot(scheduler, order, "queued", 0))
+            await asyncio.sleep(0)
+
+            with pytest.raises(SchedulerBusyError):
+                await hold_slot(scheduler, order, "rejected", 0)
+            await asyncio.gather(first, queued)
+            return scheduler.stats()
+
+        stats = asyncio.run(run())
+
+        assert stats["rejected"] == 1
+        assert stats["admitted"] == 2
+
+    def test_cancelled_waiter_leaves_queue(self):
+        async def run():
+            scheduler = InferenceScheduler(max_concurrency=1)
+            order = []
+            started = asyncio.Event()
+            first = asyncio.create_task(
+                hold_slot(scheduler, order, "first", 0, started=started)
+            )
+            await started.wait()
+            queued = asyncio.create_task(hold_slot(scheduler, order, "queued", 1))
+            await asyncio.sleep(0)
+            queued.cancel()
+            await first
+            return order, scheduler
+
+        order, scheduler = asyncio.run(run())
+
+        assert order == ["first"]
+        assert scheduler.idle
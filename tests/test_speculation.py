@@ -0,0 +1,169 @@
+import asyncio
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.llama import ChatUser, Message
+from llama_discord_bot.metrics import EVENTS
+from llama_discord_bot.scheduler import ScheduledLlama
+from llama_discord_bot.speculation import ContinuationSpeculator
+
+MESSAGES = [Message(ChatUser.HUMAN, "Hello"), Message(ChatUser.AI, "Hi")]
+
+
+def make_speculator(token_latency=0.001, response_tokens=4, **kwargs):
+    llama = ScheduledLlama(
+        FakeLlama(response_tokens=response_tokens, token_latency=token_latency)
+    )
+    return llama, ContinuationSpeculator(llama, llama.scheduler, "Continue", **kwargs)
+
+
+async def collect(chunks):
+    return "".join([chunk async for chunk in chunks])
+
+
+class TestContinuationSpeculator:
+    def test_serves_the_generated_continuation(self):
+        llama, speculator = make_speculator()
+
+        async def run():
+            assert speculator.start(1, MESSAGES, channel_id=10)
+            await asyncio.sleep(0.05)
+            return await collect(speculator.take(1, MESSAGES))
+
+        assert asyncio.run(run()) == "token0 token1 token2 token3 "
+        assert llama.llama.generations == 1
+        assert speculator.stats()["served"] == 1
+        assert speculator.stats()["entries"] == 0
+
+    def test_follows_a_running_generation(self):
+        llama, speculator = make_speculator(token_latency=0.01)
+
+        async def run():
+            speculator.start(1, MESSAGES, channel_id=10)
+            await asyncio.sleep(0.015)
+            return await collect(speculator.take(1, MESSAGES))
+
+        assert asyncio.run(run()) == "token0 token1 token2 token3 "
+        assert llama.llama.generations == 1
+
+    def test_changed_messages_are_not_served(self):
+        _, speculator = make_speculator()
+
+        async def run():
+            speculator.start(1, MESSAGES, channel_id=10)
+            await asyncio.sleep(0.05)
+            return speculator.take(1, MESSAGES + [Message(ChatUser.HUMAN, "More")])
+
+        assert asyncio.run(run()) is None
+        assert speculator.stats()["discarded"] == 1
+
+    def test_invalidated_by_the_channel(self):
+        _, speculator = make_speculator()
+
+        async def run():
+            speculator.start(1, MESSAGES, channel_id=10)
+            speculator.invalidate(10)
+            return speculator.take(1, MESSAGES)
+
+        assert asyncio.run(run()) is None
+        assert speculator.stats()["wasted_tokens"] == 0
+
+    def test_yields_to_real_requests(self):
+        llama, speculator = make_speculator(token_latency=0.01, response_tokens=20)
+
+        async def run():
+            speculator.start(1, MESSAGES, channel_id=10)
+            await asyncio.sleep(0.02)
+            # The real request waits for the slot the speculation holds, which preempts it
+            return await asyncio.wait_for(
+                llama.generate_response(MESSAGES, channel_id=20), timeout=1
+            )
+
+        assert asyncio.run(run()).startswith("token0 ")
+        assert speculator.stats()["preempted"] == 1
+        assert speculator.stats()["entries"] == 0
+
+    def test_only_starts_while_idle(self):
+        llama, speculator = make_speculator()
+
+        async def run():
+            async with llama.scheduler.slot():
+                busy = speculator.start(1, MESSAGES, channel_id=10)
+            idle = speculator.start(2, MESSAGES, channel_id=10)
+            # Only one speculation runs at a time
+            second = speculator.start(3, MESSAGES, channel_id=10)
+            await speculator.close()
+            return busy, idle, second
+
+        assert asyncio.run(run()) == (False, True, False)
+
+    def test_budget(self):
+        _, speculator = make_speculator(response_tokens=10, token_budget=4)
+
+        async def run():
+            speculator.start(1, MESSAGES, channel_id=10)
+            await asyncio.sleep(0.1)
+            return speculator.take(1, MESSAGES), speculator.can_start()
+
+        # An incomplete continuation is thrown away, and no more are started until the budget refills
+        assert asyncio.run(run()) == (None, False)
+        assert speculator.stats()["wasted_tokens"] == 4
+
+
+class TestSpeculatedContinuation:
+    def test_click_is_served_from_the_speculation(self):
+        llama = FakeLlama(response_tokens=3, token_latency=0)
+
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=llama,
+                speculation_token_budget=1024,
+            )
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            await discord.send_message(channel, user, "Hello")
+            await discord.drain()
+            generations = llama.generations
+            response = channel.messages[1]
+            await discord.click(response, "continue_response", user)
+            await discord.drain()
+            return bot, channel, generations
+
+        bot, channel, generations = asyncio.run(run())
+
+        # The response and its continuation were generated before the click, which did not generate anything
+        assert generations == 2
+        assert llama.generations == 2
+        assert channel.messages[-1].content == "token0 token1 token2"
+        assert bot.speculator.stats()["served"] == 1
+
+    def test_superseded_response_is_not_speculated_on(self):
+        llama = FakeLlama(response_tokens=3, token_latency=0.01)
+
+        async def run():
+            bot = DiscordBot(
+                local=False,
+                discord_api_token=None,
+                llama=llama,
+                speculation_token_budget=1024,
+            )
+            discord = FakeDiscord(bot)
+            channel = discord.channels[0]
+            user = FakeUser(100, "user")
+
+            errors = EVENTS.value(handler="on_message", outcome="error")
+            discord.send_message(channel, user, "Hello")
+            await asyncio.sleep(0.015)
+            discord.send_message(channel, user, "Are you there?")
+            await discord.drain()
+            return bot, EVENTS.value(handler="on_message", outcome="error") - errors
+
+        bot, errors = asyncio.run(run())
+
+        # Only the response to the newer message is continued ahead of time
+        assert errors == 0
+        assert bot.generations.stats()["superseded"] == 1
+        assert bot.speculator.stats()["started"] == 1
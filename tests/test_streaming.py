@@ -0,0 +1,128 @@
+import asyncio
+import time
+import pytest
+from llama_discord_bot.run_async import run_async_iter
+from llama_discord_bot.streaming import EMPTY_RESPONSE, stream_to_message
+
+
+async def iterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content):
+        self.content = content
+        self.edits += 1
+        return self
+
+
+async def send(content):
+    return FakeMessage(content)
+
+
+async def edit(message, content):
+    return await message.edit(content)
+
+
+class TestStreamToMessage:
+    def test_sends_on_first_visible_chunk(self):
+        message, content = asyncio.run(
+            stream_to_message(
+                iterate([" ", "Hello", ",", " world"]),
+                send=send,
+                edit=edit,
+                min_edit_interval=0,
+            )
+        )
+
+        assert content == " Hello, world"
+        assert message.content == content
+        assert message.edits == 2
+
+    def test_edits_are_throttled(self):
+        message, _ = asyncio.run(
+            stream_to_message(
+                iterate(["a", "b", "c", "d"]),
+                send=send,
+                edit=edit,
+                min_edit_interval=60,
+            )
+        )
+
+        # Only the final edit is done, since all chunks arrive within the interval
+        assert message.content == "abcd"
+        assert message.edits == 1
+
+    @pytest.mark.parametrize("chunks", [[], ["", " ", "\n"]])
+    def test_empty_response_is_sent_as_a_placeholder(self, chunks):
+        message, content = asyncio.run(
+            stream_to_message(iterate(chunks), send=send, edit=edit)
+        )
+
+        # Discord rejects messages without visible text
+        assert content == EMPTY_RESPONSE
+        assert message.content == EMPTY_RESPONSE
+
+    def test_long_responses_are_cut(self):
+        closed = False
+
+        async def endless():
+            nonlocal closed
+            try:
+                while True:
+                    yield "word "
+            finally:
+                closed = True
+
+        message, content = asyncio.run(
+            stream_to_message(endless(), send=send, edit=edit, max_length=12)
+        )
+
+        # The stream is closed at the limit, so the generation stops there
+        assert content == "word word wo"
+        assert message.content == content
+        assert closed
+
+
+class TestRunAsyncIter:
+    def test_yields_items_and_propagates_errors(self):
+        @run_async_iter
+        def generate(count):
+            yield from range(count)
+            raise ValueError("done")
+
+        async def consume():
+            items = []
+            try:
+                async for item in generate(3):
+                    items.append(item)
+            except ValueError:
+                return items
+            return None
+
+        assert asyncio.run(consume()) == [0, 1, 2]
+
+    def test_stops_generator_when_consumer_stops(self):
+        produced = []
+
+        @run_async_iter
+        def generate():
+            for i in range(1000):
+                produced.append(i)
+                time.sleep(0.001)
+                yield i
+
+        async def consume():
+            iterator = generate()
+            async for item in iterator:
+                if item == 2:
+                    break
+            await iterator.aclose()
+
+        asyncio.run(consume())
+        assert len(produced) < 1000
@@ -0,0 +1,168 @@
+import asyncio
+from llama_discord_bot.llama import ChatUser, LlamaBase, Message
+from llama_discord_bot.scheduler import InferenceScheduler
+from llama_discord_bot.summarizer import ConversationSummarizer
+
+
+class SummarizingLlama(LlamaBase):
+    """Answers every prompt with a short summary, remembering the prompts it got."""
+
+    def __init__(self):
+        super().__init__("Be nice.")
+        self.prompts = []
+        self.configs = []
+
+    async def generate_response(self, messages, suffix="", **kwargs):
+        self.prompts.append(messages[-1].content)
+        self.configs.append(kwargs.get("config"))
+        return f"summary {len(self.prompts)}"
+
+
+def make_messages(count, start=0):
+    return [
+        Message(
+            ChatUser.HUMAN if i % 2 == 0 else ChatUser.AI,
+            f"a long message number {i} " * 10,
+        )
+        for i in range(start, start + count)
+    ]
+
+
+async def settle(summarizer):
+    while summarizer._tasks:
+        await asyncio.gather(*summarizer._tasks.values())
+
+
+class TestSystemMessages:
+    def test_placed_after_the_system_prompt(self):
+        llama = SummarizingLlama()
+        prompt = llama._generate_prompt(
+            [Message(ChatUser.SYSTEM, "Earlier: hi"), Message(ChatUser.HUMAN, "Hello")],
+            "",
+        )
+
+        assert "<<SYS>>Be nice.\n\nEarlier: hi<</SYS>>" in prompt
+        assert prompt.count("[INST]") == 1
+
+    def test_always_selected(self):
+        llama = SummarizingLlama()
+        llama.CONTEXT_WINDOW = 1024
+        messages = [Message(ChatUser.SYSTEM, "Earlier: hi")] + make_messages(40)
+
+        selected = llama.select_context(messages)
+
+        assert selected[0] == messages[0]
+        assert selected[-1] == messages[-1]
+        assert len(selected) < len(messages)
+
+
+class TestConversationSummarizer:
+    def test_older_messages_are_summarized(self):
+        llama = SummarizingLlama()
+        summarizer = ConversationSummarizer(
+            llama, InferenceScheduler(), keep_messages=4, min_messages=4
+        )
+        messages = make_messages(12)
+
+        async def run():
+            first = summarizer.apply(1, messages)
+            await settle(summarizer)
+            second = summarizer.apply(1, messages + make_messages(2, start=12))
+            return first, second
+
+        first, second = asyncio.run(run())
+
+        # There is no summary yet, but one is made of the 8 messages before the latest 4
+        assert first == messages
+        assert "a long message number 7" in llama.prompts[0]
+        assert "a long message number 8" not in llama.prompts[0]
+        assert second[0] == Message(
+            ChatUser.SYSTEM, "Summary of the earlier conversation: summary 1"
+        )
+        assert second[1:] == make_messages(6, start=8)
+        assert summarizer.stats()["tokens_saved"] > 0
+
+    def test_refreshes_are_incremental(self):
+        llama = SummarizingLlama()
+        summarizer = ConversationSummarizer(
+            llama, InferenceScheduler(), keep_messages=2, min_messages=2
+        )
+
+        async def run():
+            summarizer.apply(1, make_messages(4))
+            await settle(summarizer)
+            summarized = summarizer.apply(1, make_messages(6))
+            await settle(summarizer)
+            return summarized
+
+        summarized = asyncio.run(run())
+
+        assert len(summarized) == 5
+        assert "Summary so far: summary 1" in llama.prompts[1]
+        assert "a long message number 1 " not in llama.prompts[1]
+        assert summarizer.stats()["refreshes"] == 2
+
+    def test_waits_for_a_free_slot(self):
+        llama = SummarizingLlama()
+        scheduler = InferenceScheduler(max_concurrency=1)
+        summarizer = ConversationSummarizer(
+            llama, scheduler, keep_messages=2, min_messages=2, idle_poll_interval=0.01
+        )
+
+        async def run():
+            async with scheduler.slot():
+                summarizer.apply(1, make_messages(4))
+                await asyncio.sleep(0.05)
+                waiting = len(llama.prompts)
+            await settle(summarizer)
+            return waiting
+
+        assert asyncio.run(run()) == 0
+        assert len(llama.prompts) == 1
+
+    def test_changed_history_drops_the_summary(self):
+        summarizer = ConversationSummarizer(
+            SummarizingLlama(), InferenceScheduler(), keep_messages=2, min_messages=2
+        )
+
+        async def run():
+            summarizer.apply(1, make_messages(4))
+            await settle(summarizer)
+            return summarizer.apply(1, make_messages(3, start=100))
+
+        messages = asyncio.run(run())
+
+        assert messages == make_messages(3, start=100)
+        assert summarizer.stats()["channels"] == 0
+
+    def test_refreshes_fit_in_the_context_window(self):
+        llama = SummarizingLlama()
+        summarizer = ConversationSummarizer(
+            llama,
+            InferenceScheduler(),
+            keep_messages=2,
+            min_messages=2,
+            max_summary_tokens=64,
+            context_window=400,
+        )
+        messages = make_messages(42)
+
+        async def run():
+            summarizer.apply(1, messages)
+            await settle(summarizer)
+            summarizer.apply(1, messages)
+            await settle(summarizer)
+
+        asyncio.run(run())
+
+        # Each refresh covers the oldest messages that fit, and the next one goes on from there
+        first, second = llama.prompts
+        assert "a long message number 0 " in first
+        assert "a long message number 39 " not in first
+        assert "Summary so far: summary 1" in second
+        assert "a long message number 0 " not in second
+        for prompt in llama.prompts:
+            assert (
+                llama.count_prompt_tokens([Message(ChatUser.HUMAN, prompt)]) + 64 <= 400
+            )
+        assert [config.max_tokens for config in llama.configs] == [64, 64]
@@ -0,0 +1,92 @@
+import asyncio
+from llama_discord_bot.discord_bot import DiscordBot
+from llama_discord_bot.fakes import FakeDiscord, FakeLlama, FakeUser
+from llama_discord_bot.replay import run_replay
+from llama_discord_bot.traces import (
+    CONTINUE,
+    MESSAGE,
+    RESPONSE,
+    REWRITE,
+    TraceRecorder,
+    read_trace,
+)
+
+
+def record(path):
+    async def run():
+        bot = DiscordBot(
+            local=False,
+            discord_api_token=None,
+            llama=FakeLlama(response_tokens=3, token_latency=0),
+            trace_path=path,
+        )
+        discord = FakeDiscord(bot, channels=2)
+        user = FakeUser(100, "user")
+
+        await discord.send_message(discord.channels[0], user, "Hello")
+        await discord.send_message(discord.channels[1], user, "Hi there")
+        await discord.drain()
+        response = discord.channels[0].messages[1]
+        await discord.click(response, "rewrite_response", user)
+        await discord.click(response, "continue_response", user)
+        await discord.drain()
+        await bot.close()
+
+    asyncio.run(run())
+
+
+class TestTraceRecorder:
+    def test_records_anonymized_events(self, tmp_path):
+        path = str(tmp_path / "trace.jsonl")
+        record(path)
+
+        events = list(read_trace(path))
+
+        assert [event.kind for event in events] == [
+            MESSAGE,
+            RESPONSE,
+            MESSAGE,
+            RESPONSE,
+            REWRITE,
+            CONTINUE,
+        ]
+        assert events[0].size == len("Hello")
+        assert events[1].size == len("token0 token1 token2 ")
+        # IDs are replaced by pseudonyms, which still link the events together
+        assert events[0].user not in {100, None}
+        assert events[0].user == events[2].user == events[4].user
+        assert events[1].user is None
+        assert events[0].channel == events[1].channel != events[2].channel
+        assert events[4].message == events[5].message == events[0].message
+        assert events[1].time >= events[0].time
+
+    def test_pseudonyms_depend_on_the_salt(self, tmp_path):
+        first = TraceRecorder(str(tmp_path / "first.jsonl"), salt=b"a")
+        second = TraceRecorder(str(tmp_path / "second.jsonl"), salt=b"b")
+
+        assert first._pseudonym(1) == first._pseudonym(1)
+        assert first._pseudonym(1) != second._pseudonym(1)
+        first.close()
+        second.close()
+
+    def test_incomplete_lines_are_skipped(self, tmp_path):
+        path = tmp_path / "trace.jsonl"
+        path.write_text('[1.0,"m",1,null,2,3,5]\n[2.0,"m",1,nu')
+
+        assert len(list(read_trace(str(path)))) == 1
+
+
+class TestReplay:
+    def test_replays_messages_and_clicks(self, tmp_path):
+        path = str(tmp_path / "trace.jsonl")
+        record(path)
+
+        report = asyncio.run(
+            run_replay(path, speed=100, response_tokens=2, token_latency=0.001)
+        )
+
+        assert report["requests"] == 4
+        assert report["trace"]["channels"] == 2
+        assert report["trace"]["skipped_clicks"] == 0
+        assert report["outcomes"]["completed"] == 4
+        assert report["end_to_end_seconds"]["p50"] > 0
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+import pytest
+from llama_discord_bot.backends import BackendBuilder
+from llama_discord_bot.llama import LlamaBase, Message, ChatUser
+from llama_discord_bot.loader import BackendLoadingError
+from llama_discord_bot.worker_pool import LlamaWorkerPool, WorkerError
+
+
+class EchoLlama(LlamaBase):
+    """Answers with the pid of the process it runs in, or crashes it if asked to."""
+
+    async def generate_response(self, messages, suffix="", **kwargs):
+        if messages[-1].content == "crash":
+            os._exit(1)
+        return f"{os.getpid()}"
+
+
+class SlowLlama(LlamaBase):
+    """Streams a long response slowly."""
+
+    async def generate_response(self, messages, suffix="", **kwargs):
+        return "done"
+
+    async def stream_response(self, messages, suffix="", **kwargs):
+        if messages[-1].content != "stream":
+            yield await self.generate_response(messages, suffix)
+            return
+        for _ in range(1000):
+            await asyncio.sleep(0.01)
+            yield "."
+
+
+class WarmedLlama(LlamaBase):
+    """Answers with the first prompt it was given, which is the warmup prompt."""
+
+    async def generate_response(self, messages, suffix="", **kwargs):
+        if not hasattr(self, "first_prompt"):
+            self.first_prompt = messages[-1].content
+        return self.first_prompt
+
+
+def load_tokenizer():
+    return lambda text: 1
+
+
+MESSAGES = [Message(ChatUser.HUMAN, "Hello")]
+
+
+class TestLlamaWorkerPool:
+    def test_requests_run_in_worker_processes(self):
+        async def run():
+            pool = LlamaWorkerPool(EchoLlama, workers=2)
+            responses = await asyncio.gather(
+                *[pool.generate_response(MESSAGES) for _ in range(4)]
+            )
+            stats = pool.stats()
+            await pool.close()
+            return responses, stats
+
+        responses, stats = asyncio.run(run())
+
+        assert str(os.getpid()) not in responses
+        assert stats["requests"] == 4
+        assert stats["alive"] == 2
+
+    def test_channel_affinity(self):
+        async def run():
+            pool = LlamaWorkerPool(EchoLlama, workers=2)
+            first = await pool.generate_response(MESSAGES, channel_id=1)
+            second = await pool.generate_response(MESSAGES, channel_id=1)
+            stats = pool.stats()
+            await pool.close()
+            return first, second, stats
+
+        first, second, stats = asyncio.run(run())
+
+        assert first == second
+        assert stats["affinity_hits"] == 1
+
+    def test_dead_worker_is_restarted(self):
+        async def run():
+            pool = LlamaWorkerPool(EchoLlama, workers=1)
+            with pytest.raises(WorkerError):
+                await pool.generate_response([Message(ChatUser.HUMAN, "crash")])
+            response = await pool.generate_response(MESSAGES)
+            stats = pool.stats()
+            await pool.close()
+            return response, stats
+
+        response, stats = asyncio.run(run())
+
+        assert response.isdigit()
+        assert stats["restarts"] == 1
+
+    def test_abandoned_request_is_cancelled(self):
+        async def run():
+            pool = LlamaWorkerPool(SlowLlama, workers=1)
+            chunks = pool.stream_response([Message(ChatUser.HUMAN, "stream")])
+            await anext(chunks)
+            await chunks.aclose()
+
+            start = time.monotonic()
+            response = await pool.generate_response(MESSAGES)
+            elapsed = time.monotonic() - start
+            stats = pool.stats()
+            await pool.close()
+            return response, elapsed, stats
+
+        response, elapsed, stats = asyncio.run(run())
+
+        assert response == "done"
+        assert elapsed < 5
+        assert stats["cancelled"] == 1
+
+    def test_closed_with_the_backends(self):
+        async def run():
+            builder = BackendBuilder()
+            pool = LlamaWorkerPool(EchoLlama, workers=2)
+            builder.worker_pools.append(pool)
+            processes = [worker.process for worker in pool._workers]
+            await builder.close()
+            return pool.stats(), processes
+
+        stats, processes = asyncio.run(run())
+
+        assert stats["workers"] == 0
+        assert not any(process.is_alive() for process in processes)
+
+    def test_started_like_a_loader(self):
+        async def run():
+            pool = LlamaWorkerPool(
+                WarmedLlama,
+                workers=2,
+                tokenizer=load_tokenizer,
+                warmup_prompt="Warm up",
+                wait=False,
+            )
+            loaders = BackendBuilder.loaders(pool)
+            with pytest.raises(BackendLoadingError):
+                await pool.generate_response(MESSAGES)
+            await pool.start()
+            response = await pool.generate_response(MESSAGES)
+            count = pool.count_tokens("Hello there")
+            await pool.close()
+            return loaders, response, count
+
+        loaders, response, count = asyncio.run(run())
+
+        assert len(loaders) == 1
+        assert response == "Warm up"
+        assert count == 1